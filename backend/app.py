@@ -1,23 +1,54 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 import os
+import sys
 import json
+import base64
+import hashlib
+import uuid
 from datetime import datetime
 import boto3
+from boto3.dynamodb.conditions import Attr, Key
+from boto3.dynamodb.types import TypeSerializer
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import NoCredentialsError, ClientError
 from airflow.api.client.local_client import Client
 
+# The search cache's data version and the detected_data helpers are shared with the Telegram Lambda package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'telegram_lambda_package'))
+
+import detected_data  # noqa: E402
+import query_cache  # noqa: E402
+
 # AWS and Airflow configurations
 dynamodb = boto3.resource('dynamodb')
 TABLE_NAME = 'pdf_metadata'
+# Global secondary indexes of pdf_metadata (created by create_pdf_metadata_indexes.py)
+FILENAME_INDEX = 'filename-index'
+SHOP_INDEX = 'shop_name-valid_to-index'
+CONTENT_INDEX = 'content_sha256-index'
+REGISTRY_TABLE_NAME = 'bot_registry'
+SHOP_REGISTRY_KEY = 'shops'
+# Registry items claiming a filename; the filename index cannot enforce unique filenames across shops
+FILENAME_REGISTRY_PREFIX = 'filename#'
 BUCKET_NAME = 'salestelegrambot'
 AWS_REGION = 'eu-west-1'
 AIRFLOW_URL = 'http://localhost:8080/api/v1'
 AIRFLOW_DAG_ID = 'pages_data_pipeline'
 
 s3 = boto3.client('s3', region_name=AWS_REGION)
+# Multipart uploads of 8 MB parts, several parts in flight; memory stays bounded by the parts in flight
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024,
+                                 max_concurrency=4)
+pdf_table = dynamodb.Table(TABLE_NAME)
+# Converts items to the low-level format of the client calls (transactions)
+type_serializer = TypeSerializer()
+
+# Airflow client shared by all pipeline triggers (see get_airflow_client)
+airflow_client = None
 
 # Flask app setup
 app = Flask(__name__)
@@ -29,6 +60,19 @@ ITEM_DETECTION_FOLDER = 'item_detection_files'
 ITEM_PROCESSING_FOLDER = 'item_processing_files'
 pdf_data_file = 'pdf_data.json'
 
+# Page size of /pdfs (default and maximum)
+PDF_PAGE_SIZE = 50
+MAX_PDF_PAGE_SIZE = 200
+
+# Concurrent S3 uploads of a batch upload
+UPLOAD_WORKERS = 4
+
+# Timeout in seconds for connecting to and reading from flyer URLs
+URL_DOWNLOAD_TIMEOUT = 30
+
+# Flyers expiring within this number of days are flagged as near expiry
+NEAR_EXPIRY_DAYS = 2
+
 # Ensure necessary directories exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(ITEM_DETECTION_FOLDER, exist_ok=True)
@@ -46,24 +90,539 @@ shops = [
 ]
 
 
-def load_pdf_data():
-    """Load PDF metadata from DynamoDB."""
+class HashingReader:
+    """File-like wrapper computing the SHA-256 and size of the bytes read through it."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.sha256.update(chunk)
+        self.size += len(chunk)
+        return chunk
+
+
+def upload_stream_to_s3(stream, filename):
+    """
+    Upload a stream to S3 as pdfs/<filename> with a multipart upload, hashing the bytes on the way.
+    Returns the S3 URL, the hex SHA-256 and the size of the content.
+    """
+    reader = HashingReader(stream)
+    s3.upload_fileobj(reader, BUCKET_NAME, f'pdfs/{filename}', Config=TRANSFER_CONFIG)
+    return f"https://{BUCKET_NAME}.s3.amazonaws.com/pdfs/{filename}", reader.sha256.hexdigest(), reader.size
+
+
+def upload_url_to_s3(file_url, filename):
+    """Stream a file from a URL straight into S3 without buffering it in memory or on disk."""
+    with requests.get(file_url, stream=True, timeout=URL_DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True  # Undo a Content-Encoding such as gzip
+        return upload_stream_to_s3(response.raw, filename)
+
+
+def encode_cursor(last_evaluated_key):
+    """Encode a DynamoDB LastEvaluatedKey as an opaque URL-safe cursor."""
+    if not last_evaluated_key:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(last_evaluated_key).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, key_attributes):
+    """
+    Decode a cursor produced by encode_cursor into an ExclusiveStartKey. Raises ValueError unless the
+    cursor holds exactly the key attributes of the query being run (e.g. a cursor of a shop query is
+    reused without the shop filter), which DynamoDB would reject.
+    """
+    start_key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    if (not isinstance(start_key, dict) or set(start_key) != set(key_attributes)
+            or not all(isinstance(value, str) for value in start_key.values())):
+        raise ValueError("cursor does not belong to this query")
+    return start_key
+
+
+def list_pdf_entries(limit, cursor=None, shop_name=None, window_from=None, window_to=None, used=None,
+                     page_split=None):
+    """
+    Load one page of PDF entries. Entries of a shop are queried from the shop index in the order
+    of valid_to, with the validity window as key condition; without a shop the table is scanned
+    page by page. Filters on booleans cannot be index keys and are applied as filter expressions.
+    Returns the entries and the cursor of the next page (None on the last page).
+    Raises ValueError for a cursor that does not belong to the query.
+    """
+    filters = []
+    if window_to:
+        filters.append(Attr('valid_from').lte(window_to))
+    if used is not None:
+        filters.append(Attr('used').eq(used))
+    if page_split is not None:
+        filters.append(Attr('page_split').eq(page_split))
+
+    kwargs = {}
+    start_key = None
+    if shop_name:
+        key_condition = Key('shop_name').eq(shop_name)
+        if window_from:
+            key_condition &= Key('valid_to').gte(window_from)
+        kwargs.update(IndexName=SHOP_INDEX, KeyConditionExpression=key_condition)
+        operation = pdf_table.query
+        if cursor:
+            # Keys of an index page hold the table key and the index key
+            start_key = decode_cursor(cursor, ('filename', 'shop_name', 'valid_to'))
+            if start_key['shop_name'] != shop_name or (window_from and start_key['valid_to'] < window_from):
+                raise ValueError("cursor does not belong to this query")
+    else:
+        if window_from:
+            filters.append(Attr('valid_to').gte(window_from))
+        operation = pdf_table.scan
+        if cursor:
+            start_key = decode_cursor(cursor, ('filename', 'shop_name'))
+
+    if filters:
+        filter_expression = filters[0]
+        for condition in filters[1:]:
+            filter_expression &= condition
+        kwargs['FilterExpression'] = filter_expression
+    if start_key:
+        kwargs['ExclusiveStartKey'] = start_key
+
+    # Filtered pages can come back short, so keep reading until the page is full
+    items = []
+    while True:
+        response = operation(Limit=limit - len(items), **kwargs)
+        items.extend(response.get('Items', []))
+        last_evaluated_key = response.get('LastEvaluatedKey')
+        if not last_evaluated_key or len(items) >= limit:
+            return items, encode_cursor(last_evaluated_key)
+        kwargs['ExclusiveStartKey'] = last_evaluated_key
+
+
+def is_near_expiry(entry, today):
+    """Whether a flyer expires within NEAR_EXPIRY_DAYS days (or already expired)."""
+    valid_to = datetime.strptime(entry['valid_to'], '%Y-%m-%d').date()
+    return (valid_to - today).days <= NEAR_EXPIRY_DAYS
+
+
+def parse_bool_arg(name):
+    """Read an optional 'true'/'false' query argument; raises ValueError for other values."""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    if value.lower() not in ('true', 'false'):
+        raise ValueError(f"{name} must be 'true' or 'false'")
+    return value.lower() == 'true'
+
+
+def pdf_key(entry):
+    """Primary key of a PDF entry."""
+    return {'filename': entry['filename'], 'shop_name': entry['shop_name']}
+
+
+def get_pdf_entry(filename):
+    """Look up the PDF entry of a filename through the filename index (None if there is none)."""
+    response = pdf_table.query(IndexName=FILENAME_INDEX, KeyConditionExpression=Key('filename').eq(filename), Limit=1)
+    items = response.get('Items', [])
+    return items[0] if items else None
+
+
+def serialize_item(item):
+    """Convert an item to the low-level format of transactions."""
+    return {key: type_serializer.serialize(value) for key, value in item.items()}
+
+
+def filename_registry_key(filename):
+    """Registry key of the item claiming a filename for one PDF entry."""
+    return serialize_item({'registry_key': FILENAME_REGISTRY_PREFIX + filename})
+
+
+def claim_filename(filename):
+    """Transaction item claiming a filename; cancels the transaction if another entry holds it."""
+    return {'Put': {
+        'TableName': REGISTRY_TABLE_NAME,
+        'Item': filename_registry_key(filename),
+        'ConditionExpression': 'attribute_not_exists(registry_key)'
+    }}
+
+
+def release_filename(filename):
+    """Transaction item releasing a filename (entries written before the claims existed hold none)."""
+    return {'Delete': {'TableName': REGISTRY_TABLE_NAME, 'Key': filename_registry_key(filename)}}
+
+
+def create_pdf_entry(entry):
+    """
+    Write a new PDF entry and claim its filename in one transaction; the transaction is cancelled
+    if the filename is taken, also by an entry of another shop.
+    """
+    dynamodb.meta.client.transact_write_items(TransactItems=[
+        claim_filename(entry['filename']),
+        {'Put': {
+            'TableName': TABLE_NAME,
+            'Item': serialize_item(entry),
+            'ConditionExpression': 'attribute_not_exists(filename)'
+        }}
+    ])
+
+
+def update_pdf_entry(entry, changes, removed=()):
+    """
+    Apply changed attributes to a PDF entry with a single update_item; attributes listed in
+    removed are dropped. Changing a key attribute (filename or shop_name) moves the entry in one
+    transaction that writes the new item and deletes the old one. Returns the updated entry.
+    """
+    if any(key in changes and changes[key] != entry[key] for key in ('filename', 'shop_name')):
+        updated_entry = {key: value for key, value in {**entry, **changes}.items() if key not in removed}
+        move_pdf_entry(entry, updated_entry)
+        return updated_entry
+
+    # Key attributes cannot be SET; they are unchanged here
+    changes = {attribute: value for attribute, value in changes.items() if attribute not in ('filename', 'shop_name')}
+    names = {f"#a{i}": attribute for i, attribute in enumerate(changes)}
+    removed_names = {f"#r{i}": attribute for i, attribute in enumerate(removed)}
+    values = {f":v{i}": value for i, value in enumerate(changes.values())}
+    clauses = []
+    if names:
+        clauses.append('SET ' + ', '.join(f"{name} = :v{i}" for i, name in enumerate(names)))
+    if removed_names:
+        clauses.append('REMOVE ' + ', '.join(removed_names))
+    if not clauses:
+        return entry
+
+    update_kwargs = {'ExpressionAttributeValues': values} if values else {}
+    response = pdf_table.update_item(
+        Key=pdf_key(entry),
+        UpdateExpression=' '.join(clauses),
+        ConditionExpression='attribute_exists(filename)',
+        ExpressionAttributeNames={**names, **removed_names},
+        ReturnValues='ALL_NEW',
+        **update_kwargs
+    )
+    return response['Attributes']
+
+
+def move_pdf_entry(entry, updated_entry):
+    """
+    Replace a PDF entry by one with a different key in a single transaction. The transaction is
+    cancelled if the new key or filename is taken or the old entry was deleted meanwhile.
+    """
+    transact_items = [
+        {'Put': {
+            'TableName': TABLE_NAME,
+            'Item': serialize_item(updated_entry),
+            'ConditionExpression': 'attribute_not_exists(filename)'
+        }},
+        {'Delete': {
+            'TableName': TABLE_NAME,
+            'Key': serialize_item(pdf_key(entry)),
+            'ConditionExpression': 'attribute_exists(filename)'
+        }}
+    ]
+    if updated_entry['filename'] != entry['filename']:
+        transact_items += [claim_filename(updated_entry['filename']), release_filename(entry['filename'])]
+    dynamodb.meta.client.transact_write_items(TransactItems=transact_items)
+
+
+def delete_pdf_entry(entry):
+    """Delete a PDF entry and release its filename; the transaction is cancelled if it was deleted meanwhile."""
+    dynamodb.meta.client.transact_write_items(TransactItems=[
+        {'Delete': {
+            'TableName': TABLE_NAME,
+            'Key': serialize_item(pdf_key(entry)),
+            'ConditionExpression': 'attribute_exists(filename)'
+        }},
+        release_filename(entry['filename'])
+    ])
+
+
+def find_pdf_by_content(content_sha256, ignored_filename=None):
+    """Look up an entry other than ignored_filename with the given content hash (None if there is none)."""
+    response = pdf_table.query(IndexName=CONTENT_INDEX, KeyConditionExpression=Key('content_sha256').eq(content_sha256),
+                               Limit=2)
+    return next((item for item in response.get('Items', []) if item['filename'] != ignored_filename), None)
+
+
+def flyer_key(entry):
+    """Content, shop and validity window of an entry; entries with the same key share their detected items."""
+    return entry.get('content_sha256'), entry['shop_name'], entry['valid_from'], entry['valid_to']
+
+
+def find_processed_duplicate(entry):
+    """
+    Look up another entry with the same flyer_key that was sent through the pipeline (None if there
+    is none). The detected items of such entries are linked to the one entry that was processed.
+    """
+    if not entry.get('content_sha256'):
+        return None
+    response = pdf_table.query(IndexName=CONTENT_INDEX,
+                               KeyConditionExpression=Key('content_sha256').eq(entry['content_sha256']))
+    return next((item for item in response.get('Items', [])
+                 if item['filename'] != entry['filename'] and item.get('used') and flyer_key(item) == flyer_key(entry)),
+                None)
+
+
+def pdf_object_name(entry):
+    """
+    Name of the S3 object (under pdfs/) holding the content of an entry; duplicates share the original's
+    object. Entries written before object_name existed use the object named like the entry.
+    """
+    return entry.get('object_name', entry.get('duplicate_of', entry['filename']))
+
+
+def new_pdf_object_name(filename):
+    """Fresh S3 object name for new content of filename, so an upload never overwrites an object in use."""
+    base, ext = os.path.splitext(filename)
+    return f"{base}-{uuid.uuid4().hex}{ext}"
+
+
+def delete_pdf_object_if_unshared(entry, updated_entry=None):
+    """
+    Delete the S3 object of an entry unless another entry with the same content still uses it.
+    updated_entry is the entry's new version after its content was replaced (it keeps the object
+    only if it still points to it).
+    """
+    object_name = pdf_object_name(entry)
+    if updated_entry is not None and pdf_object_name(updated_entry) == object_name:
+        return
+
+    ignored_filenames = {entry['filename']} | ({updated_entry['filename']} if updated_entry is not None else set())
+    if entry.get('content_sha256'):
+        response = pdf_table.query(IndexName=CONTENT_INDEX,
+                                   KeyConditionExpression=Key('content_sha256').eq(entry['content_sha256']),
+                                   ProjectionExpression='filename')
+        if any(item['filename'] not in ignored_filenames for item in response.get('Items', [])):
+            return
+    s3.delete_object(Bucket=BUCKET_NAME, Key=f'pdfs/{object_name}')
+
+
+def discard_pdf_upload(pdf_content):
+    """Delete the object uploaded for an entry that was not written (duplicates did not upload one)."""
+    if 'duplicate_of' not in pdf_content:
+        s3.delete_object(Bucket=BUCKET_NAME, Key=f"pdfs/{pdf_content['object_name']}")
+
+
+def deduplicate_upload(object_name, content_sha256, filename):
+    """
+    Check whether the bytes just uploaded as pdfs/<object_name> for the entry of filename were
+    uploaded before by another entry. A duplicate's object is deleted and the entry points to the
+    original's object instead, so the pipeline never processes the same content twice.
+    Returns the original entry, or None for new content.
+    """
+    original = find_pdf_by_content(content_sha256, filename)
+    if original:
+        s3.delete_object(Bucket=BUCKET_NAME, Key=f'pdfs/{object_name}')
+    return original
+
+
+def upload_pdf_content(filename, file=None, file_url=None, entry_filename=None):
+    """
+    Upload the content of a flyer named filename (a multipart file or the file behind a URL) under a
+    fresh object name and return the entry attributes describing it. Identical bytes uploaded before
+    by another entry than entry_filename (default: filename) reuse that entry's object.
+    """
+    object_name = new_pdf_object_name(filename)
+    if file:
+        s3_url, content_sha256, content_size = upload_stream_to_s3(file.stream, object_name)
+    else:
+        s3_url, content_sha256, content_size = upload_url_to_s3(file_url, object_name)
+
+    pdf_content = {"object_name": object_name, "s3_url": s3_url, "content_sha256": content_sha256,
+                   "content_size": content_size, "used": False}
+
+    # Identical bytes uploaded under another name reuse the existing object (trigger_pdf_pipeline
+    # decides whether the entry shares the detected items of another one)
+    original = deduplicate_upload(object_name, content_sha256, entry_filename or filename)
+    if original:
+        pdf_content['object_name'] = pdf_content['duplicate_of'] = pdf_object_name(original)
+        pdf_content['s3_url'] = original['s3_url']
+    return pdf_content
+
+
+class UploadError(Exception):
+    """An upload rejected because of the request (carries the HTTP status code of the response)."""
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def upload_filename(file=None, file_url=None):
+    """Filename of an uploaded flyer: the name of the multipart file or the last path segment of the URL."""
+    if file:
+        return file.filename
+    if file_url:
+        return file_url.split('/')[-1].split('?')[0]
+    return None
+
+
+def prepare_pdf_entry(shop_name, valid_from, valid_to, file=None, file_url=None):
+    """
+    Upload a flyer (a multipart file or the file behind a URL) to S3 and build its PDF entry
+    without writing it. Duplicates of earlier uploads point to the existing object; callers
+    failing to write the entry discard the upload with discard_pdf_upload.
+    Raises UploadError for invalid input or an existing filename.
+    """
+    if not shop_name or not valid_from or not valid_to:
+        raise UploadError("Missing required fields", 400)
+
+    filename = upload_filename(file, file_url)
+    if not filename:
+        raise UploadError("Either file or file_url must be provided", 400)
+
+    # Convert valid_from and valid_to to date objects
+    try:
+        valid_from_date = datetime.strptime(valid_from, '%Y-%m-%d').date()
+        valid_to_date = datetime.strptime(valid_to, '%Y-%m-%d').date()
+    except ValueError:
+        raise UploadError("Dates must have the format YYYY-MM-DD", 400)
+
+    # Reject the upload before transferring the file; the entry could not be written
+    if get_pdf_entry(filename):
+        raise UploadError(f"File {filename} already exists", 409)
+
+    pdf_content = upload_pdf_content(filename, file, file_url)
+
+    # Get today's date
+    today = datetime.utcnow().date()
+
+    # Determine if the PDF is valid based on the current date
+    is_valid = valid_from_date <= today <= valid_to_date
+
+    return {
+        "shop_name": shop_name,
+        "filename": filename,
+        "valid_from": valid_from,
+        "valid_to": valid_to,
+        "upload_date": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        "page_split": False,
+        "valid": is_valid,
+        **pdf_content
+    }
+
+
+def get_airflow_client():
+    """Return the Airflow client, created once and reused by all requests."""
+    global airflow_client
+    if airflow_client is None:
+        airflow_client = Client(None, None)
+    return airflow_client
+
+
+def trigger_pdf_pipeline(file_entry, processed_flyers=None, force=False):
+    """
+    Trigger one DAG run for a PDF entry and mark the entry as used. Identical content is detected
+    once per shop and validity window: if another entry with the same flyer_key (or a key in
+    processed_flyers, the keys triggered by the current batch) was processed, the entry shares its
+    detected items and is only marked as used. force triggers the run anyway (e.g. after a failed run).
+    Returns True if a DAG run was triggered.
+    """
+    key = flyer_key(file_entry) if file_entry.get('content_sha256') else None
+    if not force and key and (key in (processed_flyers or ()) or find_processed_duplicate(file_entry)):
+        update_pdf_entry(file_entry, {'used': True})
+        return False
+
+    # The DAG reads the object and passes pdf_filename on to ingest_flyer.py
+    payload = {'filename': pdf_object_name(file_entry), 'pdf_filename': file_entry['filename'],
+               'shop_name': file_entry['shop_name'], 'valid': file_entry['valid']}
+    app.logger.debug(f"Triggering Airflow DAG with payload: {json.dumps(payload)}")
+
+    get_airflow_client().trigger_dag(dag_id=AIRFLOW_DAG_ID, run_id=None, conf=payload)
+    update_pdf_entry(file_entry, {'used': True})
+    if key and processed_flyers is not None:
+        processed_flyers.add(key)
+    return True
+
+
+def shop_has_pdfs(shop_name, ignored_filename=None):
+    """Check through the shop index whether any PDF entry other than ignored_filename belongs to a shop."""
+    # The index is eventually consistent, so a just deleted entry may still be returned
+    response = pdf_table.query(IndexName=SHOP_INDEX, KeyConditionExpression=Key('shop_name').eq(shop_name),
+                               ProjectionExpression='filename', Limit=2)
+    return any(item['filename'] != ignored_filename for item in response.get('Items', []))
+
+
+def is_conditional_check_failure(error):
+    """Whether a ClientError was raised by a failed ConditionExpression (also within a transaction)."""
+    code = error.response['Error']['Code']
+    if code == 'TransactionCanceledException':
+        return any(reason.get('Code') == 'ConditionalCheckFailed'
+                   for reason in error.response.get('CancellationReasons', []))
+    return code == 'ConditionalCheckFailedException'
+
+
+def seed_shop_registry(shop_name):
+    """
+    Create the shop registry from all shops of pdf_metadata (and shop_name) unless it exists.
+    The registry must list every shop, so a missing item is never created with a single shop.
+    """
+    shop_names = {shop_name}
+    scan_kwargs = {'ProjectionExpression': 'shop_name'}
+    while True:
+        response = pdf_table.scan(**scan_kwargs)
+        shop_names.update(item['shop_name'] for item in response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
     try:
-        response = dynamodb.Table(TABLE_NAME).scan()
-        return response.get('Items', [])
+        dynamodb.Table(REGISTRY_TABLE_NAME).put_item(
+            Item={'registry_key': SHOP_REGISTRY_KEY, 'shops': shop_names},
+            ConditionExpression='attribute_not_exists(registry_key)'
+        )
+        return True
+    except ClientError as e:
+        if not is_conditional_check_failure(e):
+            raise
+        return False  # Seeded meanwhile (e.g. by the bot)
+
+
+def register_shop(shop_name):
+    """Add a shop to the shop registry read by the Telegram bot, seeding the registry if it is missing."""
+    try:
+        for _ in range(2):
+            try:
+                dynamodb.Table(REGISTRY_TABLE_NAME).update_item(
+                    Key={'registry_key': SHOP_REGISTRY_KEY},
+                    UpdateExpression='ADD shops :shop',
+                    ConditionExpression='attribute_exists(registry_key)',
+                    ExpressionAttributeValues={':shop': {shop_name}}
+                )
+                return
+            except ClientError as e:
+                if not is_conditional_check_failure(e):
+                    raise
+            if seed_shop_registry(shop_name):
+                return
     except Exception as e:
-        logging.error(f"Error loading data from DynamoDB: {e}")
-        return []
+        logging.error(f"Error registering shop {shop_name}: {e}")
+
+
+def unregister_shop_if_unused(shop_name, removed_filename=None):
+    """Remove a shop from the shop registry when no remaining PDF entry belongs to it."""
+    try:
+        if shop_has_pdfs(shop_name, removed_filename):
+            return
+        # A missing registry is left to be seeded from pdf_metadata, which no longer lists the shop
+        dynamodb.Table(REGISTRY_TABLE_NAME).update_item(
+            Key={'registry_key': SHOP_REGISTRY_KEY},
+            UpdateExpression='DELETE shops :shop',
+            ConditionExpression='attribute_exists(registry_key)',
+            ExpressionAttributeValues={':shop': {shop_name}}
+        )
+    except ClientError as e:
+        if not is_conditional_check_failure(e):
+            logging.error(f"Error unregistering shop {shop_name}: {e}")
+    except Exception as e:
+        logging.error(f"Error unregistering shop {shop_name}: {e}")
 
 
-def save_pdf_data(data):
-    """Save PDF metadata to DynamoDB."""
-    table = dynamodb.Table(TABLE_NAME)
+def bump_data_version():
+    """Invalidate the search results cached by the Telegram bot after flyer validity changed."""
     try:
-        for entry in data:
-            table.put_item(Item=entry)
+        query_cache.bump_data_version()
     except Exception as e:
-        logging.error(f"Error saving data to DynamoDB: {e}")
+        logging.error(f"Error bumping data version: {e}")
 
 
 def get_unique_filename(filepath):
@@ -85,78 +644,170 @@ def get_shops():
 
 @app.route('/pdfs', methods=['GET'])
 def get_pdfs():
-    pdf_data = load_pdf_data()
-    return jsonify(pdf_data)
-
-
-@app.route('/upload', methods=['POST'])
-def upload_file():
-    shop_name = request.form.get('shop_name')
-    valid_from = request.form.get('valid_from')
-    valid_to = request.form.get('valid_to')
-    file = request.files.get('file')
-    file_url = request.form.get('file_url')
-
-    if not shop_name or not valid_from or not valid_to:
-        return jsonify({"error": "Missing required fields"}), 400
+    """
+    List one page of PDF entries. Query arguments: limit, cursor (next_cursor of the previous page),
+    shop, valid_from/valid_to (entries valid at some day of the window), used, page_split.
+    Responses carry an ETag, so an unchanged page is answered with 304 Not Modified.
+    """
+    try:
+        limit = min(int(request.args.get('limit', PDF_PAGE_SIZE)), MAX_PDF_PAGE_SIZE)
+        window_from = request.args.get('valid_from')
+        window_to = request.args.get('valid_to')
+        for date in (window_from, window_to):
+            if date:
+                datetime.strptime(date, '%Y-%m-%d')
+        used = parse_bool_arg('used')
+        page_split = parse_bool_arg('page_split')
+        if limit < 1:
+            raise ValueError("limit must be positive")
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query argument: {e}"}), 400
 
     try:
-        if file:
-            filename = file.filename
-            s3.upload_fileobj(file, BUCKET_NAME, f'pdfs/{filename}')
-            s3_url = f"https://{BUCKET_NAME}.s3.amazonaws.com/pdfs/{filename}"
-        elif file_url:
-            response = requests.get(file_url)
-            filename = file_url.split('/')[-1].split('?')[0]
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            with open(file_path, 'wb') as f:
-                f.write(response.content)
-            with open(file_path, 'rb') as f:
-                s3.upload_fileobj(f, BUCKET_NAME, f'pdfs/{filename}')
-            s3_url = f"https://{BUCKET_NAME}.s3.amazonaws.com/pdfs/{filename}"
-        else:
-            return jsonify({"error": "Either file or file_url must be provided"}), 400
+        items, next_cursor = list_pdf_entries(limit, request.args.get('cursor'), request.args.get('shop'),
+                                              window_from, window_to, used, page_split)
+    except (ValueError, UnicodeError):
+        return jsonify({"error": "Invalid cursor"}), 400
+    except ClientError as e:
+        logging.error(f"Error loading data from DynamoDB: {e}")
+        return jsonify({"error": "Error loading PDFs"}), 500
 
-        # Convert valid_from and valid_to to date objects
-        valid_from_date = datetime.strptime(valid_from, '%Y-%m-%d').date()
-        valid_to_date = datetime.strptime(valid_to, '%Y-%m-%d').date()
+    today = datetime.utcnow().date()
+    for item in items:
+        item['near_expiry'] = is_near_expiry(item, today)
 
-        # Get today's date
-        today = datetime.utcnow().date()
+    response = jsonify({"items": items, "next_cursor": next_cursor})
+    response.headers['Cache-Control'] = 'no-cache'
+    response.add_etag()
+    return response.make_conditional(request)
 
-        # Determine if the PDF is valid based on the current date
-        is_valid = valid_from_date <= today <= valid_to_date
 
-        pdf_entry = {
-            "shop_name": shop_name,
-            "filename": filename,
-            "s3_url": s3_url,
-            "valid_from": valid_from,
-            "valid_to": valid_to,
-            "upload_date": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            "page_split": False,
-            "used": False,
-            "valid": is_valid
-        }
-        pdf_data = load_pdf_data()
-        pdf_data.append(pdf_entry)
-        save_pdf_data(pdf_data)
-
-        return jsonify(
-            {"message": "File uploaded successfully", "filename": filename, "s3_url": s3_url, "valid": is_valid}), 200
+@app.route('/upload', methods=['POST'])
+def upload_file():
+    file_url = request.form.get('file_url')
 
+    try:
+        pdf_entry = prepare_pdf_entry(request.form.get('shop_name'), request.form.get('valid_from'),
+                                      request.form.get('valid_to'), request.files.get('file'), file_url)
+        try:
+            create_pdf_entry(pdf_entry)
+        except ClientError:
+            discard_pdf_upload(pdf_entry)
+            raise
+        register_shop(pdf_entry['shop_name'])
+
+        return jsonify({"message": "File uploaded successfully", "filename": pdf_entry['filename'],
+                        "s3_url": pdf_entry['s3_url'], "valid": pdf_entry['valid'],
+                        "duplicate_of": pdf_entry.get('duplicate_of')}), 200
+
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status_code
     except NoCredentialsError:
         return jsonify({"error": "AWS credentials not available"}), 500
+    except requests.RequestException as e:
+        return jsonify({"error": f"Error downloading {file_url}: {e}"}), 502
+    except ClientError as e:
+        if is_conditional_check_failure(e):
+            return jsonify({"error": "File already exists"}), 409
+        return jsonify({"error": f"Error uploading file: {e}"}), 500
+
+
+@app.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    """
+    Upload many flyers at once. The form field 'items' holds a JSON list of objects with
+    shop_name, valid_from, valid_to and either file_url or file (the name of a multipart file
+    field of the request). Files are uploaded concurrently and every entry is written as soon as
+    its upload is done; one JSON status line per item is streamed back after its entry was written.
+    """
+    try:
+        items = json.loads(request.form.get('items', ''))
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            raise ValueError("items must be a list of objects")
+    except ValueError as e:
+        return jsonify({"error": f"Invalid items: {e}"}), 400
+
+    def item_error(item):
+        # Checked in the request thread, the upload workers have no request context
+        file_field, file_url = item.get('file'), item.get('file_url')
+        if file_field is not None and not isinstance(file_field, str):
+            return "file must be the name of a file field"
+        if file_url is not None and not isinstance(file_url, str):
+            return "file_url must be a string"
+        if file_field and file_field not in request.files:
+            return f"No file field {file_field} in request"
+        return None
+
+    # Invalid items are reported on their own status line and not uploaded
+    errors = {index: error for index, error in enumerate(map(item_error, items)) if error}
+    files = [request.files.get(item['file']) if index not in errors and item.get('file') else None
+             for index, item in enumerate(items)]
+
+    # Items with the same filename would write the same entry
+    filenames = [upload_filename(file, item.get('file_url')) if index not in errors else None
+                 for index, (item, file) in enumerate(zip(items, files))]
+    repeated = sorted({name for name in filenames if name and filenames.count(name) > 1})
+    if repeated:
+        return jsonify({"error": f"Duplicate filenames in batch: {', '.join(repeated)}"}), 400
+
+    def upload_item(item, file):
+        return prepare_pdf_entry(item.get('shop_name'), item.get('valid_from'), item.get('valid_to'),
+                                 file, item.get('file_url'))
+
+    def save_item(pdf_entry, batch_originals):
+        # Identical files within the batch point to the object of the first entry written
+        original = batch_originals.get(pdf_entry['content_sha256'])
+        if original is not None and 'duplicate_of' not in pdf_entry:
+            discard_pdf_upload(pdf_entry)
+            pdf_entry['object_name'] = pdf_entry['duplicate_of'] = pdf_object_name(original)
+            pdf_entry['s3_url'] = original['s3_url']
+
+        try:
+            create_pdf_entry(pdf_entry)
+        except ClientError as e:
+            discard_pdf_upload(pdf_entry)
+            if is_conditional_check_failure(e):
+                raise UploadError(f"File {pdf_entry['filename']} already exists", 409)
+            raise
+        batch_originals.setdefault(pdf_entry['content_sha256'], pdf_entry)
+
+    def generate():
+        batch_originals = {}
+        registered_shops = set()
+        saved = 0
+
+        for index, error in sorted(errors.items()):
+            yield json.dumps({"index": index, "status": "failed", "error": error}) + "\n"
+
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+            futures = {executor.submit(upload_item, item, file): index
+                       for index, (item, file) in enumerate(zip(items, files)) if index not in errors}
+
+            for future in as_completed(futures):
+                status = {"index": futures[future]}
+                try:
+                    pdf_entry = future.result()
+                    save_item(pdf_entry, batch_originals)
+                    registered_shops.add(pdf_entry['shop_name'])
+                    saved += 1
+                    status.update(status="uploaded", filename=pdf_entry['filename'],
+                                  duplicate_of=pdf_entry.get('duplicate_of'))
+                except Exception as e:
+                    status.update(status="failed", error=str(e))
+                yield json.dumps(status) + "\n"
+
+        for shop_name in registered_shops:
+            register_shop(shop_name)
+        yield json.dumps({"status": "saved", "count": saved}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 
 @app.route('/update/<filename>', methods=['POST'])
 def update_file(filename):
     try:
-        # Load the current PDF data from DynamoDB
-        pdf_data = load_pdf_data()
-
         # Find the entry for the specified filename
-        file_entry = next((entry for entry in pdf_data if entry['filename'] == filename), None)
+        file_entry = get_pdf_entry(filename)
 
         if not file_entry:
             return jsonify({"error": "File not found"}), 404
@@ -177,89 +828,153 @@ def update_file(filename):
         # Perform validity check based on the current date
         is_valid = valid_from_date <= today <= valid_to_date
 
-        # Update file if a new one is provided
+        changes = {'shop_name': shop_name, 'valid_from': valid_from, 'valid_to': valid_to, 'valid': is_valid}
+
+        removed = []
+
+        # Entries of one flyer share the detected items linked to one of them; an entry leaving the
+        # flyer (new content, shop or validity window) hands them over to an entry that stays
+        flyer_changed = (shop_name, valid_from, valid_to) != (file_entry['shop_name'], file_entry['valid_from'],
+                                                             file_entry['valid_to'])
+        remaining_entry = None
+        if file_entry.get('used') and (file or flyer_changed):
+            remaining_entry = find_processed_duplicate(file_entry)
+            if remaining_entry and not file:
+                changes['used'] = False  # The entry needs its own pipeline run
+
+        # Upload the new file to S3 under a fresh object name (the old object may still be in use)
+        pdf_content = None
         if file:
-            # Remove old file from S3
-            s3.delete_object(Bucket=BUCKET_NAME, Key=f'pdfs/{filename}')
+            pdf_content = upload_pdf_content(file.filename, file, entry_filename=filename)
+            changes['filename'] = file.filename
+            changes.update(pdf_content)
+            if 'duplicate_of' not in pdf_content and 'duplicate_of' in file_entry:
+                removed.append('duplicate_of')
+
+        # Save the changed attributes of the entry to DynamoDB
+        previous_shop_name = file_entry['shop_name']
+        previous_valid = file_entry.get('valid')
+        try:
+            updated_entry = update_pdf_entry(file_entry, changes, removed)
+        except ClientError:
+            if pdf_content:
+                discard_pdf_upload(pdf_content)
+            raise
+
+        # Remove the old file from S3 once nothing refers to it (kept while other entries share its content)
+        if file:
+            delete_pdf_object_if_unshared(file_entry, updated_entry)
 
-            # Upload new file to S3
-            new_filename = file.filename
-            s3.upload_fileobj(file, BUCKET_NAME, f'pdfs/{new_filename}')
-            s3_url = f"https://{BUCKET_NAME}.s3.amazonaws.com/pdfs/{new_filename}"
-            file_entry['filename'] = new_filename
-            file_entry['s3_url'] = s3_url
+        # Keep the bot's shop registry in sync with the changed shop name
+        if shop_name != previous_shop_name:
+            register_shop(shop_name)
+            unregister_shop_if_unused(previous_shop_name, filename)
 
-        # Update the metadata
-        file_entry['shop_name'] = shop_name
-        file_entry['valid_from'] = valid_from
-        file_entry['valid_to'] = valid_to
-        file_entry['valid'] = is_valid
+        # Keep the detected items of the flyer in sync (items of a replaced file are detected again)
+        if remaining_entry:
+            detected_data.relink_flyer_items(filename, remaining_entry['filename'])
+        elif file:
+            detected_data.delete_flyer_items(filename, bump_version=False)
+        elif shop_name != previous_shop_name or is_valid != previous_valid:
+            detected_data.update_flyer_items(filename, shop_name, is_valid, bump_version=False)
 
-        # Save updated entry back to DynamoDB
-        save_pdf_data(pdf_data)
+        if file or shop_name != previous_shop_name or is_valid != previous_valid:
+            bump_data_version()
 
         return jsonify({"message": f"File {filename} updated successfully", "valid": is_valid}), 200
 
+    except ClientError as e:
+        if is_conditional_check_failure(e):
+            return jsonify({"error": f"File {filename} was changed concurrently or the new name exists"}), 409
+        return jsonify({"error": f"Error updating file: {e}"}), 500
     except Exception as e:
         return jsonify({"error": f"Error updating file: {e}"}), 500
 
 
 @app.route('/trigger_pipeline/<filename>', methods=['POST'])
 def trigger_pipeline(filename):
-    pdf_data = load_pdf_data()
-    file_entry = next((entry for entry in pdf_data if entry['filename'] == filename), None)
+    file_entry = get_pdf_entry(filename)
 
     if not file_entry:
         return jsonify({"error": "File not found"}), 404
 
-    payload = {'filename': filename, 'shop_name': file_entry['shop_name'], 'valid': file_entry['valid']}
-    app.logger.debug(f"Triggering Airflow DAG with payload: {json.dumps(payload)}")
-
+    # force=true triggers a new run also if the flyer was processed (e.g. to retry a failed run)
     try:
-        client = Client(None, None)
-        client.trigger_dag(dag_id=AIRFLOW_DAG_ID, run_id=None, conf=payload)
-
-        file_entry['used'] = True
-        save_pdf_data(pdf_data)
+        force = parse_bool_arg('force') or False
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query argument: {e}"}), 400
 
+    try:
+        if not trigger_pdf_pipeline(file_entry, force=force):
+            return jsonify({"message": f"Content of {filename} was already processed"}), 200
         return jsonify({"message": f"Pipeline triggered for {filename}"}), 200
     except Exception as e:
         app.logger.error(f"Failed to trigger Airflow DAG: {e}")
         return jsonify({"error": "Failed to trigger Airflow DAG"}), 500
 
 
+@app.route('/trigger_pipeline/batch', methods=['POST'])
+def trigger_pipeline_batch():
+    """
+    Trigger the pipeline for many flyers. The JSON body holds {"filenames": [...]}; one DAG run is
+    triggered per file through the shared Airflow client, and one JSON status line per file is
+    streamed back.
+    """
+    filenames = (request.get_json(silent=True) or {}).get('filenames')
+    if not isinstance(filenames, list):
+        return jsonify({"error": "filenames must be a list"}), 400
+
+    def generate():
+        processed_flyers = set()  # Flyer keys triggered by this batch
+
+        for filename in filenames:
+            status = {"filename": filename}
+            try:
+                file_entry = get_pdf_entry(filename)
+                if not file_entry:
+                    status.update(status="failed", error="File not found")
+                elif trigger_pdf_pipeline(file_entry, processed_flyers):
+                    status.update(status="triggered")
+                else:
+                    status.update(status="already_processed")
+            except Exception as e:
+                app.logger.error(f"Failed to trigger Airflow DAG for {filename}: {e}")
+                status.update(status="failed", error=str(e))
+            yield json.dumps(status) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
 @app.route('/delete/<filename>', methods=['DELETE'])
 def delete_file(filename):
     try:
-        # Load PDF data
-        pdf_data = load_pdf_data()
-
         # Find the entry in the DynamoDB table
-        file_entry = next((entry for entry in pdf_data if entry['filename'] == filename), None)
+        file_entry = get_pdf_entry(filename)
 
         if not file_entry:
             return jsonify({"error": "File not found"}), 404
 
-        # Delete the file from S3
-        s3.delete_object(Bucket=BUCKET_NAME, Key=f'pdfs/{filename}')
-
-        # Remove the entry from DynamoDB
-        table = dynamodb.Table(TABLE_NAME)
-        table.delete_item(
-            Key={
-                'filename': filename,
-                'shop_name': file_entry['shop_name']
-            }
-        )
+        # Delete the file from S3 (kept while other entries share its content)
+        delete_pdf_object_if_unshared(file_entry)
 
-        # Remove the file entry from the local pdf_data if applicable
-        pdf_data = [entry for entry in pdf_data if entry['filename'] != filename]
-        save_pdf_data(pdf_data)
+        # Remove the entry and its detected items from DynamoDB (another entry of the flyer takes them over)
+        remaining_entry = find_processed_duplicate(file_entry)
+        delete_pdf_entry(file_entry)
+        if remaining_entry:
+            detected_data.relink_flyer_items(filename, remaining_entry['filename'])
+        else:
+            detected_data.delete_flyer_items(filename, bump_version=False)
+        unregister_shop_if_unused(file_entry['shop_name'], filename)
+        bump_data_version()
 
         return jsonify({"message": f"File {filename} deleted successfully"}), 200
 
     except NoCredentialsError:
         return jsonify({"error": "AWS credentials not available"}), 500
+    except ClientError as e:
+        if is_conditional_check_failure(e):
+            return jsonify({"error": "File not found"}), 404
+        return jsonify({"error": f"Error deleting file: {e}"}), 500
     except Exception as e:
         return jsonify({"error": f"Error deleting file: {e}"}), 500
 
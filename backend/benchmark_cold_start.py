@@ -0,0 +1,184 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Cold-start benchmark of the Telegram Lambda. Every run starts a fresh Python process (like a new
+# Lambda container), imports lambda_function and handles a '/start' update twice. AWS calls go to
+# a local stand-in (DynamoDB Local, LocalStack, ...) given by --endpoint-url / AWS_ENDPOINT_URL;
+# Telegram calls go to a stub HTTP server started by this script.
+#
+# Usage: python benchmark_cold_start.py --endpoint-url http://localhost:8000 --runs 10
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'telegram_lambda_package')
+BENCHMARK_CHAT_ID = 1000001
+
+
+class StubTelegramHandler(BaseHTTPRequestHandler):
+    """
+    Answers every Bot API call with a successful response and records when it arrived.
+    """
+    received_at = []
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        StubTelegramHandler.received_at.append(time.time())
+
+        body = json.dumps({'ok': True, 'result': {'message_id': 1}}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Keep the benchmark output readable
+
+
+def start_stub_telegram():
+    """
+    Starts the stub Bot API server on a free local port.
+
+    :return: The base URL of the server.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubTelegramHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def prepare_stand_in(endpoint_url):
+    """
+    Creates the tables used by the '/start' flow on the local AWS stand-in and resets the
+    benchmark user, so that every run takes the new-user path.
+
+    :param endpoint_url: The endpoint of the local AWS stand-in.
+    """
+    import boto3
+
+    dynamodb = boto3.resource('dynamodb', endpoint_url=endpoint_url)
+    existing_tables = set(dynamodb.meta.client.list_tables()['TableNames'])
+    table_keys = {'user_preferences': ('chat_id', 'S'), 'bot_registry': ('registry_key', 'S'),
+                  'processed_updates': ('update_id', 'N')}
+
+    for table_name, (key, key_type) in table_keys.items():
+        if table_name not in existing_tables:
+            dynamodb.create_table(
+                TableName=table_name,
+                KeySchema=[{'AttributeName': key, 'KeyType': 'HASH'}],
+                AttributeDefinitions=[{'AttributeName': key, 'AttributeType': key_type}],
+                BillingMode='PAY_PER_REQUEST'
+            ).wait_until_exists()
+
+    with open(os.path.join(PACKAGE_DIR, 'static_data.json'), encoding='utf-8') as static_data_file:
+        shops = set(json.load(static_data_file)['shops'])
+    dynamodb.Table('bot_registry').put_item(Item={'registry_key': 'shops', 'shops': shops})
+    dynamodb.Table('user_preferences').delete_item(Key={'chat_id': str(BENCHMARK_CHAT_ID)})
+
+
+def run_child():
+    """
+    Runs inside the fresh process: measures the import of lambda_function and two invocations,
+    and prints the timings as JSON on the last line of stdout.
+    """
+    sys.path.insert(0, PACKAGE_DIR)
+
+    started = time.perf_counter()
+    import lambda_function
+    import_seconds = time.perf_counter() - started
+
+    invocations = []
+    for invocation in range(2):
+        # Unique update ids, as the handler drops updates it has processed before
+        update = {
+            'update_id': int(time.time() * 1000) + invocation,
+            'message': {'message_id': 1, 'chat': {'id': BENCHMARK_CHAT_ID}, 'text': '/start'}
+        }
+        event = {'body': json.dumps(update)}
+
+        handler_started_at = time.time()
+        started = time.perf_counter()
+        response = lambda_function.lambda_handler(event, None)
+        if response['statusCode'] != 200:
+            sys.exit(f"lambda_handler failed: {response}")
+        invocations.append((handler_started_at, time.perf_counter() - started))
+
+    print(json.dumps({
+        'import_seconds': import_seconds,
+        'handler_started_at': invocations[0][0],
+        'first_invocation_seconds': invocations[0][1],
+        'warm_invocation_seconds': invocations[1][1]
+    }))
+
+
+def run_benchmark(endpoint_url, runs, import_profile=None):
+    """
+    Runs the benchmark and prints the median, 90th percentile and maximum of every metric.
+
+    :param endpoint_url: The endpoint of the local AWS stand-in.
+    :param runs: The number of cold starts to measure.
+    :param import_profile: (Optional) File receiving the '-X importtime' output of the first run.
+    """
+    telegram_url = start_stub_telegram()
+    env = {
+        **os.environ,
+        'AWS_ENDPOINT_URL': endpoint_url,
+        'AWS_ACCESS_KEY_ID': os.environ.get('AWS_ACCESS_KEY_ID', 'local'),
+        'AWS_SECRET_ACCESS_KEY': os.environ.get('AWS_SECRET_ACCESS_KEY', 'local'),
+        'AWS_DEFAULT_REGION': os.environ.get('AWS_DEFAULT_REGION', 'eu-west-1'),
+        'TOKEN': 'benchmark',
+        'TELEGRAM_API_URL': telegram_url
+    }
+
+    metrics = {'import': [], 'first response': [], 'first invocation': [], 'warm invocation': []}
+
+    for run in range(runs):
+        prepare_stand_in(endpoint_url)
+        StubTelegramHandler.received_at.clear()
+
+        command = [sys.executable, os.path.abspath(__file__), '--child']
+        profile_file = None
+        if import_profile and run == 0:
+            command[1:1] = ['-X', 'importtime']
+            profile_file = open(import_profile, 'w')
+
+        try:
+            completed = subprocess.run(command, env=env, stdout=subprocess.PIPE,
+                                       stderr=profile_file or subprocess.DEVNULL, text=True, check=True)
+        finally:
+            if profile_file:
+                profile_file.close()
+
+        timings = json.loads(completed.stdout.strip().splitlines()[-1])
+        first_request_at = min(t for t in StubTelegramHandler.received_at if t >= timings['handler_started_at'])
+
+        metrics['import'].append(timings['import_seconds'])
+        metrics['first response'].append(first_request_at - timings['handler_started_at'])
+        metrics['first invocation'].append(timings['first_invocation_seconds'])
+        metrics['warm invocation'].append(timings['warm_invocation_seconds'])
+
+    print(f"{'metric':<18}{'median ms':>12}{'p90 ms':>12}{'max ms':>12}")
+    for name, values in metrics.items():
+        values = sorted(values)
+        p90 = values[min(len(values) - 1, int(round(0.9 * (len(values) - 1))))]
+        print(f"{name:<18}{statistics.median(values) * 1000:>12.1f}{p90 * 1000:>12.1f}{values[-1] * 1000:>12.1f}")
+
+
+# Main function
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the cold start of the Telegram Lambda.")
+    parser.add_argument('--endpoint-url', default=os.environ.get('AWS_ENDPOINT_URL', 'http://localhost:8000'),
+                        help="Endpoint of the local DynamoDB/S3 stand-in")
+    parser.add_argument('--runs', type=int, default=10, help="Number of measured cold starts")
+    parser.add_argument('--import-profile', help="Write the '-X importtime' output of the first run to this file")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child()
+    else:
+        run_benchmark(args.endpoint_url, args.runs, args.import_profile)
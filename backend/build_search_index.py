@@ -0,0 +1,42 @@
+import os
+import sys
+
+# The index helpers are shared with the Telegram Lambda package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'telegram_lambda_package'))
+
+from detected_data import backfill_detected_item, detected_data_table  # noqa: E402
+from dynamodb_utils import parallel_scan  # noqa: E402
+from query_cache import bump_data_version  # noqa: E402
+from search_index import index_detected_item  # noqa: E402
+
+
+# Build the inverted bigram index from the existing detected_data rows
+def build_search_index():
+    """
+    Scans the whole detected_data table, adds the precomputed search attributes to rows
+    ingested before they existed and writes the posting entries of every valid row into the
+    search index table (see prune_search_index.py for the rows that are not valid).
+    Safe to re-run: postings are overwritten by key.
+
+    :return: A tuple (number of indexed rows, number of written postings).
+    """
+    indexed_items = 0
+    written_postings = 0
+
+    for item in parallel_scan(detected_data_table):
+        if 'search_fingerprint' not in item:
+            item = backfill_detected_item(item)
+        postings = index_detected_item(item)
+        if postings:
+            written_postings += postings
+            indexed_items += 1
+
+    # Search results cached before the index was (re)built may be incomplete
+    bump_data_version()
+    return indexed_items, written_postings
+
+
+# Main function
+if __name__ == "__main__":
+    items, postings = build_search_index()
+    print(f"Indexed {items} items with {postings} postings")
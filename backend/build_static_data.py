@@ -0,0 +1,35 @@
+import json
+import os
+import sys
+
+# The registry helpers are shared with the Telegram Lambda package
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'telegram_lambda_package')
+sys.path.insert(0, PACKAGE_DIR)
+
+from lambda_function import STATIC_DATA_PATH, load_shop_registry  # noqa: E402
+
+
+# Refresh the shop list snapshot packaged with the Telegram Lambda
+def build_static_data():
+    """
+    Replaces the shop snapshot in static_data.json with the current shop registry.
+    Languages and keyboards are maintained in the file itself and kept as they are.
+
+    :return: The number of shops written.
+    """
+    with open(STATIC_DATA_PATH, encoding='utf-8') as static_data_file:
+        static_data = json.load(static_data_file)
+
+    static_data['shops'] = load_shop_registry()
+
+    with open(STATIC_DATA_PATH, 'w', encoding='utf-8') as static_data_file:
+        json.dump(static_data, static_data_file, ensure_ascii=False, indent=2)
+        static_data_file.write('\n')
+
+    return len(static_data['shops'])
+
+
+# Main function
+if __name__ == "__main__":
+    shops = build_static_data()
+    print(f"Wrote {shops} shops to {STATIC_DATA_PATH}")
@@ -0,0 +1,124 @@
+import argparse
+import os
+import sys
+
+import boto3
+from botocore.exceptions import ClientError
+
+# The table names are shared with the Telegram Lambda package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'telegram_lambda_package'))
+
+from query_cache import QUERY_CACHE_TABLE, REGISTRY_TABLE  # noqa: E402
+from search_index import SEARCH_INDEX_TABLE  # noqa: E402
+from update_ledger import PROCESSED_UPDATES_TABLE  # noqa: E402
+
+# Name must match lambda_function.py
+TELEGRAM_FILE_CACHE_TABLE = os.environ.get('TELEGRAM_FILE_CACHE_TABLE', 'telegram_file_cache')
+
+# Tables of the Telegram bot besides user_preferences, pdf_metadata and detected_data:
+# table name -> (key schema [(attribute name, attribute type, key type)], TTL attribute or None)
+TABLES = {
+    REGISTRY_TABLE: ([('registry_key', 'S', 'HASH')], None),
+    SEARCH_INDEX_TABLE: ([('bigram', 'S', 'HASH'), ('item_id', 'S', 'RANGE')], None),
+    TELEGRAM_FILE_CACHE_TABLE: ([('image_key', 'S', 'HASH')], None),
+    PROCESSED_UPDATES_TABLE: ([('update_id', 'N', 'HASH')], 'expires_at')
+}
+
+# Schema of the optional shared query cache tier (only created when a name is configured)
+QUERY_CACHE_SCHEMA = ([('cache_key', 'S', 'HASH')], 'expires_at')
+
+# SQS redelivers a message once its visibility timeout expires; AWS recommends six times the function timeout
+VISIBILITY_TIMEOUT_FACTOR = 6
+
+
+# Create the missing tables of the bot
+def create_bot_tables(query_cache_table=QUERY_CACHE_TABLE):
+    """
+    Creates every table of TABLES (and the query cache table if a name is given) that does not
+    exist yet, with on-demand capacity, and enables the TTL expiry of the tables that have one.
+
+    :param query_cache_table: (Optional) The name of the shared query cache table.
+    :return: The list of created table names.
+    """
+    client = boto3.client('dynamodb')
+    tables = dict(TABLES)
+    if query_cache_table:
+        tables[query_cache_table] = QUERY_CACHE_SCHEMA
+
+    created = []
+    for table_name, (key_schema, ttl_attribute) in tables.items():
+        if table_exists(client, table_name):
+            continue
+
+        client.create_table(
+            TableName=table_name,
+            AttributeDefinitions=[{'AttributeName': name, 'AttributeType': attribute_type}
+                                  for name, attribute_type, _ in key_schema],
+            KeySchema=[{'AttributeName': name, 'KeyType': key_type} for name, _, key_type in key_schema],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        client.get_waiter('table_exists').wait(TableName=table_name)
+        if ttl_attribute:
+            client.update_time_to_live(TableName=table_name, TimeToLiveSpecification={
+                'Enabled': True, 'AttributeName': ttl_attribute})
+        created.append(table_name)
+
+    return created
+
+
+def table_exists(client, table_name):
+    """
+    Returns whether a DynamoDB table exists.
+    """
+    try:
+        client.describe_table(TableName=table_name)
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceNotFoundException':
+            raise
+        return False
+
+
+# Create the FIFO update queue and let the function consume it
+def create_update_queue(queue_name, function_name=None):
+    """
+    Creates the SQS FIFO queue of the 'sqs' update queue mode (UPDATE_QUEUE_URL) and, given the bot's
+    function, the event source mapping through which the function consumes it. The mapping reports
+    partial batch failures (ReportBatchItemFailures), so only failed updates are redelivered.
+
+    :param queue_name: The queue name (must end with '.fifo').
+    :param function_name: (Optional) The name of the bot's Lambda function.
+    :return: The queue URL.
+    """
+    attributes = {'FifoQueue': 'true'}  # Deduplicated by update_id, see update_queue.SqsUpdateQueue
+    lambda_client = boto3.client('lambda') if function_name else None
+    if lambda_client:
+        timeout = lambda_client.get_function_configuration(FunctionName=function_name)['Timeout']
+        attributes['VisibilityTimeout'] = str(VISIBILITY_TIMEOUT_FACTOR * timeout)
+
+    sqs = boto3.client('sqs')
+    queue_url = sqs.create_queue(QueueName=queue_name, Attributes=attributes)['QueueUrl']
+    if not lambda_client:
+        return queue_url
+
+    queue_arn = sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['QueueArn'])['Attributes']['QueueArn']
+    mappings = lambda_client.list_event_source_mappings(EventSourceArn=queue_arn, FunctionName=function_name)
+    if not mappings['EventSourceMappings']:
+        lambda_client.create_event_source_mapping(EventSourceArn=queue_arn, FunctionName=function_name,
+                                                  BatchSize=10, FunctionResponseTypes=['ReportBatchItemFailures'])
+    return queue_url
+
+
+# Main function
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create the DynamoDB tables and the update queue of the bot.")
+    parser.add_argument('--query-cache-table', default=QUERY_CACHE_TABLE,
+                        help="Also create the shared query cache table (QUERY_CACHE_TABLE) with this name")
+    parser.add_argument('--update-queue', help="Also create the SQS FIFO update queue with this name (*.fifo)")
+    parser.add_argument('--function-name', help="The bot's Lambda function consuming the update queue")
+    args = parser.parse_args()
+
+    created_tables = create_bot_tables(args.query_cache_table)
+    print(f"Created tables: {', '.join(created_tables) or 'none'}")
+    if args.update_queue:
+        print(f"Update queue: {create_update_queue(args.update_queue, args.function_name)}")
@@ -0,0 +1,21 @@
+import os
+import sys
+
+from create_pdf_metadata_indexes import create_missing_indexes
+
+# The table and index names are shared with the Telegram Lambda package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'telegram_lambda_package'))
+
+from detected_data import DETECTED_DATA_TABLE, PDF_FILENAME_ATTRIBUTE, PDF_FILENAME_INDEX  # noqa: E402
+
+# Global secondary index of the detected_data table linking rows to their flyer. The admin API and
+# ingest_flyer.py read the rows of a flyer through it to expire, move or delete them with the flyer.
+INDEXES = {
+    PDF_FILENAME_INDEX: [(PDF_FILENAME_ATTRIBUTE, 'HASH')]
+}
+
+
+# Main function
+if __name__ == "__main__":
+    created_indexes = create_missing_indexes(DETECTED_DATA_TABLE, INDEXES)
+    print(f"Created indexes: {', '.join(created_indexes) or 'none'}")
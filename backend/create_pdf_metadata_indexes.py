@@ -0,0 +1,113 @@
+import time
+
+import boto3
+
+# Global secondary indexes of the pdf_metadata table used by the admin API (names must match app.py).
+# The table key is (filename, shop_name); the indexes let the API read single entries by filename,
+# the entries of a shop and the entries with identical content by key instead of scanning the whole table.
+TABLE_NAME = 'pdf_metadata'
+INDEXES = {
+    'filename-index': [('filename', 'HASH')],
+    'shop_name-valid_to-index': [('shop_name', 'HASH'), ('valid_to', 'RANGE')],
+    'content_sha256-index': [('content_sha256', 'HASH')]
+}
+# Registry items claiming the filename of each entry (names must match app.py)
+REGISTRY_TABLE_NAME = 'bot_registry'
+FILENAME_REGISTRY_PREFIX = 'filename#'
+
+
+# Create the missing indexes of the pdf_metadata table
+def create_pdf_metadata_indexes():
+    """
+    Adds every index of INDEXES the pdf_metadata table does not have yet.
+
+    :return: The list of created index names.
+    """
+    return create_missing_indexes(TABLE_NAME, INDEXES)
+
+
+def create_missing_indexes(table_name, indexes):
+    """
+    Adds every index the table does not have yet. DynamoDB builds one index at a time,
+    so the function waits for each index to become active before creating the next one.
+
+    :param table_name: The table name.
+    :param indexes: A dict mapping an index name to its key schema [(attribute name, key type)].
+    :return: The list of created index names.
+    """
+    client = boto3.client('dynamodb')
+    created = []
+
+    for index_name, key_schema in indexes.items():
+        table = client.describe_table(TableName=table_name)['Table']
+        if any(index['IndexName'] == index_name for index in table.get('GlobalSecondaryIndexes', [])):
+            continue
+
+        index = {
+            'IndexName': index_name,
+            'KeySchema': [{'AttributeName': name, 'KeyType': key_type} for name, key_type in key_schema],
+            'Projection': {'ProjectionType': 'ALL'}
+        }
+        if table.get('BillingModeSummary', {}).get('BillingMode') != 'PAY_PER_REQUEST':
+            throughput = table['ProvisionedThroughput']
+            index['ProvisionedThroughput'] = {'ReadCapacityUnits': throughput['ReadCapacityUnits'],
+                                              'WriteCapacityUnits': throughput['WriteCapacityUnits']}
+
+        client.update_table(
+            TableName=table_name,
+            AttributeDefinitions=[{'AttributeName': name, 'AttributeType': 'S'} for name, _ in key_schema],
+            GlobalSecondaryIndexUpdates=[{'Create': index}]
+        )
+        wait_until_index_active(client, table_name, index_name)
+        created.append(index_name)
+
+    return created
+
+
+# Claim the filenames of entries written before the API claimed them
+def claim_existing_filenames():
+    """
+    Writes the registry item claiming the filename of every pdf_metadata entry, so new uploads
+    cannot reuse the filename of an older entry under another shop.
+
+    :return: The number of claimed filenames.
+    """
+    dynamodb = boto3.resource('dynamodb')
+    pdf_table = dynamodb.Table(TABLE_NAME)
+    filenames = set()
+    scan_kwargs = {'ProjectionExpression': 'filename'}
+    while True:
+        response = pdf_table.scan(**scan_kwargs)
+        filenames.update(item['filename'] for item in response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    with dynamodb.Table(REGISTRY_TABLE_NAME).batch_writer() as batch:
+        for filename in filenames:
+            batch.put_item(Item={'registry_key': FILENAME_REGISTRY_PREFIX + filename})
+    return len(filenames)
+
+
+def wait_until_index_active(client, table_name, index_name, delay=20):
+    """
+    Polls the table until the index finished backfilling.
+
+    :param client: The DynamoDB client.
+    :param table_name: The table name.
+    :param index_name: The index name.
+    :param delay: Seconds between polls.
+    """
+    while True:
+        table = client.describe_table(TableName=table_name)['Table']
+        statuses = {index['IndexName']: index['IndexStatus'] for index in table.get('GlobalSecondaryIndexes', [])}
+        if statuses.get(index_name) == 'ACTIVE':
+            return
+        time.sleep(delay)
+
+
+# Main function
+if __name__ == "__main__":
+    created_indexes = create_pdf_metadata_indexes()
+    print(f"Created indexes: {', '.join(created_indexes) or 'none'}")
+    print(f"Claimed filenames: {claim_existing_filenames()}")
@@ -0,0 +1,39 @@
+import argparse
+import json
+import os
+import sys
+from decimal import Decimal
+
+# The ingestion helpers are shared with the Telegram Lambda package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'telegram_lambda_package'))
+
+from detected_data import ingest_flyer_items  # noqa: E402
+
+
+# Ingest the detected items of one flyer
+def ingest_flyer(pdf_filename, rows_file, notify=True):
+    """
+    Entry point of the pages_data_pipeline DAG: its last task runs this script once per processed
+    flyer with the detected_data rows it produced. The rows are written with their search and price
+    attributes, linked to the flyer, indexed, and the users tracking any new item are notified.
+
+    :param pdf_filename: The filename of the flyer's pdf_metadata entry.
+    :param rows_file: An open file holding a JSON list of detected_data rows.
+    :param notify: Whether to send the tracked-item notifications.
+    :return: The number of ingested rows.
+    """
+    rows = json.load(rows_file, parse_float=Decimal)  # DynamoDB does not accept floats
+    return len(ingest_flyer_items(rows, pdf_filename=pdf_filename, notify=notify))
+
+
+# Main function
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest the detected_data rows of one flyer.")
+    parser.add_argument('pdf_filename', help="Filename of the flyer's pdf_metadata entry")
+    parser.add_argument('rows', type=argparse.FileType('r', encoding='utf-8'),
+                        help="JSON file with the list of detected_data rows ('-' reads stdin)")
+    parser.add_argument('--no-notify', action='store_true', help="Do not notify users tracking the items")
+    args = parser.parse_args()
+
+    ingested_rows = ingest_flyer(args.pdf_filename, args.rows, notify=not args.no_notify)
+    print(f"Ingested {ingested_rows} rows of {args.pdf_filename}")
@@ -0,0 +1,49 @@
+import os
+import sys
+
+from botocore.exceptions import ClientError
+
+# The price helpers are shared with the Telegram Lambda package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'telegram_lambda_package'))
+
+from detected_data import PRICE_SCHEMA_VERSION, detected_data_table, migrate_detected_item_prices  # noqa: E402
+from dynamodb_utils import parallel_scan  # noqa: E402
+from query_cache import bump_data_version  # noqa: E402
+
+
+# Convert the raw price attributes of existing detected_data rows into structured attributes
+def migrate_detected_prices():
+    """
+    Scans the whole detected_data table and writes the structured price attributes
+    (price, initial_price, member_price, volume, packaging, price_schema_version) to every row
+    written with an older price schema. Safe to re-run: migrated rows are skipped.
+
+    :return: A tuple (number of migrated rows, number of skipped rows).
+    """
+    migrated_items = 0
+    skipped_items = 0
+
+    for item in parallel_scan(detected_data_table):
+        if item.get('price_schema_version', 0) >= PRICE_SCHEMA_VERSION:
+            skipped_items += 1
+            continue
+
+        try:
+            migrate_detected_item_prices(item)
+            migrated_items += 1
+        except ClientError as e:
+            # The row was migrated concurrently (e.g. re-ingested by the pipeline)
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            skipped_items += 1
+
+    # Cached search results carry the prices formatted from the old attributes
+    if migrated_items:
+        bump_data_version()
+    return migrated_items, skipped_items
+
+
+# Main function
+if __name__ == "__main__":
+    migrated, skipped = migrate_detected_prices()
+    print(f"Migrated {migrated} items, skipped {skipped} items")
@@ -0,0 +1,38 @@
+import os
+import sys
+
+# The index helpers are shared with the Telegram Lambda package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'telegram_lambda_package'))
+
+from detected_data import detected_data_table  # noqa: E402
+from dynamodb_utils import parallel_scan  # noqa: E402
+from query_cache import bump_data_version  # noqa: E402
+from search_index import unindex_detected_item  # noqa: E402
+
+
+# Remove the postings of detected_data rows that are no longer valid
+def prune_search_index():
+    """
+    Scans detected_data for rows that are not valid and deletes their posting entries, so that
+    searches only read postings of current flyers. Rows expired through detected_data.expire_detected_item
+    are unindexed right away; this script cleans up postings written before only valid rows were
+    indexed, or by rows whose validity was changed by other tools. Safe to re-run.
+
+    :return: The number of unindexed rows.
+    """
+    pruned_items = 0
+
+    rows = parallel_scan(detected_data_table, FilterExpression='attribute_not_exists(#valid) OR #valid <> :valid',
+                         ExpressionAttributeNames={'#valid': 'valid'}, ExpressionAttributeValues={':valid': True})
+    for item in rows:
+        unindex_detected_item(item)
+        pruned_items += 1
+
+    if pruned_items:
+        bump_data_version()
+    return pruned_items
+
+
+# Main function
+if __name__ == "__main__":
+    print(f"Removed the postings of {prune_search_index()} rows that are not valid")
@@ -0,0 +1,63 @@
+import threading
+
+
+class LazyResource:
+    """
+    Proxy for an AWS resource, table or client that is constructed on first attribute access.
+    Importing boto3 and loading the service models dominate the Lambda cold start, so nothing
+    is constructed before an invocation actually talks to the service.
+    """
+
+    def __init__(self, factory):
+        """
+        :param factory: Zero-argument callable constructing the wrapped object.
+        """
+        self._factory = factory
+        self._instance = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Returns the wrapped object, constructing it once (also when first used from several threads).
+        """
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = self._factory()
+        return self._instance
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+def create_dynamodb_resource():
+    import boto3  # Deferred import, see LazyResource
+    return boto3.resource('dynamodb')
+
+
+# DynamoDB service resource shared by all modules of the package
+dynamodb = LazyResource(create_dynamodb_resource)
+
+
+def lazy_table(table_name):
+    """
+    Returns a lazily constructed DynamoDB Table of the shared service resource.
+
+    :param table_name: The name of the table.
+    """
+    return LazyResource(lambda: dynamodb.Table(table_name))
+
+
+def lazy_client(service_name, **config_kwargs):
+    """
+    Returns a lazily constructed boto3 client.
+
+    :param service_name: The AWS service, e.g. 's3'.
+    :param config_kwargs: Keyword arguments of the botocore Config (e.g. max_pool_connections).
+    """
+    def create_client():
+        import boto3
+        from botocore.config import Config
+        return boto3.client(service_name, config=Config(**config_kwargs))
+
+    return LazyResource(create_client)
@@ -0,0 +1,411 @@
+import ast
+import json
+import os
+from decimal import Decimal, InvalidOperation
+
+from aws_resources import lazy_table
+from dynamodb_utils import iter_items
+from query_cache import bump_data_version
+from search_index import DETECTED_DATA_KEY, index_detected_item, search_fields, unindex_detected_item
+
+# Name of the DynamoDB table holding the detected flyer items
+DETECTED_DATA_TABLE = os.environ.get('DETECTED_DATA_TABLE', 'detected_data')
+
+detected_data_table = lazy_table(DETECTED_DATA_TABLE)
+
+# Attribute linking a row to the pdf_metadata entry (flyer) it was detected in, and the global
+# secondary index over it (created by backend/create_detected_data_indexes.py)
+PDF_FILENAME_ATTRIBUTE = 'pdf_filename'
+PDF_FILENAME_INDEX = os.environ.get('PDF_FILENAME_INDEX', 'pdf_filename-index')
+
+# Version of the structured price attributes written by structured_price_fields
+# (2: unknown price labels are ignored and the dedicated raw attributes take precedence)
+PRICE_SCHEMA_VERSION = 2
+
+# Raw price attributes written by the pipeline (dict reprs produced by price_processing.process_price_by_class_id)
+RAW_PRICE_ATTRIBUTES = {
+    'processed_item_price': 'price',
+    'processed_item_initial_price': 'initial_price',
+    'processed_item_member_price': 'member_price'
+}
+
+# Keys of the processed price dicts and the structured attribute they map to
+PRICE_KEYS = {
+    'item_price': 'price',
+    'initial_price': 'initial_price',
+    'item_initial_price': 'initial_price',
+    'item_member_price': 'member_price',
+    'volume': 'volume',
+    'packaging': 'packaging'
+}
+
+# Structured attributes holding numbers; the others hold strings
+NUMERIC_PRICE_FIELDS = ('price', 'initial_price', 'member_price')
+
+# Every attribute structured_price_fields may write (removed by the migration when no longer derived)
+STRUCTURED_PRICE_ATTRIBUTES = (NUMERIC_PRICE_FIELDS + tuple(f"{field}_text" for field in NUMERIC_PRICE_FIELDS)
+                               + ('volume', 'packaging'))
+
+
+# --------------- Ingestion ---------------
+
+def prepare_detected_item(item):
+    """
+    Returns a copy of a detected_data row extended with the attributes the bot needs at query
+    time, so that searches do not have to recompute them for every scanned row.
+
+    :param item: The detected_data row produced by the data pipeline.
+    :return: The row including the search attributes ('search_name', 'search_bigrams',
+             'search_fingerprint') and the structured price attributes.
+    """
+    return {**item, **search_fields(item.get('item_name', '')), **structured_price_fields(item)}
+
+
+def ingest_detected_item(item, bump_version=True):
+    """
+    Writes a detected_data row together with its precomputed attributes and adds it to the
+    inverted search index. This is the entry point the data pipeline uses for every detection.
+
+    :param item: The detected_data row produced by the data pipeline.
+    :param bump_version: Whether to bump the data version so that cached search results are dropped.
+                         Batch ingestion should pass False and call bump_data_version once per batch.
+    :return: The row as stored in DynamoDB.
+    """
+    item = prepare_detected_item(item)
+    detected_data_table.put_item(Item=item)
+    index_detected_item(item)
+    if bump_version:
+        bump_data_version()
+    return item
+
+
+def ingest_flyer_items(items, pdf_filename=None, notify=True):
+    """
+    Ingests all detected_data rows of one flyer, bumps the data version once and notifies the
+    users tracking any of the new items. This is the entry point the data pipeline uses per flyer
+    (the pipeline DAG runs it through backend/ingest_flyer.py).
+
+    When the flyer's filename is given, the rows are linked to it, so that the admin API can
+    expire or delete them together with the flyer, and rows of an earlier run over the same flyer
+    that are not part of this run are deleted. Rows already stored are not notified again.
+
+    :param items: An iterable of detected_data rows produced by the data pipeline.
+    :param pdf_filename: (Optional) The filename of the flyer's pdf_metadata entry.
+    :param notify: Whether to send the tracked-item notifications.
+    :return: The list of rows as stored in DynamoDB.
+    """
+    previous_items = {}
+    if pdf_filename is not None:
+        items = [{**item, PDF_FILENAME_ATTRIBUTE: pdf_filename} for item in items]
+        previous_items = {item[DETECTED_DATA_KEY]: item for item in find_flyer_items(pdf_filename)}
+    stored_ids = set(previous_items)
+
+    stored_items = []
+    for item in items:
+        previous_item = previous_items.pop(item[DETECTED_DATA_KEY], None)
+        if previous_item is not None:
+            unindex_detected_item(previous_item)  # The item name may have changed
+        stored_items.append(ingest_detected_item(item, bump_version=False))
+
+    for previous_item in previous_items.values():
+        delete_detected_item(previous_item)
+
+    if stored_items or previous_items:
+        bump_data_version()
+
+    new_items = [item for item in stored_items if item[DETECTED_DATA_KEY] not in stored_ids]
+    if notify and new_items:
+        from notifications import notify_tracked_items  # Deferred, notifications imports this module
+        notify_tracked_items(new_items)
+
+    return stored_items
+
+
+def expire_detected_item(item):
+    """
+    Marks a detected_data row as no longer valid and removes its postings from the search index.
+    Callers changing many rows should bump the data version once afterwards.
+
+    :param item: The stored detected_data row.
+    """
+    detected_data_table.update_item(
+        Key={DETECTED_DATA_KEY: item[DETECTED_DATA_KEY]},
+        UpdateExpression='SET #valid = :valid',
+        ExpressionAttributeNames={'#valid': 'valid'},
+        ExpressionAttributeValues={':valid': False}
+    )
+    unindex_detected_item(item)
+
+
+def delete_detected_item(item):
+    """
+    Deletes a detected_data row together with its postings in the search index.
+    Callers deleting many rows should bump the data version once afterwards.
+
+    :param item: The stored detected_data row.
+    """
+    detected_data_table.delete_item(Key={DETECTED_DATA_KEY: item[DETECTED_DATA_KEY]})
+    unindex_detected_item(item)
+
+
+def backfill_detected_item(item):
+    """
+    Adds the precomputed attributes to a row written before they existed.
+
+    :param item: The stored detected_data row.
+    :return: The row including the precomputed attributes.
+    """
+    fields = search_fields(item.get('item_name', ''))
+    detected_data_table.update_item(
+        Key={DETECTED_DATA_KEY: item[DETECTED_DATA_KEY]},
+        UpdateExpression='SET search_name = :name, search_bigrams = :bigrams, search_fingerprint = :fingerprint',
+        ExpressionAttributeValues={
+            ':name': fields['search_name'],
+            ':bigrams': fields['search_bigrams'],
+            ':fingerprint': fields['search_fingerprint']
+        }
+    )
+    return {**item, **fields}
+
+
+# --------------- Flyers ---------------
+
+def find_flyer_items(pdf_filename):
+    """
+    Reads the detected_data rows of a flyer through the pdf_filename index. Rows ingested
+    before they were linked to their flyer are not found.
+
+    :param pdf_filename: The filename of the flyer's pdf_metadata entry.
+    :return: The list of rows.
+    """
+    from boto3.dynamodb.conditions import Key  # Deferred import, see aws_resources.LazyResource
+
+    return list(iter_items(detected_data_table.query, IndexName=PDF_FILENAME_INDEX,
+                           KeyConditionExpression=Key(PDF_FILENAME_ATTRIBUTE).eq(pdf_filename)))
+
+
+def update_flyer_items(pdf_filename, shop_name, valid, bump_version=True):
+    """
+    Applies the shop name and validity of a flyer to its detected_data rows and keeps their
+    postings in the search index in sync: rows of a valid flyer are (re)indexed under the shop,
+    rows of an expired flyer are removed from the index.
+
+    :param pdf_filename: The filename of the flyer's pdf_metadata entry.
+    :param shop_name: The flyer's shop name.
+    :param valid: Whether the flyer is valid.
+    :param bump_version: Whether to bump the data version if any row changed.
+    :return: The number of changed rows.
+    """
+    changed_items = 0
+
+    for item in find_flyer_items(pdf_filename):
+        was_valid = item.get('valid') is True
+        if item.get('shop_name') == shop_name and was_valid == valid:
+            continue
+
+        detected_data_table.update_item(
+            Key={DETECTED_DATA_KEY: item[DETECTED_DATA_KEY]},
+            UpdateExpression='SET shop_name = :shop_name, #valid = :valid',
+            ExpressionAttributeNames={'#valid': 'valid'},
+            ExpressionAttributeValues={':shop_name': shop_name, ':valid': valid}
+        )
+        if valid:
+            index_detected_item({**item, 'shop_name': shop_name, 'valid': True})  # Overwrites the postings' shop
+        elif was_valid:
+            unindex_detected_item(item)
+        changed_items += 1
+
+    if changed_items and bump_version:
+        bump_data_version()
+    return changed_items
+
+
+def relink_flyer_items(pdf_filename, new_pdf_filename):
+    """
+    Links the detected_data rows of a flyer to another pdf_metadata entry, e.g. one with the same
+    content, shop and validity window when the entry they were detected for is deleted. The rows
+    and their postings are unchanged, so the data version is not bumped.
+
+    :param pdf_filename: The filename of the pdf_metadata entry the rows are linked to.
+    :param new_pdf_filename: The filename of the pdf_metadata entry taking the rows over.
+    :return: The number of relinked rows.
+    """
+    items = find_flyer_items(pdf_filename)
+    for item in items:
+        detected_data_table.update_item(
+            Key={DETECTED_DATA_KEY: item[DETECTED_DATA_KEY]},
+            UpdateExpression='SET #pdf_filename = :pdf_filename',
+            ExpressionAttributeNames={'#pdf_filename': PDF_FILENAME_ATTRIBUTE},
+            ExpressionAttributeValues={':pdf_filename': new_pdf_filename}
+        )
+    return len(items)
+
+
+def delete_flyer_items(pdf_filename, bump_version=True):
+    """
+    Deletes the detected_data rows of a flyer together with their postings in the search index.
+
+    :param pdf_filename: The filename of the flyer's pdf_metadata entry.
+    :param bump_version: Whether to bump the data version if any row was deleted.
+    :return: The number of deleted rows.
+    """
+    items = find_flyer_items(pdf_filename)
+    for item in items:
+        delete_detected_item(item)
+
+    if items and bump_version:
+        bump_data_version()
+    return len(items)
+
+
+# --------------- Structured Prices ---------------
+
+def parse_raw_price(value):
+    """
+    Converts a raw price attribute into a Python value. The pipeline stores the processed prices
+    as dict reprs, so the value is evaluated as a Python literal first and parsed as JSON second.
+
+    :param value: The raw attribute value.
+    :return: A dict if the value holds one, otherwise the original value.
+    """
+    if isinstance(value, str):
+        try:
+            parsed = ast.literal_eval(value)  # Attempt to evaluate as a Python literal
+        except (ValueError, SyntaxError):
+            try:
+                parsed = json.loads(value)  # Attempt to parse as JSON
+            except (ValueError, TypeError):
+                return value  # Return original value if conversion fails
+        # Anything but a dict stays a string ('29,90' would otherwise evaluate to a tuple)
+        return parsed if isinstance(parsed, dict) else value
+    return value
+
+
+def to_decimal(value):
+    """
+    Converts a price to a Decimal as required by DynamoDB ('59,90' and '59.90' are both accepted).
+
+    :param value: The price as a number or string.
+    :return: The Decimal, or None if the value is not a number.
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        return Decimal(str(value).strip().replace(',', '.'))
+    except InvalidOperation:
+        return None
+
+
+def structured_price_fields(item):
+    """
+    Derives the typed price attributes of a detected_data row from its raw price attributes:
+    'price', 'initial_price', 'member_price' (numbers), 'volume', 'packaging' (strings) and
+    'price_schema_version'. Values that are not numbers are kept as '<field>_text' so that
+    nothing shown to users today gets lost. Only the keys of PRICE_KEYS are mapped (unknown
+    labels such as a price without VAT are ignored), and a field's dedicated raw attribute
+    wins over the same key found in another attribute's dict.
+
+    :param item: The detected_data row.
+    :return: A dict with the structured attributes present for the row.
+    """
+    # (field, value) pairs in order, those of the field's dedicated attribute first
+    dedicated_values, other_values = [], []
+
+    for raw_attribute, default_field in RAW_PRICE_ATTRIBUTES.items():
+        raw_value = parse_raw_price(item.get(raw_attribute))
+        if raw_value is None or raw_value == '':
+            continue
+
+        if not isinstance(raw_value, dict):
+            dedicated_values.append((default_field, raw_value))
+            continue
+
+        for key, value in raw_value.items():
+            field = PRICE_KEYS.get(key)
+            if field is None or value is None:
+                continue
+            (dedicated_values if field == default_field else other_values).append((field, value))
+
+    fields = {}
+    for field, value in dedicated_values + other_values:
+        if field in fields or f"{field}_text" in fields:
+            continue
+
+        if field in NUMERIC_PRICE_FIELDS:
+            number = to_decimal(value)
+            if number is not None:
+                fields[field] = number
+            else:
+                fields[f"{field}_text"] = str(value)
+        else:
+            fields[field] = str(value)
+
+    fields['price_schema_version'] = PRICE_SCHEMA_VERSION
+    return fields
+
+
+def migrate_detected_item_prices(item):
+    """
+    Adds the structured price attributes to a row written before they existed (or by an older
+    schema version) and removes the ones the current version no longer derives.
+    Rows already carrying the current schema version are skipped by the condition.
+
+    :param item: The stored detected_data row.
+    :return: The structured price attributes written.
+    """
+    fields = structured_price_fields(item)
+    names = {f"#f{i}": field for i, field in enumerate(fields)}
+    values = {f":v{i}": value for i, value in enumerate(fields.values())}
+    stale_names = {f"#r{i}": attribute for i, attribute in
+                   enumerate(a for a in STRUCTURED_PRICE_ATTRIBUTES if a in item and a not in fields)}
+
+    update_expression = 'SET ' + ', '.join(f"{name} = :v{i}" for i, name in enumerate(names))
+    if stale_names:
+        update_expression += ' REMOVE ' + ', '.join(stale_names)
+        names.update(stale_names)
+
+    detected_data_table.update_item(
+        Key={DETECTED_DATA_KEY: item[DETECTED_DATA_KEY]},
+        UpdateExpression=update_expression,
+        ConditionExpression='attribute_not_exists(price_schema_version) OR price_schema_version < :version',
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues={**values, ':version': PRICE_SCHEMA_VERSION}
+    )
+    return fields
+
+
+def format_price(value):
+    """
+    Formats a price for users the way flyers print it, with the Czech decimal comma
+    (Decimal('29.90') -> '29,90', Decimal('10.9') -> '10,90'). Text prices are kept as detected.
+
+    :param value: The structured price (a Decimal) or its text.
+    :return: The formatted price.
+    """
+    if not isinstance(value, Decimal):
+        return str(value)
+    if value.as_tuple().exponent < 0:
+        return f"{value:.2f}".replace('.', ',')
+    return f"{value:f}"
+
+
+def find_price_for_item(obj):
+    """
+    Formats the structured price attributes (price, initial_price, member_price) of a
+    DynamoDB item. Rows not migrated to the current price schema yet are converted on the fly.
+
+    :param obj: The DynamoDB item containing price information.
+    :return: A formatted string containing price information or "Price not found" if no prices exist.
+    """
+    if obj.get('price_schema_version', 0) < PRICE_SCHEMA_VERSION:
+        obj = {**{k: v for k, v in obj.items() if k not in STRUCTURED_PRICE_ATTRIBUTES},
+               **structured_price_fields(obj)}
+
+    prices = []
+    for field, label in (('price', 'Price'), ('initial_price', 'Initial price'), ('member_price', 'Member price')):
+        value = obj.get(field, obj.get(f"{field}_text"))
+        if value is not None:
+            prices.append(f"{label}: {format_price(value)}\n")
+
+    # Return the price strings or "Price not found" if no prices are available
+    return "".join(prices) if prices else "Price not found"
@@ -0,0 +1,152 @@
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+logger = logging.getLogger()
+
+# Number of segments used by parallel scans of large tables
+SCAN_SEGMENTS = int(os.environ.get('SCAN_SEGMENTS', '4'))
+
+# Maximal number of fetched pages buffered between scan workers and the consumer
+MAX_BUFFERED_PAGES = 8
+
+# BatchGetItem accepts at most 100 keys per request
+BATCH_GET_LIMIT = 100
+
+# Retries of unprocessed BatchGetItem keys (throttling), with exponential backoff and full jitter
+BATCH_GET_MAX_RETRIES = int(os.environ.get('BATCH_GET_MAX_RETRIES', '6'))
+BATCH_GET_BASE_DELAY = 0.05
+BATCH_GET_MAX_DELAY = 2.0
+
+
+def iter_pages(operation, stop_when=None, **kwargs):
+    """
+    Yields the pages of a DynamoDB scan or query, following LastEvaluatedKey until the
+    result set is exhausted. Only one page is held in memory at a time.
+
+    :param operation: The bound operation to call, e.g. table.scan or table.query.
+    :param stop_when: (Optional) Callable checked after every page; returning True stops the pagination early.
+    :param kwargs: Keyword arguments passed to every call of the operation.
+    """
+    kwargs = dict(kwargs)
+
+    while True:
+        response = operation(**kwargs)
+        yield response.get('Items', [])
+
+        exclusive_start_key = response.get('LastEvaluatedKey')
+        if not exclusive_start_key or (stop_when and stop_when()):
+            break
+        kwargs['ExclusiveStartKey'] = exclusive_start_key
+
+
+def iter_items(operation, stop_when=None, **kwargs):
+    """
+    Yields every item of a paginated DynamoDB scan or query.
+
+    :param operation: The bound operation to call, e.g. table.scan or table.query.
+    :param stop_when: (Optional) Callable checked after every page; returning True stops the pagination early.
+    :param kwargs: Keyword arguments passed to every call of the operation.
+    """
+    for page in iter_pages(operation, stop_when=stop_when, **kwargs):
+        yield from page
+
+
+def parallel_scan(table, total_segments=SCAN_SEGMENTS, stop_when=None, **scan_kwargs):
+    """
+    Yields every item of a table using a segmented scan (Segment/TotalSegments) executed by
+    one worker thread per segment. Workers hand pages over through a bounded queue, so memory
+    stays bounded by MAX_BUFFERED_PAGES pages regardless of the table size.
+
+    :param table: The DynamoDB Table resource to scan.
+    :param total_segments: The number of parallel segments; 1 falls back to a sequential scan.
+    :param stop_when: (Optional) Callable checked after every page; returning True stops all workers early.
+    :param scan_kwargs: Keyword arguments passed to every scan call (FilterExpression, ProjectionExpression...).
+    """
+    if total_segments <= 1:
+        yield from iter_items(table.scan, stop_when=stop_when, **scan_kwargs)
+        return
+
+    pages = queue.Queue(maxsize=MAX_BUFFERED_PAGES)
+    stopped = threading.Event()
+    finished = object()  # Sentinel put by every worker once its segment is done
+
+    def put(value):
+        # Do not block forever on a full queue once the consumer went away
+        while not stopped.is_set():
+            try:
+                pages.put(value, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def scan_segment(segment):
+        try:
+            segment_pages = iter_pages(table.scan, stop_when=stopped.is_set, Segment=segment,
+                                       TotalSegments=total_segments, **scan_kwargs)
+            for page in segment_pages:
+                put(page)
+        except Exception as e:
+            put(e)
+        finally:
+            put(finished)
+
+    workers = [threading.Thread(target=scan_segment, args=(segment,), daemon=True)
+               for segment in range(total_segments)]
+    for worker in workers:
+        worker.start()
+
+    try:
+        running = total_segments
+        while running:
+            page = pages.get()
+            if page is finished:
+                running -= 1
+                continue
+            if isinstance(page, Exception):
+                raise page
+
+            yield from page
+
+            if stop_when and stop_when():
+                break
+    finally:
+        stopped.set()
+
+
+def batch_get_items(dynamodb, table_name, keys, **request_kwargs):
+    """
+    Fetches items by their primary keys using BatchGetItem, 100 keys per request, and retries
+    the keys DynamoDB could not process (throttling) with exponential backoff and jitter.
+    Keys still unprocessed after BATCH_GET_MAX_RETRIES retries are logged and skipped.
+
+    :param dynamodb: The DynamoDB service resource.
+    :param table_name: The name of the table to read from.
+    :param keys: An iterable of primary key dicts.
+    :param request_kwargs: Extra per-table request parameters (e.g. ProjectionExpression).
+    :return: A list of the found items (missing keys are skipped).
+    """
+    keys = list(keys)
+    items = []
+
+    for start in range(0, len(keys), BATCH_GET_LIMIT):
+        request_items = {table_name: {'Keys': keys[start:start + BATCH_GET_LIMIT], **request_kwargs}}
+
+        for attempt in range(BATCH_GET_MAX_RETRIES + 1):
+            if attempt:
+                time.sleep(random.uniform(0, min(BATCH_GET_MAX_DELAY, BATCH_GET_BASE_DELAY * 2 ** attempt)))
+
+            response = dynamodb.batch_get_item(RequestItems=request_items)
+            items.extend(response.get('Responses', {}).get(table_name, []))
+            request_items = response.get('UnprocessedKeys')
+            if not request_items:
+                break
+        else:
+            unprocessed = len(request_items.get(table_name, {}).get('Keys', []))
+            logger.warning(f"Skipped {unprocessed} keys of {table_name} still unprocessed after "
+                           f"{BATCH_GET_MAX_RETRIES} retries")
+
+    return items
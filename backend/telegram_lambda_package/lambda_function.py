@@ -1,13 +1,22 @@
-import ast
 import copy
-import tempfile
-import requests
+import heapq
 import json
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import os
-import re
-import boto3
-from boto3.dynamodb.conditions import Attr
+import time
+from botocore.exceptions import ClientError
 import logging
+from aws_resources import dynamodb, lazy_client, lazy_table
+from detected_data import find_price_for_item
+from dynamodb_utils import batch_get_items, iter_items, parallel_scan
+from query_cache import QueryResultCache, get_data_version
+from search_index import DETECTED_DATA_KEY, QueryMatcher, find_candidate_ids, find_candidate_ids_batch, normalize_name
+from send_scheduler import RateLimiter, split_message
+from telegram_client import TelegramClient
+from update_ledger import UpdateLedger
+from update_queue import create_update_queue
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -16,58 +25,316 @@ logger = logging.getLogger()
 # Constants for the S3 bucket and Telegram API
 BUCKET_NAME = os.environ.get('BUCKET_NAME')
 TOKEN = os.environ.get('TOKEN')
-API_URL = f"https://api.telegram.org/bot{TOKEN}"
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
 
-# Initialize DynamoDB resources
-dynamodb = boto3.resource('dynamodb')
-s3 = boto3.client('s3')
+# How updates are processed: 'sync' (by the webhook), 'sqs' (FIFO queue consumed by the same function
+# through an SQS event source mapping) or 'local' (in-process queue for local development and tests)
+UPDATE_QUEUE_MODE = os.environ.get('UPDATE_QUEUE_MODE', 'sync')
+UPDATE_QUEUE_URL = os.environ.get('UPDATE_QUEUE_URL')
+
+# Snapshot of static bot data, refreshed by backend/build_static_data.py
+STATIC_DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static_data.json')
+
+# Resolve searches through the inverted bigram index instead of scanning detected_data. Enable it once
+# the search_index table exists and was backfilled (see backend/create_bot_tables.py and build_search_index.py)
+USE_SEARCH_INDEX = os.environ.get('USE_SEARCH_INDEX', 'false').lower() == 'true'
+
+# Registry table holding small shared items (e.g. the set of shop names) maintained by the admin API
+REGISTRY_TABLE = os.environ.get('REGISTRY_TABLE', 'bot_registry')
+SHOP_REGISTRY_KEY = 'shops'
+
+# Cache of Telegram file ids of already uploaded product images, keyed by 'image_key' (the S3 path)
+TELEGRAM_FILE_CACHE_TABLE = os.environ.get('TELEGRAM_FILE_CACHE_TABLE', 'telegram_file_cache')
+
+# Parts of the error descriptions Telegram returns for file ids it no longer accepts
+# (e.g. "wrong file identifier/HTTP URL specified", "FILE_REFERENCE_EXPIRED")
+FILE_ID_ERROR_MARKERS = ('file identifier', 'file reference', 'file_reference')
+
+# Concurrent S3 reads when building albums, and the size limit of a single image (Telegram's photo limit)
+S3_FETCH_WORKERS = int(os.environ.get('S3_FETCH_WORKERS', '8'))
+MAX_IMAGE_BYTES = int(os.environ.get('MAX_IMAGE_BYTES', str(10 * 1024 * 1024)))
+
+# Telegram accepts at most 10 items per album; the next albums' images are prefetched while one is sent
+MEDIA_GROUP_LIMIT = 10
+ALBUM_PIPELINE_DEPTH = int(os.environ.get('ALBUM_PIPELINE_DEPTH', '2'))
+
+# Number of ranked search results sent per page ("More results" requests the next page)
+SEARCH_PAGE_SIZE = int(os.environ.get('SEARCH_PAGE_SIZE', '10'))
+
+# Maximal number of product images sent for a single item of a compared shopping list (over all shops)
+ALBUM_IMAGE_BUDGET = int(os.environ.get('ALBUM_IMAGE_BUDGET', '20'))
+
+# Maximal number of product images sent with one page of search results (over all shops). Defaults to
+# the page size; a smaller budget shortens the pages of users who get results as photos only
+SEARCH_PAGE_IMAGE_BUDGET = int(os.environ.get('SEARCH_PAGE_IMAGE_BUDGET', str(SEARCH_PAGE_SIZE)))
+
+# Seconds the shop list is served from memory before the registry is read again
+SHOP_CACHE_TTL = int(os.environ.get('SHOP_CACHE_TTL', '300'))
+
+# AWS clients are constructed on first use (see aws_resources), keeping the cold start short
+s3 = lazy_client('s3', max_pool_connections=S3_FETCH_WORKERS)
+
+# Thread pool for concurrent S3 reads, shared across warm Lambda invocations
+s3_executor = ThreadPoolExecutor(max_workers=S3_FETCH_WORKERS, thread_name_prefix='s3')
 
 # DynamoDB table references
-user_preferences_table = dynamodb.Table('user_preferences')
-pdf_metadata_table = dynamodb.Table('pdf_metadata')
-detected_data_table = dynamodb.Table("detected_data")
+user_preferences_table = lazy_table('user_preferences')
+pdf_metadata_table = lazy_table('pdf_metadata')
+detected_data_table = lazy_table("detected_data")
+registry_table = lazy_table(REGISTRY_TABLE)
+telegram_file_cache_table = lazy_table(TELEGRAM_FILE_CACHE_TABLE)
+
+# Telegram Bot API client with a pooled session, reused across warm Lambda invocations
+telegram = TelegramClient(TOKEN, api_url=TELEGRAM_API_URL, rate_limiter=RateLimiter())
+
+# Read-only data packaged with the function (languages, keyboards and a snapshot of the shop list)
+with open(STATIC_DATA_PATH, encoding='utf-8') as static_data_file:
+    static_data = json.load(static_data_file)
+
+# In-process shop list cache, kept across warm Lambda invocations
+shop_cache = {'shops': None, 'expires_at': 0.0}
+
+# Claimed update ids, so that updates redelivered by Telegram or SQS are processed once
+update_ledger = UpdateLedger()
+
+# Search results of popular queries, kept across warm Lambda invocations (optionally shared via DynamoDB)
+query_cache = QueryResultCache()
 
 
 # --------------- AWS Handling ---------------
-def download_file_from_s3(filename_path, local_path):
+def read_file_from_s3(filename_path, max_bytes=MAX_IMAGE_BYTES):
     """
-    Downloads a file from the specified S3 bucket to a local file path.
+    Reads a file from the specified S3 bucket into memory.
 
     :param filename_path: The path of the file in the S3 bucket.
-    :param local_path: The local path where the file should be saved.
+    :param max_bytes: Files larger than this many bytes are rejected before being read.
 
-    :raises ValueError: If the provided filename_path is not a valid string.
+    :raises ValueError: If the provided filename_path is not a valid string or the file is too large.
+    :return: The file content as bytes.
     """
     # Ensure the S3 file path is a valid string before proceeding with the download
     if not isinstance(filename_path, str) or not filename_path:
         raise ValueError(f"Invalid S3 filename path: {filename_path}")
 
     # Log the download operation for debugging purposes
-    logger.debug(f"Downloading file from S3 bucket: {filename_path} to local path: {local_path}")
+    logger.debug(f"Reading file from S3 bucket: {filename_path}")
+
+    response = s3.get_object(Bucket=BUCKET_NAME, Key=filename_path)
+    if response['ContentLength'] > max_bytes:
+        response['Body'].close()
+        raise ValueError(f"S3 file {filename_path} exceeds {max_bytes} bytes")
+
+    return response['Body'].read()
 
-    # Perform the file download from the specified S3 bucket to the local path
-    s3.download_file(BUCKET_NAME, filename_path, local_path)
+
+def fetch_files_from_s3(filename_paths):
+    """
+    Reads several files from S3 into memory concurrently on a bounded thread pool,
+    so the total time is roughly that of the slowest file.
+
+    :param filename_paths: The paths of the files in the S3 bucket.
+    :return: A dict mapping each successfully read path to its content; failures are logged and skipped.
+    """
+    return collect_s3_reads(submit_s3_reads(filename_paths))
+
+
+def submit_s3_reads(filename_paths):
+    """
+    Starts reading files from S3 on the shared thread pool without waiting for them.
+
+    :param filename_paths: The paths of the files in the S3 bucket.
+    :return: A dict mapping each path to the Future of its content.
+    """
+    return {path: s3_executor.submit(read_file_from_s3, path) for path in dict.fromkeys(filename_paths)}
+
+
+def collect_s3_reads(futures):
+    """
+    Waits for S3 reads started with submit_s3_reads.
+
+    :param futures: A dict mapping paths to the Futures of their content.
+    :return: A dict mapping each successfully read path to its content; failures are logged and skipped.
+    """
+    contents = {}
+
+    for path, future in futures.items():
+        try:
+            contents[path] = future.result()
+        except Exception as e:
+            logger.error(f"Error reading {path} from S3: {str(e)}")
+
+    return contents
+
+
+def batch_get_detected_items(item_ids):
+    """
+    Fetches detected_data rows by their primary key.
+
+    :param item_ids: An iterable of detected_data item ids.
+    :return: A list of the found rows (missing ids are skipped).
+    """
+    return batch_get_items(dynamodb, detected_data_table.name, [{DETECTED_DATA_KEY: item_id} for item_id in item_ids])
 
 
 # --------------- User Preferences Handling ---------------
 
+class UserPreferencesSession:
+    """
+    Holds the preferences of one user for the duration of a single Telegram update.
+    The item is read from DynamoDB at most once; changes are kept in memory and written
+    with a single UpdateItem request that touches only the changed attributes.
+    """
+
+    def __init__(self, chat_id):
+        self.chat_id = str(chat_id)
+        self._preferences = None
+        self._stored = None
+        self._save_requested = False
+
+    @property
+    def preferences(self):
+        """
+        The mutable preferences document, loaded from DynamoDB on first access.
+        If no preferences are found, it holds a default preference with 'new_user' state.
+        """
+        if self._preferences is None:
+            response = user_preferences_table.get_item(Key={'chat_id': self.chat_id})
+            item = response.get('Item')
+            self._stored = copy.deepcopy(item) if item else {}
+            self._preferences = item if item else {"state": "new_user"}
+            self._preferences.pop('chat_id', None)
+            self._stored.pop('chat_id', None)
+        return self._preferences
+
+    def save(self, preferences):
+        """
+        Merges the given preferences into the session and marks the session for writing.
+
+        :param preferences: The preferences document (usually the session's own dict).
+        """
+        if preferences is not self.preferences:
+            self.preferences.update(preferences)
+        self._save_requested = True
+
+    def dirty_fields(self):
+        """
+        Returns the names of the fields that differ from the stored item.
+        """
+        if self._preferences is None:
+            return set()
+        fields = set(self._preferences) | set(self._stored)
+        return {field for field in fields if self._preferences.get(field) != self._stored.get(field)}
+
+    def flush(self):
+        """
+        Writes the preferences to DynamoDB if a save was requested and any field changed.
+
+        :return: True if a write was issued.
+        """
+        dirty_fields = self.dirty_fields()
+        if not self._save_requested or not dirty_fields:
+            return False
+
+        user_preferences_table.update_item(Key={'chat_id': self.chat_id},
+                                           **self._build_update(dirty_fields))
+        self._stored = copy.deepcopy(self._preferences)
+        self._save_requested = False
+        return True
+
+    def _build_update(self, fields):
+        """
+        Builds the UpdateItem expression for the changed fields:
+        - string sets that were already stored as sets and only grew or shrank get ADD/DELETE
+          of the changed elements,
+        - lists that only grew get list_append of the new tail,
+        - removed or None fields get REMOVE,
+        - everything else (including legacy lists converted to sets) gets SET.
+
+        :param fields: The names of the changed fields.
+        :return: The keyword arguments for update_item.
+        """
+        set_actions, remove_actions, add_actions, delete_actions = [], [], [], []
+        names, values = {}, {}
+
+        for i, field in enumerate(sorted(fields)):
+            name, value = f"#f{i}", f":v{i}"
+            names[name] = field
+            old = self._stored.get(field)
+            new = self._preferences.get(field)
+
+            # A single expression cannot both ADD and DELETE on the same attribute
+            if isinstance(new, set) and isinstance(old, set) and (new >= old or new <= old):
+                if new - old:
+                    add_actions.append(f"{name} {value}")
+                    values[value] = new - old
+                else:
+                    delete_actions.append(f"{name} {value}")
+                    values[value] = old - new
+            elif new is None or new == set():
+                remove_actions.append(name)
+            elif isinstance(new, list) and isinstance(old, list) and new[:len(old)] == old:
+                set_actions.append(f"{name} = list_append(if_not_exists({name}, :empty_list), {value})")
+                values[value] = new[len(old):]
+                values[':empty_list'] = []
+            else:
+                set_actions.append(f"{name} = {value}")
+                values[value] = new
+
+        clauses = []
+        for keyword, actions in (('SET', set_actions), ('REMOVE', remove_actions),
+                                 ('ADD', add_actions), ('DELETE', delete_actions)):
+            if actions:
+                clauses.append(f"{keyword} {', '.join(actions)}")
+
+        update = {
+            'UpdateExpression': ' '.join(clauses),
+            'ExpressionAttributeNames': names
+        }
+        if values:
+            update['ExpressionAttributeValues'] = values
+        return update
+
+
+# Preference sessions of the update being processed, keyed by chat id
+preference_sessions = {}
+
+
+def get_preferences_session(chat_id):
+    """
+    Returns the preferences session of the given chat for the current update.
+    """
+    chat_id = str(chat_id)
+    if chat_id not in preference_sessions:
+        preference_sessions[chat_id] = UserPreferencesSession(chat_id)
+    return preference_sessions[chat_id]
+
+
+def flush_preference_sessions():
+    """
+    Writes every changed preferences session and forgets all sessions, so the next
+    update (possibly in the same warm container) starts with fresh reads.
+    """
+    try:
+        for session in preference_sessions.values():
+            session.flush()
+    finally:
+        preference_sessions.clear()
+
+
 def get_user_preferences(chat_id):
     """
-    Retrieves user preferences from DynamoDB for the given chat_id.
+    Retrieves user preferences for the given chat_id from the current update's session.
     If no preferences are found, it returns a default preference with 'new_user' state.
     """
-    response = user_preferences_table.get_item(Key={'chat_id': str(chat_id)})
-    return response.get('Item', {"state": "new_user"})
+    return get_preferences_session(chat_id).preferences
 
 
 def save_user_preferences(chat_id, preferences):
     """
-    Saves or updates user preferences in DynamoDB for the given chat_id.
+    Saves or updates user preferences for the given chat_id.
+    The write to DynamoDB happens once, when the update has been processed.
     """
-    user_preferences_table.put_item(Item={
-        'chat_id': str(chat_id),
-        **preferences
-    })
+    get_preferences_session(chat_id).save(preferences)
 
 
 def get_user_language(chat_id):
@@ -142,22 +409,23 @@ def get_user_selected_shops_history(chat_id):
 
 def get_tracked_items(chat_id):
     """
-    Retrieves the list of items the user is tracking.
+    Retrieves the sorted list of items the user is tracking.
     """
     preferences = get_user_preferences(chat_id)
-    return preferences.get('tracked_items', [])
+    return sorted(preferences.get('tracked_items', []))
 
 
 def add_tracked_item(chat_id, item_name):
     """
-    Adds an item to the user's tracking list, if it's not already being tracked.
+    Adds an item to the user's tracking list (a string set), if it's not already being tracked.
     Returns True if the item is newly added, False if it already exists.
     """
     preferences = get_user_preferences(chat_id)
-    tracked_items = preferences.setdefault('tracked_items', [])
+    tracked_items = set(preferences.get('tracked_items', []))
 
     if item_name not in tracked_items:
-        tracked_items.append(item_name)
+        tracked_items.add(item_name)
+        preferences['tracked_items'] = tracked_items
         save_user_preferences(chat_id, preferences)
         return True
     return False
@@ -168,10 +436,11 @@ def remove_tracked_item(chat_id, item_name):
     Removes an item from the user's tracking list.
     """
     preferences = get_user_preferences(chat_id)
-    tracked_items = preferences.get('tracked_items', [])
+    tracked_items = set(preferences.get('tracked_items', []))
 
     if item_name in tracked_items:
         tracked_items.remove(item_name)
+        preferences['tracked_items'] = tracked_items
         save_user_preferences(chat_id, preferences)
 
 
@@ -182,25 +451,10 @@ def exclude_all_shops(chat_id):
     Excludes all shops by retrieving all shop names from the pdf_metadata table
     and storing them in the user's preferences.
     """
-    unique_shops = set()
-    exclusive_start_key = None
-
-    while True:
-        scan_kwargs = {'ProjectionExpression': 'shop_name'}
-        if exclusive_start_key:
-            scan_kwargs['ExclusiveStartKey'] = exclusive_start_key
-
-        response = pdf_metadata_table.scan(**scan_kwargs)
-
-        for item in response.get('Items', []):
-            unique_shops.add(item['shop_name'])
-
-        exclusive_start_key = response.get('LastEvaluatedKey')
-        if not exclusive_start_key:
-            break
+    unique_shops = get_all_shops()
 
     preferences = get_user_preferences(chat_id)
-    preferences['excluded_shops'] = list(unique_shops)
+    preferences['excluded_shops'] = set(unique_shops)
     save_user_preferences(chat_id, preferences)
 
     return preferences
@@ -220,8 +474,7 @@ def get_included_shops(chat_id):
     to the excluded shops in the user's preferences.
     """
     excluded_shops = get_excluded_shops(chat_id)
-    response = pdf_metadata_table.scan(ProjectionExpression="shop_name")
-    all_shops = set(item['shop_name'] for item in response['Items'])
+    all_shops = set(get_all_shops())
     included_shops = all_shops - excluded_shops
     return sorted(included_shops) if included_shops else []
 
@@ -235,7 +488,7 @@ def exclude_shop(chat_id, shop_name):
 
     if shop_name not in excluded_shops:
         excluded_shops.add(shop_name)
-        preferences['excluded_shops'] = list(excluded_shops)
+        preferences['excluded_shops'] = excluded_shops
         save_user_preferences(chat_id, preferences)
 
 
@@ -248,7 +501,7 @@ def include_shop(chat_id, shop_name):
 
     if shop_name in excluded_shops:
         excluded_shops.remove(shop_name)
-        preferences['excluded_shops'] = list(excluded_shops)
+        preferences['excluded_shops'] = excluded_shops
         save_user_preferences(chat_id, preferences)
 
 
@@ -256,10 +509,42 @@ def include_shop(chat_id, shop_name):
 
 def get_all_shops():
     """
-    Retrieves a list of all unique shop names from the pdf_metadata table.
+    Retrieves a sorted list of all unique shop names. The list is served from an in-process
+    cache for SHOP_CACHE_TTL seconds and otherwise read from the shop registry item. If the
+    registry cannot be read, the packaged snapshot of the shop list is served meanwhile.
     """
-    response = pdf_metadata_table.scan(ProjectionExpression="shop_name")
-    unique_shops = set(item['shop_name'] for item in response['Items'])
+    now = time.monotonic()
+    if shop_cache['shops'] is None or now >= shop_cache['expires_at']:
+        try:
+            shop_cache['shops'] = load_shop_registry()
+        except ClientError as e:
+            logger.error(f"Error loading shop registry: {str(e)}")
+            if shop_cache['shops'] is None:
+                shop_cache['shops'] = static_data['shops']
+        shop_cache['expires_at'] = now + SHOP_CACHE_TTL
+    return list(shop_cache['shops'])
+
+
+def load_shop_registry():
+    """
+    Reads the set of shop names from the registry table. If the registry item does not exist yet,
+    the shop names are derived from the pdf_metadata table once and the registry is seeded with them.
+    """
+    response = registry_table.get_item(Key={'registry_key': SHOP_REGISTRY_KEY})
+    item = response.get('Item')
+    if item is not None:
+        return sorted(item.get('shops', set()))
+
+    unique_shops = set(item['shop_name'] for item in iter_items(pdf_metadata_table.scan,
+                                                                ProjectionExpression="shop_name"))
+    if unique_shops:
+        try:
+            # The admin API owns the registry; never overwrite an item it created meanwhile
+            registry_table.put_item(Item={'registry_key': SHOP_REGISTRY_KEY, 'shops': unique_shops},
+                                    ConditionExpression='attribute_not_exists(registry_key)')
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
     return sorted(unique_shops)
 
 
@@ -320,147 +605,303 @@ def set_text_info_enabled(chat_id, enabled):
 
 # --------------- Search Handling ---------------
 
-czech_to_english_map = str.maketrans(
-    "áčďéěíňóřšťúůýžÁČĎÉĚÍŇÓŘŠŤÚŮÝŽ",
-    "acdeeinorstuuyzACDEEINORSTUUYZ"
-)
-
-
-def find_item(item_name, shop_name=None, included_shops=None):
+def find_item(item_name, shop_name=None, included_shops=None, limit=None, top_k=None):
     """
     Searches for an item in the detected_data_table based on the given item_name,
     optional shop_name, and list of included_shops. It uses n-gram matching for flexible name search.
 
+    Candidates are looked up in the inverted bigram index, so only the posting lists of the
+    query's bigrams are read. When the index is disabled the whole table is scanned instead.
+    Candidates are ranked by relevance (IDF-weighted bigram overlap, Dice coefficient and a
+    length penalty, see QueryMatcher.relevance) and only the best top_k are returned.
+    Results are cached per normalized query, shop filter and data version.
+
     :param item_name: The name of the item to search for.
     :param shop_name: (Optional) The specific shop to search in.
     :param included_shops: (Optional) A list of shops to limit the search.
-    :return: A list of matching items with their prices and other metadata.
+    :param limit: (Optional) Stop scanning once this many items with a perfect n-gram score were found.
+    :param top_k: (Optional) The maximal number of results to return; all matches if None.
+    :return: A list of matching items with their prices and other metadata, best match first.
     """
-    results = []
-
-    # Preprocess the input item name: lowercase and convert Czech characters to English equivalents
-    item_name_lower = item_name.lower().translate(czech_to_english_map).replace('\n', ' ').replace('\t', ' ').strip()
+    # Normalize the user's input and generate its n-grams once (for flexible matching)
+    matcher = QueryMatcher(item_name)
+    query_ngrams = matcher.ngrams
+    if not query_ngrams:
+        return []
 
-    # Generate n-grams from the user's input (for flexible matching)
-    query_ngrams = generate_ngrams(item_name_lower, 2)
+    min_overlap = matcher.min_overlap
 
-    # Define the DynamoDB scan query to filter for valid items
-    scan_kwargs = {
-        'FilterExpression': Attr('valid').eq(True)  # Only include valid items
-    }
-
-    # Apply additional filters for shop_name or included_shops if provided
+    # Restrict the search to the requested shops
+    shop_names = None
     if shop_name:
-        scan_kwargs['FilterExpression'] &= Attr('shop_name').eq(shop_name)
+        shop_names = {shop_name}
     if included_shops:
-        scan_kwargs['FilterExpression'] &= Attr('shop_name').is_in(included_shops)
+        shop_names = shop_names & set(included_shops) if shop_names else set(included_shops)
 
-    # Perform the scan operation on DynamoDB
-    response = detected_data_table.scan(**scan_kwargs)
+    # Results cut short by a scan limit depend on the scan order and are not cached
+    cache_key = None
+    if limit is None:
+        try:
+            cache_key = build_query_cache_key(item_name, shop_names)
+        except ClientError as e:
+            # Without the data version a cached result cannot be validated; search without the cache
+            logger.error(f"Error reading data version, query cache bypassed: {str(e)}")
+
+    if cache_key is not None:
+        cached = query_cache.get(cache_key)
+        # A cached ranking serves every request for at most as many results as it holds
+        if cached is not None and (cached['top_k'] is None or len(cached['results']) < cached['top_k']
+                                   or (top_k is not None and top_k <= cached['top_k'])):
+            return cached['results'][:top_k]
+
+    matches = None
+    if USE_SEARCH_INDEX:
+        try:
+            matches, document_frequencies, total_documents = find_candidates_in_index(matcher, min_overlap,
+                                                                                      shop_names)
+        except ClientError as e:
+            if not is_missing_table(e):
+                raise
+            logger.error(f"Search index unavailable, scanning detected_data instead: {str(e)}")
+    if matches is None:
+        matches, document_frequencies, total_documents = find_candidates_by_scan(
+            matcher, min_overlap, shop_name, included_shops, limit)
+
+    # Score every match, but format prices only for the selected results
+    idf_weights = matcher.idf_weights(document_frequencies, total_documents)
+    scored = [(item, shared_ngrams, matcher.relevance(item, shared_ngrams, idf_weights))
+              for item, shared_ngrams in matches]
+
+    results = [build_search_result(item, len(shared_ngrams), relevance)
+               for item, shared_ngrams, relevance in select_top_matches(scored, top_k)]
+
+    if cache_key is not None:
+        query_cache.put(cache_key, {'top_k': top_k, 'results': results})
 
-    # Iterate over each returned item from the scan
-    for item in response.get('Items', []):
-        item_shop_name = item.get('shop_name', 'Unknown Shop')
+    return results
 
-        # Preprocess both original and processed item names
-        processed_item_name = item.get('processed_item_name', '').lower().translate(czech_to_english_map).strip()
-        db_item_name = item.get('item_name', '').lower().translate(czech_to_english_map).strip()
 
-        # Concatenate both names and generate n-grams from the result
-        concatenated_name = f"{db_item_name}".strip()
-        item_ngrams = generate_ngrams(concatenated_name, 2)
+def is_missing_table(error):
+    """
+    Returns whether a ClientError was raised because a table does not exist (e.g. the search index
+    table was not created yet).
+    """
+    return error.response['Error']['Code'] == 'ResourceNotFoundException'
 
-        # Count the intersection between user query n-grams and item name n-grams
-        ngram_intersection_count = len(query_ngrams.intersection(item_ngrams))
 
-        # If there's a sufficient match, add the item to the result
-        if ngram_intersection_count >= len(query_ngrams)-1:
-            price = find_price_for_item(item)
-            results.append({
-                'item_name': item.get('item_name', ''),
-                'price': price,
-                'shop_name': item_shop_name,
-                'ngram_score': ngram_intersection_count,
-                'image_name': item.get('image_id')  # Include the image filename if available
-            })
+def build_query_cache_key(item_name, shop_names=None):
+    """
+    Builds the result cache key of a search. The current data version is part of the key,
+    so results cached before detected_data or flyer validity changed are never served.
+
+    :param item_name: The searched item name.
+    :param shop_names: (Optional) Set of shop names the search is restricted to.
+    :return: The cache key.
+    """
+    shops = ','.join(sorted(shop_names)) if shop_names else '*'
+    return f"{get_data_version()}|{shops}|{normalize_name(item_name)}"
 
-    # Sort results by n-gram score in descending order
-    results = sorted(results, key=lambda x: x['ngram_score'], reverse=True)
+
+def find_items_batch(item_names, shop_names, top_k=None):
+    """
+    Searches for a whole shopping list in a set of shops at once. All queries are resolved with
+    a single index lookup (or a single scan when the index is disabled) and every candidate row
+    is scored against all queries in one pass.
+
+    :param item_names: The list of item names to search for.
+    :param shop_names: The list of shops to search in.
+    :param top_k: (Optional) The maximal number of results per item name and shop; all matches if None.
+    :return: A dict {shop_name: {item_name: [results sorted by relevance]}} containing every
+             requested shop and every non-empty item name.
+    """
+    shop_names = set(shop_names)
+    item_names = list(dict.fromkeys(name.strip() for name in item_names if name.strip()))
+    results = {shop: {name: [] for name in item_names} for shop in shop_names}
+
+    matchers = {name: QueryMatcher(name) for name in item_names}
+    matchers = {name: matcher for name, matcher in matchers.items() if matcher.ngrams}
+    if not matchers or not shop_names:
+        return results
+
+    matches = {shop: {name: [] for name in matchers} for shop in shop_names}
+    document_frequencies = Counter()
+
+    candidate_scores = None
+    if USE_SEARCH_INDEX:
+        try:
+            candidate_scores = find_candidate_ids_batch(
+                {name: matcher.ngrams for name, matcher in matchers.items()},
+                {name: matcher.min_overlap for name, matcher in matchers.items()},
+                shop_names,
+                document_frequencies
+            )
+        except ClientError as e:
+            if not is_missing_table(e):
+                raise
+            logger.error(f"Search index unavailable, scanning detected_data instead: {str(e)}")
+            document_frequencies.clear()
+
+    if candidate_scores is not None:
+        candidate_ids = set().union(*(scores.keys() for scores in candidate_scores.values()))
+        total_documents = get_detected_item_count()
+
+        for item in batch_get_detected_items(candidate_ids):
+            item_shop_name = item.get('shop_name')
+            if item.get('valid') is not True or item_shop_name not in shop_names:
+                continue
+            for name, scores in candidate_scores.items():
+                if item[DETECTED_DATA_KEY] in scores:
+                    matches[item_shop_name][name].append((item, matchers[name].shared_ngrams(item)))
+    else:
+        from boto3.dynamodb.conditions import Attr  # Deferred import, see aws_resources.LazyResource
+
+        scan_kwargs = {'FilterExpression': Attr('valid').eq(True) & Attr('shop_name').is_in(list(shop_names))}
+        total_documents = 0
+
+        for item in parallel_scan(detected_data_table, **scan_kwargs):
+            total_documents += 1
+            counted_ngrams = set()
+            for name, matcher in matchers.items():
+                shared_ngrams = matcher.shared_ngrams(item)
+                counted_ngrams |= shared_ngrams
+                if len(shared_ngrams) >= matcher.min_overlap:
+                    matches[item['shop_name']][name].append((item, shared_ngrams))
+            document_frequencies.update(counted_ngrams)
+
+    # Rank every result list by relevance and keep its best top_k results
+    idf_weights = {name: matcher.idf_weights(document_frequencies, total_documents)
+                   for name, matcher in matchers.items()}
+    for shop, shop_matches in matches.items():
+        for name, item_matches in shop_matches.items():
+            matcher = matchers[name]
+            scored = [(item, shared_ngrams, matcher.relevance(item, shared_ngrams, idf_weights[name]))
+                      for item, shared_ngrams in item_matches]
+            results[shop][name] = [build_search_result(item, len(shared_ngrams), relevance)
+                                   for item, shared_ngrams, relevance in select_top_matches(scored, top_k)]
 
     return results
 
 
-def find_price_for_item(obj):
+def select_top_matches(scored_matches, top_k=None):
     """
-    Extracts different price types (item_price, item_initial_price, item_member_price)
-    from a DynamoDB item and returns them as a formatted string.
+    Selects the best scored matches. A bounded heap keeps only top_k matches at a time,
+    so the full candidate list is never sorted.
 
-    :param obj: The DynamoDB item containing price information.
-    :return: A formatted string containing price information or "Price not found" if no prices exist.
+    :param scored_matches: A list of (item, shared_ngrams, relevance) tuples.
+    :param top_k: (Optional) The number of matches to select; all matches if None.
+    :return: The selected matches, best relevance first.
     """
-    prices = []
+    if top_k is None:
+        return sorted(scored_matches, key=lambda match: match[2], reverse=True)
+    return heapq.nlargest(top_k, scored_matches, key=lambda match: match[2])
 
-    def try_convert_to_dict(value):
-        """
-        Utility function to safely convert a string into a dictionary if possible.
 
-        :param value: The value to attempt conversion.
-        :return: A dictionary if successful, otherwise the original value.
-        """
-        if isinstance(value, str):
-            try:
-                return ast.literal_eval(value)  # Attempt to evaluate as a Python literal
-            except (ValueError, SyntaxError):
-                try:
-                    return json.loads(value)  # Attempt to parse as JSON
-                except (ValueError, TypeError):
-                    return value  # Return original value if conversion fails
-        return value
+def build_search_result(item, ngram_score, relevance):
+    """
+    Converts a matched detected_data row into the search result passed to the message handlers.
 
-    # Try to convert price fields to dictionaries, if applicable
-    processed_price = try_convert_to_dict(obj.get('processed_item_price', None))
-    initial_price = try_convert_to_dict(obj.get('processed_item_initial_price', None))
-    member_price = try_convert_to_dict(obj.get('processed_item_member_price', None))
+    :param item: The matched detected_data row.
+    :param ngram_score: The number of query bigrams shared with the row.
+    :param relevance: The relevance score of the row for the query.
+    :return: A dict with the item name, formatted price, shop name, scores and image path.
+    """
+    return {
+        'item_name': item.get('item_name', ''),
+        'price': find_price_for_item(item),
+        'shop_name': item.get('shop_name', 'Unknown Shop'),
+        'ngram_score': ngram_score,
+        'relevance': relevance,
+        'image_name': item.get('image_id')  # Include the image filename if available
+    }
 
-    # Handle processed_item_price
-    if isinstance(processed_price, dict):
-        prices.append(f"Price: {processed_price.get('item_price')}\n")
-    elif processed_price:  # If it's a string or number
-        prices.append(f"Price: {processed_price}\n")
 
-    # Handle processed_item_initial_price
-    if isinstance(initial_price, dict):
-        prices.append(f"Initial price: {initial_price.get('item_initial_price')}\n")
-    elif initial_price:
-        prices.append(f"Initial price: {initial_price}\n")
+def get_detected_item_count():
+    """
+    Returns the approximate number of rows in detected_data (the IDF corpus size). DynamoDB
+    refreshes the count about every six hours; it is read once per warm Lambda container.
+    """
+    try:
+        return detected_data_table.item_count
+    except ClientError as e:
+        logger.error(f"Error describing detected_data: {str(e)}")
+        return 0  # The IDF falls back to the largest document frequency
+
+
+def find_candidates_in_index(matcher, min_overlap, shop_names=None):
+    """
+    Resolves the query against the inverted bigram index and fetches the matched rows.
+
+    :param matcher: The QueryMatcher of the normalized query.
+    :param min_overlap: The minimal number of shared bigrams for an item to qualify.
+    :param shop_names: (Optional) Set of shop names to restrict the search to.
+    :return: A tuple (list of (item, shared_ngrams) tuples for valid items, document frequencies
+             of the query bigrams, number of documents in the corpus).
+    """
+    document_frequencies = {}
+    candidate_scores = find_candidate_ids(matcher.ngrams, min_overlap, shop_names, document_frequencies)
+    matches = []
 
-    # Handle processed_item_member_price
-    if isinstance(member_price, dict):
-        prices.append(f"Member price: {member_price.get('item_member_price')}\n")
-    elif member_price:
-        prices.append(f"Member price: {member_price}\n")
+    for item in batch_get_detected_items(candidate_scores.keys()):
+        # Validity is owned by detected_data, so it is checked on the fetched row
+        if item.get('valid') is not True:
+            continue
+        if shop_names is not None and item.get('shop_name') not in shop_names:
+            continue
+        matches.append((item, matcher.shared_ngrams(item)))
 
-    # Return the price strings or "Price not found" if no prices are available
-    return "".join(prices) if prices else "Price not found"
+    return matches, document_frequencies, get_detected_item_count()
 
 
-def generate_ngrams(text, n):
+def find_candidates_by_scan(matcher, min_overlap, shop_name=None, included_shops=None, limit=None):
     """
-    Generates n-grams from a given text.
+    Scans detected_data for valid items (parallel segmented scan over all pages) and matches
+    every returned row against the query using the rows' precomputed bigram fingerprints.
+    The scanned rows also serve as the corpus of the IDF weights.
 
-    :param text: The input text from which n-grams are generated.
-    :param n: The number of characters per n-gram.
-    :return: A set of n-grams.
+    :param matcher: The QueryMatcher of the normalized query.
+    :param min_overlap: The minimal number of shared bigrams for an item to qualify.
+    :param shop_name: (Optional) The specific shop to search in.
+    :param included_shops: (Optional) A list of shops to limit the search.
+    :param limit: (Optional) Stop the scan once this many items with a perfect n-gram score were found.
+    :return: A tuple (list of (item, shared_ngrams) tuples, document frequencies of the query
+             bigrams, number of scanned rows).
     """
-    words = re.split(r'\W+', text)  # Split text by any non-alphanumeric characters
-    ngrams = set()
+    from boto3.dynamodb.conditions import Attr  # Deferred import, see aws_resources.LazyResource
+
+    # Define the DynamoDB scan query to filter for valid items
+    scan_kwargs = {
+        'FilterExpression': Attr('valid').eq(True)  # Only include valid items
+    }
+
+    # Apply additional filters for shop_name or included_shops if provided
+    if shop_name:
+        scan_kwargs['FilterExpression'] &= Attr('shop_name').eq(shop_name)
+    if included_shops:
+        scan_kwargs['FilterExpression'] &= Attr('shop_name').is_in(included_shops)
+
+    matches = []
+    document_frequencies = Counter()
+    scanned_items = 0
+    perfect_matches = 0
 
-    # Generate n-grams for each word in the text
-    for word in words:
-        for i in range(len(word) - n + 1):
-            ngrams.add(word[i:i + n])
+    def enough_results():
+        # Full matches rank highest for most queries; with a limit only the rows scanned so far are ranked
+        return limit is not None and perfect_matches >= limit
 
-    return ngrams
+    # Perform the scan operation on DynamoDB
+    for item in parallel_scan(detected_data_table, stop_when=enough_results, **scan_kwargs):
+        # Find the user query n-grams contained in the item name
+        shared_ngrams = matcher.shared_ngrams(item)
+        document_frequencies.update(shared_ngrams)
+        scanned_items += 1
+
+        # If there's a sufficient match, add the item to the result
+        if len(shared_ngrams) >= min_overlap:
+            matches.append((item, shared_ngrams))
+            if len(shared_ngrams) == len(matcher.ngrams):
+                perfect_matches += 1
+
+    return matches, document_frequencies, scanned_items
 
 
 # --------------- User Interaction Handling ---------------
@@ -469,12 +910,7 @@ def get_available_languages():
     """
     Returns a dictionary of supported languages and their respective codes.
     """
-    return {
-        'en': 'English',
-        'ru': 'Русский',
-        'uk': 'Українська',
-        'cs': 'Čeština'
-    }
+    return static_data['languages']
 
 
 # Language selection prompt
@@ -484,21 +920,16 @@ def language_selection(chat_id):
 
     :param chat_id: The Telegram chat ID of the user.
     """
-    url = f"{API_URL}/sendMessage"
     buttons = {
-        "inline_keyboard": [
-            [{"text": "English", "callback_data": "lang_en"}],
-            [{"text": "Русский", "callback_data": "lang_ru"}],
-            [{"text": "Українська", "callback_data": "lang_uk"}],
-            [{"text": "Čeština", "callback_data": "lang_cs"}],
-        ]
+        "inline_keyboard": [[{"text": language, "callback_data": f"lang_{code}"}]
+                            for code, language in get_available_languages().items()]
     }
     payload = {
         "chat_id": chat_id,
         "text": "Welcome! Please select your language:",
         "reply_markup": buttons
     }
-    requests.post(url, json=payload)
+    telegram.call("sendMessage", json=payload)
 
 
 # Main menu display
@@ -508,15 +939,8 @@ def main_menu(chat_id):
 
     :param chat_id: The Telegram chat ID of the user.
     """
-    url = f"{API_URL}/sendMessage"
     buttons = {
-        "keyboard": [
-            [{"text": "🔍 Search for item"}],
-            [{"text": "🛒 Add shop item to track price"}],
-            [{"text": "🛍 Compare shopping list over shops"}],
-            [{"text": "⚙️ Settings"}],
-            [{"text": "ℹ️ About project"}],
-        ],
+        "keyboard": static_data['keyboards']['main_menu'],
         "resize_keyboard": True
     }
     payload = {
@@ -524,7 +948,7 @@ def main_menu(chat_id):
         "text": "Main Menu",
         "reply_markup": buttons
     }
-    requests.post(url, json=payload)
+    telegram.call("sendMessage", json=payload)
 
 
 # Including shop to track at the start
@@ -542,7 +966,7 @@ def include_user_tracking_shops(chat_id):
         exclude_all_shops(chat_id)
 
     # Send the list of shops with options to select from
-    requests.post(f"{API_URL}/sendMessage", json={
+    telegram.call("sendMessage", json={
         "chat_id": chat_id,
         "text": "Please select a shop from the list for item search and tracking. You can change this later in 'Settings'.",
         "reply_markup": {
@@ -562,8 +986,6 @@ def settings_menu(chat_id):
 
     :param chat_id: The Telegram chat ID of the user.
     """
-    url = f"{API_URL}/sendMessage"
-
     # Get the current state of photo groups and text info to display in the button labels
     photo_group_state = "Enabled" if is_photo_group_enabled(chat_id) else "Disabled"
     text_info_state = "Enabled" if is_text_info_enabled(chat_id) else "Disabled"
@@ -589,704 +1011,1044 @@ def settings_menu(chat_id):
         "text": "Select an option from Settings:",
         "reply_markup": buttons
     }
-    requests.post(url, json=payload)
+    telegram.call("sendMessage", json=payload)
+
+
+def select_album_images(found_items, image_budget=ALBUM_IMAGE_BUDGET):
+    """
+    Picks the images to show for one query: the images of the best scored results,
+    at most image_budget of them.
+
+    :param found_items: The search results of the query.
+    :param image_budget: The maximal number of images to send for the query.
+    :return: A set of S3 image paths.
+    """
+    ranked = sorted((item for item in found_items if item.get('image_name')),
+                    key=lambda x: x['relevance'], reverse=True)
+    return set(item['image_name'] for item in ranked[:image_budget])
 
 
 # Sending images as an album
 def send_images_as_album(chat_id, media_group, shop_name):
     """
-    Sends a group of images (as an album) to the user via Telegram.
+    Sends a group of images (as one or more albums) to the user via Telegram.
+    The images are split into albums of at most MEDIA_GROUP_LIMIT items (Telegram's limit).
+    Albums are sent in order while the S3 reads of the next ALBUM_PIPELINE_DEPTH albums
+    already run in the background.
+    Images already uploaded once are referenced by their cached Telegram file_id; only the
+    others are read from S3 and uploaded. If Telegram rejects a cached file_id, the
+    cached ids of that album are dropped and it is sent again with the images from S3.
 
     :param chat_id: The Telegram chat ID of the user.
-    :param media_group: A list of tuples (S3 image path, local temp path) representing images to send.
-    :param shop_name: The name of the shop to include in the caption of the first image.
+    :param media_group: A list of S3 image paths representing images to send, best match first.
+    :param shop_name: The name of the shop to include in the caption of the first image of every album.
     """
-    media = []
-    files = {}
+    s3_image_paths = list(dict.fromkeys(media_group))
+    chunks = [s3_image_paths[i:i + MEDIA_GROUP_LIMIT] for i in range(0, len(s3_image_paths), MEDIA_GROUP_LIMIT)]
+    file_ids = get_cached_file_ids(s3_image_paths)
+    reads = {}
 
-    # Loop through the media group and process each image
-    for i, (s3_image_path, temp_path) in enumerate(media_group):
-        try:
-            # Extract the image filename from the S3 path
-            image_name = os.path.basename(s3_image_path)
+    def prefetch(chunk_index):
+        # Start reading the not cached images of an album from S3
+        if chunk_index < len(chunks):
+            reads.update(submit_s3_reads(path for path in chunks[chunk_index] if path not in file_ids))
+
+    for chunk_index in range(ALBUM_PIPELINE_DEPTH):
+        prefetch(chunk_index)
 
-            # Log the S3 path and temporary file for debugging
-            logger.debug(f"Downloading image from S3: {s3_image_path} to {temp_path}")
+    for chunk_index, chunk in enumerate(chunks):
+        prefetch(chunk_index + ALBUM_PIPELINE_DEPTH)
+        caption = shop_name if len(chunks) == 1 else f"{shop_name} ({chunk_index + 1}/{len(chunks)})"
+        send_album_chunk(chat_id, chunk, caption, file_ids, reads)
 
-            # Use a temporary file to handle the downloaded image
-            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                temp_file_path = temp_file.name
-                # Download the image from S3 into the temporary file
-                download_file_from_s3(s3_image_path, temp_file_path)
 
-                # Read the file content for use in the Telegram API
-                with open(temp_file_path, 'rb') as image_file:
-                    image_content = image_file.read()
+def send_album_chunk(chat_id, s3_image_paths, caption, file_ids, reads):
+    """
+    Sends one album of at most MEDIA_GROUP_LIMIT images and caches the file ids of the uploaded images.
 
-                # Prepare the files dictionary (it must have unique keys for each image)
-                files[f"photo{i}"] = (image_name, image_content)
+    :param chat_id: The Telegram chat ID of the user.
+    :param s3_image_paths: The S3 paths of the images of this album, in album order.
+    :param caption: The caption of the first image.
+    :param file_ids: A dict mapping S3 paths to cached Telegram file ids.
+    :param reads: A dict mapping S3 paths to the Futures of their content.
+    """
+    chunk_file_ids = {path: file_ids[path] for path in s3_image_paths if path in file_ids}
+    image_contents = collect_s3_reads({path: reads[path] for path in s3_image_paths if path in reads})
 
-                # Prepare the media array with references to the attached photos
-                media.append({
-                    "type": "photo",
-                    "media": f"attach://photo{i}",
-                    "caption": shop_name if i == 0 else ""  # Add shop name as caption only to the first image
-                })
+    response, sent_paths = post_media_group(chat_id, s3_image_paths, caption, chunk_file_ids, image_contents)
+    if chunk_file_ids and is_file_id_error(response):
+        logger.warning(f"Cached file ids rejected ({response.text}), resending album from S3")
+        evict_cached_file_ids(chunk_file_ids.keys())
+        image_contents.update(fetch_files_from_s3(chunk_file_ids.keys()))
+        chunk_file_ids = {}
+        response, sent_paths = post_media_group(chat_id, s3_image_paths, caption, chunk_file_ids, image_contents)
 
-                # Remove the temporary file after reading
-                os.remove(temp_file_path)
+    if response is not None and response.ok:
+        cache_file_ids_from_response(response, sent_paths, chunk_file_ids)
 
-        except Exception as e:
-            logger.error(f"Error processing image {image_name}: {str(e)}")
+
+def post_media_group(chat_id, s3_image_paths, caption, file_ids, image_contents):
+    """
+    Builds and sends one sendMediaGroup request (sendPhoto if only one image is available,
+    as albums need at least two items).
+
+    :param chat_id: The Telegram chat ID of the user.
+    :param s3_image_paths: The S3 paths of the images, in album order.
+    :param caption: The caption of the first image.
+    :param file_ids: A dict mapping S3 paths to cached Telegram file ids.
+    :param image_contents: A dict mapping S3 paths to image bytes read from S3.
+    :return: A tuple (Telegram API response or None if nothing could be sent,
+             S3 paths of the images included in the album in album order).
+    """
+    media = []
+    files = {}
+    sent_paths = []
+
+    # Loop through the media group and process each image
+    for i, s3_image_path in enumerate(s3_image_paths):
+        if s3_image_path in file_ids:
+            # Reference the image already stored on Telegram's servers
+            media_reference = file_ids[s3_image_path]
+        elif s3_image_path in image_contents:
+            # Prepare the files dictionary (it must have unique keys for each image)
+            files[f"photo{i}"] = (os.path.basename(s3_image_path), image_contents[s3_image_path])
+            media_reference = f"attach://photo{i}"
+        else:
+            continue  # The image could not be read from S3
+
+        # Prepare the media array with references to the attached or cached photos
+        media.append({
+            "type": "photo",
+            "media": media_reference,
+            "caption": caption if not media else ""  # Add the caption only to the first image
+        })
+        sent_paths.append(s3_image_path)
 
     # If no valid media is available, log an error and return
     if not media:
         logger.error("No valid media to send.")
-        return
+        return None, sent_paths
 
     # Send the media group using the Telegram API
     try:
-        response = requests.post(f"{API_URL}/sendMediaGroup", files=files, data={
-            "chat_id": chat_id,
-            "media": json.dumps(media)  # Convert the media list to a JSON string
-        })
+        if len(media) == 1:
+            photo = media[0]["media"]
+            if photo.startswith("attach://"):
+                response = telegram.call("sendPhoto", files={"photo": files[photo[len("attach://"):]]},
+                                         data={"chat_id": chat_id, "caption": caption})
+            else:
+                response = telegram.call("sendPhoto", json={"chat_id": chat_id, "photo": photo, "caption": caption})
+        else:
+            response = telegram.call("sendMediaGroup", files=files or None, data={
+                "chat_id": chat_id,
+                "media": json.dumps(media)  # Convert the media list to a JSON string
+            })
 
         logger.debug(f"Telegram API response for sendMediaGroup: {response.status_code}, {response.text}")
+        return response, sent_paths
     except Exception as e:
         logger.error(f"Error sending media group: {str(e)}")
+        return None, sent_paths
+
+
+# --------------- Telegram File Cache ---------------
+
+def get_cached_file_ids(s3_image_paths):
+    """
+    Looks up the Telegram file ids of already uploaded images.
+
+    :param s3_image_paths: The S3 paths of the images.
+    :return: A dict mapping S3 paths to file ids for the cached images.
+    """
+    keys = [{'image_key': path} for path in dict.fromkeys(s3_image_paths)]
+    try:
+        items = batch_get_items(dynamodb, telegram_file_cache_table.name, keys)
+    except Exception as e:
+        logger.error(f"Error reading the Telegram file cache: {str(e)}")
+        return {}
+    return {item['image_key']: item['file_id'] for item in items}
+
+
+def cache_file_ids_from_response(response, s3_image_paths, file_ids):
+    """
+    Stores the file ids Telegram assigned to newly uploaded images of an album.
+    The messages of a sendMediaGroup result are in the order of the sent media.
+
+    :param response: The successful sendMediaGroup (or sendPhoto) response.
+    :param s3_image_paths: The S3 paths of the images included in the album, in album order.
+    :param file_ids: The file ids that were already cached (these are not written again).
+    """
+    try:
+        messages = response.json().get('result', [])
+        if isinstance(messages, dict):
+            messages = [messages]  # sendPhoto returns a single message
+        uploaded = {}
+        for s3_image_path, message in zip(s3_image_paths, messages):
+            photo_sizes = message.get('photo')
+            if s3_image_path not in file_ids and photo_sizes:
+                uploaded[s3_image_path] = photo_sizes[-1]['file_id']  # The largest size
+
+        with telegram_file_cache_table.batch_writer(overwrite_by_pkeys=['image_key']) as batch:
+            for s3_image_path, file_id in uploaded.items():
+                batch.put_item(Item={'image_key': s3_image_path, 'file_id': file_id})
+    except Exception as e:
+        logger.error(f"Error caching Telegram file ids: {str(e)}")
+
+
+def is_file_id_error(response):
+    """
+    Returns whether Telegram rejected a request because of a file id it no longer accepts
+    (other errors, e.g. a too long caption, do not invalidate the cached ids).
+
+    :param response: The Telegram API response, or None if the request failed.
+    """
+    if response is None or response.status_code != 400:
+        return False
+    try:
+        description = response.json().get('description', '').lower()
+    except ValueError:
+        return False
+    return any(marker in description for marker in FILE_ID_ERROR_MARKERS)
+
+
+def evict_cached_file_ids(s3_image_paths):
+    """
+    Removes file ids Telegram no longer accepts from the cache.
+
+    :param s3_image_paths: The S3 paths of the images to evict.
+    """
+    try:
+        with telegram_file_cache_table.batch_writer(overwrite_by_pkeys=['image_key']) as batch:
+            for s3_image_path in s3_image_paths:
+                batch.delete_item(Key={'image_key': s3_image_path})
+    except Exception as e:
+        logger.error(f"Error evicting Telegram file ids: {str(e)}")
+
+
+def send_shop_results(chat_id, shop_name, media_group, text=None):
+    """
+    Sends the search results of one shop: the album first, then the text info.
+
+    :param chat_id: The Telegram chat ID of the user.
+    :param shop_name: The name of the shop.
+    :param media_group: A list of S3 image paths; may be empty.
+    :param text: (Optional) The text results to send after the album.
+    """
+    if media_group:
+        send_images_as_album(chat_id, media_group, shop_name)
+    if text:
+        telegram.call("sendMessage", json={"chat_id": chat_id, "text": text})
+
+
+def search_and_send_page(chat_id, item_name, offset=0):
+    """
+    Searches for an item in the user's included shops and sends one page of the ranked results,
+    grouped by shop. If more results exist, a "More results" inline button requesting the next
+    page is sent as well; the query is kept in the user's preferences for that button.
+
+    :param chat_id: The Telegram chat ID of the user.
+    :param item_name: The searched item name.
+    :param offset: The number of best results already shown to the user.
+    :return: True if any result was sent, otherwise False.
+    """
+    photo_group_enabled = is_photo_group_enabled(chat_id)
+    text_info_enabled = is_text_info_enabled(chat_id)
+
+    # Without text lines a result is only shown through its photo, so a page holds at most the image budget
+    page_size = SEARCH_PAGE_SIZE
+    if photo_group_enabled and not text_info_enabled:
+        page_size = max(1, min(SEARCH_PAGE_SIZE, SEARCH_PAGE_IMAGE_BUDGET))
+
+    # One extra result tells whether a next page exists
+    found_items = find_item(item_name, included_shops=get_included_shops(chat_id),
+                            top_k=offset + page_size + 1)
+    page_items = found_items[offset:offset + page_size]
+    if not page_items:
+        return False
+
+    items_by_shop = {}
+    for found_item in page_items:
+        shop_name = found_item['shop_name']
+
+        if shop_name not in items_by_shop:
+            items_by_shop[shop_name] = []
+        items_by_shop[shop_name].append(found_item)
+
+    album_images = select_album_images(page_items, SEARCH_PAGE_IMAGE_BUDGET)  # Best matches of the page
+    shop_tasks = []  # Results of different shops are sent concurrently
+
+    for shop_name, shop_items in items_by_shop.items():
+        response = f"Here is what I found for '{item_name}' in {shop_name}:\n"
+        media_group = []
+
+        for found_item in shop_items:
+            if text_info_enabled:
+                response += f"- {found_item['item_name']} at {shop_name}: {found_item['price']}\n"
+
+            s3_image_dir = found_item.get('image_name')
+            # Collecting images for the media group (album) if photo group is enabled
+            if photo_group_enabled and s3_image_dir in album_images:
+                media_group.append(s3_image_dir)
+                logger.debug(f"Image added to media_group: {s3_image_dir}")
+
+        logger.debug(f"Sending results for {shop_name} with {len(media_group)} images")
+        shop_tasks.append(partial(send_shop_results, chat_id, shop_name,
+                                  media_group if photo_group_enabled else [],
+                                  response if text_info_enabled else None))
+
+    telegram.run_concurrently(shop_tasks)
+
+    next_offset = offset + len(page_items)
+    if len(found_items) > next_offset:
+        preferences = get_user_preferences(chat_id)
+        preferences['last_search'] = item_name
+        save_user_preferences(chat_id, preferences)
+
+        telegram.call("sendMessage", json={
+            "chat_id": chat_id,
+            "text": f"Showing results {offset + 1}-{next_offset} for '{item_name}'.",
+            "reply_markup": {
+                "inline_keyboard": [[{"text": "More results", "callback_data": f"more_{next_offset}"}]]
+            }
+        })
+
+    return True
+
+
+# --------------- Message Routing ---------------
+
+# Transition targets of message routes besides regular state names
+IDLE = 'idle'  # The main menu; stored as no state
+KEEP_STATE = 'keep'  # Leave the user's state unchanged
+
+# States in which the main menu commands are not available (the user has to finish the step first)
+EXCLUSIVE_STATES = {'/start_selecting_shops'}
+
+# Key of the routes applying to every state without a route of its own
+ANY_STATE = '*'
+
+# Route tables: commands available everywhere, main menu commands, commands of a state
+# keyed by (state, text), and the free text input handler of a state
+PRIORITY_COMMANDS = {}
+MENU_COMMANDS = {}
+STATE_COMMANDS = {}
+STATE_INPUTS = {}
+
+
+class Route:
+    """
+    A message handler together with the state the user moves to once it completed.
+    Handlers receive a MessageContext and may return a target overriding next_state.
+    """
+
+    def __init__(self, handler, next_state=KEEP_STATE):
+        self.handler = handler
+        self.next_state = next_state
+
+
+class MessageContext:
+    """
+    Everything a message handler needs about the incoming message and its user. The user's
+    preferences are loaded once when the context is created; derived values are computed from them.
+    """
+
+    def __init__(self, update):
+        message = update['message']
+        self.chat_id = message['chat']['id']
+        self.text = message.get('text')
+        self.preferences = get_user_preferences(self.chat_id)
+        self.state = self.preferences.get('state')
+
+    @property
+    def language(self):
+        return self.preferences.get('language')
+
+    @property
+    def included_shops(self):
+        return get_included_shops(self.chat_id)
+
+    @property
+    def excluded_shops(self):
+        return get_excluded_shops(self.chat_id)
+
+    def transition(self, target):
+        """
+        Moves the user to the given state (IDLE for the main menu, KEEP_STATE for no change).
+        """
+        if target == KEEP_STATE:
+            return
+        self.state = None if target == IDLE else target
+        save_user_state(self.chat_id, self.state)
+
+
+def on_command(*texts, states=None, next_state=KEEP_STATE, priority=False):
+    """
+    Registers the decorated function as the handler of keyboard button texts.
+
+    :param texts: The button texts handled.
+    :param states: (Optional) The states in which the texts are handled; the main menu commands
+                   (available in all non-exclusive states) if None.
+    :param next_state: The state the user moves to after the handler.
+    :param priority: Handle the texts in every state, before any state route (e.g. '/start').
+    """
+    def register(handler):
+        route = Route(handler, next_state)
+        for text in texts:
+            if priority:
+                PRIORITY_COMMANDS[text] = route
+            elif states is None:
+                MENU_COMMANDS[text] = route
+            else:
+                for state in states:
+                    STATE_COMMANDS[(state, text)] = route
+        return handler
+
+    return register
+
+
+def on_input(*states, next_state=KEEP_STATE):
+    """
+    Registers the decorated function as the handler of free text input in the given states.
+
+    :param states: The states handled (ANY_STATE for the fallback handler).
+    :param next_state: The state the user moves to after the handler.
+    """
+    def register(handler):
+        route = Route(handler, next_state)
+        for state in states:
+            STATE_INPUTS[state] = route
+        return handler
+
+    return register
+
+
+def resolve_route(state, text):
+    """
+    Finds the route of a message with constant-time lookups, in the order: priority commands,
+    main menu commands (unless the state is exclusive), commands of the state, input handler
+    of the state, and the routes registered for ANY_STATE.
+    """
+    if text is None:
+        return STATE_INPUTS[ANY_STATE]
+
+    route = PRIORITY_COMMANDS.get(text)
+    if route is None and state not in EXCLUSIVE_STATES:
+        route = MENU_COMMANDS.get(text)
+    if route is None:
+        route = STATE_COMMANDS.get((state, text)) or STATE_INPUTS.get(state)
+    if route is None:
+        route = STATE_COMMANDS.get((ANY_STATE, text)) or STATE_INPUTS[ANY_STATE]
+    return route
 
 
 # Process messages and button responses
 def process_message(update):
-    chat_id = update['message']['chat']['id']
-    text = update['message'].get('text')
-
-    # Ensure user preferences are loaded
-    state = get_user_state(chat_id)
-
-    # Handle /start command
-    if text == "/start":
-        description = "Welcome to the Smart Shopping Bot! I will help you track prices, manage sale sheets, and find the best shopping paths."
-        requests.post(f"{API_URL}/sendMessage", json={"chat_id": chat_id, "text": description})
-
-        if state == "new_user":
-            # Set default preferences for new users
-            preferences = get_user_preferences(chat_id)
-            if 'photo_group_enabled' not in preferences:
-                preferences['photo_group_enabled'] = True  # Default to show photo groups
-            if 'text_info_enabled' not in preferences:
-                preferences['text_info_enabled'] = False  # Default to hide text info
-            save_user_preferences(chat_id, preferences)
+    """
+    Routes a Telegram message to its handler based on the user's state and the message text,
+    and applies the route's state transition.
+
+    :param update: The update payload containing the message.
+    """
+    context = MessageContext(update)
+    route = resolve_route(context.state, context.text)
+
+    started = time.perf_counter()
+    target = route.handler(context)
+    context.transition(target if target is not None else route.next_state)
+    logger.info(f"Handled message with {route.handler.__name__} in {(time.perf_counter() - started) * 1000:.1f} ms")
 
-            # Guide user through initial steps of setup: language selection or shop inclusion
-            if get_user_language(chat_id) is None:
-                language_selection(chat_id)
-                save_user_state(chat_id, None)
-            elif get_included_shops(chat_id) is None:
-                include_user_tracking_shops(chat_id)
-                save_user_state(chat_id, None)
-            else:
-                main_menu(chat_id)
-                save_user_state(chat_id, None)
-        else:
-            # If user is not new, take them directly to the main menu
-            main_menu(chat_id)
-            save_user_state(chat_id, None)
 
-    # Handling the shop selection state
-    elif state == '/start_selecting_shops':
-        if text == "➕ Add another shop":
+# --------------- Message Handlers: Start and Main Menu ---------------
+
+@on_command("/start", priority=True, next_state=IDLE)
+def handle_start(context):
+    chat_id = context.chat_id
+    description = "Welcome to the Smart Shopping Bot! I will help you track prices, manage sale sheets, and find the best shopping paths."
+    telegram.call("sendMessage", json={"chat_id": chat_id, "text": description})
+
+    if context.state == "new_user":
+        # Set default preferences for new users
+        preferences = context.preferences
+        if 'photo_group_enabled' not in preferences:
+            preferences['photo_group_enabled'] = True  # Default to show photo groups
+        if 'text_info_enabled' not in preferences:
+            preferences['text_info_enabled'] = False  # Default to hide text info
+        save_user_preferences(chat_id, preferences)
+
+        # Guide user through initial steps of setup: language selection or shop inclusion
+        if context.language is None:
+            language_selection(chat_id)
+        elif context.included_shops is None:
             include_user_tracking_shops(chat_id)
-        elif text == "➡️ Save tracking shop list. Return to the main menu":
-            if not get_included_shops(chat_id):
-                # No shops have been included yet, notify the user
-                requests.post(f"{API_URL}/sendMessage", json={
-                    "chat_id": chat_id,
-                    "text": "Please select at least one shop from the list:",
-                    "reply_markup": {
-                        "keyboard": [[shop] for shop in sorted(get_excluded_shops(chat_id))] + [
-                            ["⬅️ Back to main menu"]],
-                        "resize_keyboard": True}
-                })
-            else:
-                # At least one shop is included, allow returning to the menu
-                main_menu(chat_id)
-                save_user_state(chat_id, None)
         else:
-            # Get the list of excluded shops
-            shops = list(get_excluded_shops(chat_id))
-            # Check if the input text is a valid shop
-            if text in shops:
-                include_shop(chat_id, text)
-                # Ask if the user wants to add more shops or return to the main menu
-                requests.post(f"{API_URL}/sendMessage", json={
-                    "chat_id": chat_id,
-                    "text": "Do you want to add more shops or continue with the selected shop list?",
-                    "reply_markup": {
-                        "keyboard": [["➕ Add another shop"], ["➡️ Save tracking shop list. Return to the main menu"]],
-                        "resize_keyboard": True
-                    }
-                })
-                save_user_state(chat_id, '/start_selecting_shops')
-            elif text == "⬅️ Back to main menu":
-                # Check if any shops are included before allowing return to the main menu
-                if not get_included_shops(chat_id):
-                    requests.post(f"{API_URL}/sendMessage", json={
-                        "chat_id": chat_id,
-                        "text": "Please select at least one shop before returning to the menu:",
-                        "reply_markup": {"keyboard": [[shop] for shop in shops] + [["⬅️ Back to main menu"]],
-                                         "resize_keyboard": True}
-                    })
-                else:
-                    main_menu(chat_id)
-                    save_user_state(chat_id, None)
+            main_menu(chat_id)
+    else:
+        # If user is not new, take them directly to the main menu
+        main_menu(chat_id)
 
-            else:
-                # The user input is not a valid shop, ask them to select again
-                requests.post(f"{API_URL}/sendMessage", json={
-                    "chat_id": chat_id,
-                    "text": "Please select a valid shop from the list:",
-                    "reply_markup": {"keyboard": [[shop] for shop in shops] + [["⬅️ Back to main menu"]],
-                                     "resize_keyboard": True}
-                })
-
-    # Handle search functionality
-    elif text == "🔍 Search for item":
-        requests.post(f"{API_URL}/sendMessage", json={
+
+@on_command("⬅️ Back to main menu", next_state=IDLE,
+            states=('adding_item', 'searching_item', 'in_settings', 'shop_list_history', 'selecting_shops',
+                    'confirming_shops', 'entering_items', ANY_STATE))
+@on_command("ℹ️ About project", next_state=IDLE)
+def handle_main_menu(context):
+    if context.text == "ℹ️ About project":
+        about_text = "This bot helps you optimize your shopping by tracking prices, managing sale sheets, and finding the best shopping routes."
+        telegram.call("sendMessage", json={"chat_id": context.chat_id, "text": about_text})
+    main_menu(context.chat_id)
+
+
+@on_command("🔍 Search for item", next_state='searching_item')
+def handle_search_command(context):
+    telegram.call("sendMessage", json={
+        "chat_id": context.chat_id,
+        "text": "Please enter the name of the item you want to search for.",
+        "reply_markup": {"keyboard": [["⬅️ Back to main menu"]], "resize_keyboard": True}
+    })
+
+
+@on_command("🛒 Add shop item to track price", next_state='adding_item')
+def handle_add_item_command(context):
+    telegram.call("sendMessage", json={
+        "chat_id": context.chat_id,
+        "text": "Please provide the name of the shop item you want to track.",
+        "reply_markup": {"keyboard": [["⬅️ Back to main menu"]], "resize_keyboard": True}
+    })
+
+
+@on_command("⚙️ Settings", next_state='in_settings')
+def handle_settings_command(context):
+    settings_menu(context.chat_id)
+
+
+@on_command("🛍 Compare shopping list over shops", next_state='selecting_shops')
+def handle_compare_command(context):
+    # Clean preferences after unexpected last user manipulations
+    preferences = context.preferences
+    preferences['selected_shops'] = []
+    preferences['item_list'] = []
+    save_user_preferences(context.chat_id, preferences)
+
+    telegram.call("sendMessage", json={
+        "chat_id": context.chat_id,
+        "text": "Please select a shop or list of shops from your history.",
+        "reply_markup": {
+            "keyboard": [["List of all shops"], ["Lists of shops from history"], ["⬅️ Back to main menu"]],
+            "resize_keyboard": True}
+    })
+
+
+@on_input(ANY_STATE)
+def handle_unknown_input(context):
+    telegram.call("sendMessage", json={"chat_id": context.chat_id,
+                                       "text": "I'm sorry, I didn't understand that. Please choose an option from the menu."})
+
+
+# --------------- Message Handlers: Initial Shop Selection ---------------
+
+@on_command("➕ Add another shop", states=('/start_selecting_shops',))
+def handle_start_add_shop(context):
+    include_user_tracking_shops(context.chat_id)
+
+
+@on_command("➡️ Save tracking shop list. Return to the main menu", states=('/start_selecting_shops',))
+def handle_start_save_shops(context):
+    if not context.included_shops:
+        # No shops have been included yet, notify the user
+        telegram.call("sendMessage", json={
+            "chat_id": context.chat_id,
+            "text": "Please select at least one shop from the list:",
+            "reply_markup": {
+                "keyboard": [[shop] for shop in sorted(context.excluded_shops)] + [
+                    ["⬅️ Back to main menu"]],
+                "resize_keyboard": True}
+        })
+        return KEEP_STATE
+
+    # At least one shop is included, allow returning to the menu
+    main_menu(context.chat_id)
+    return IDLE
+
+
+@on_command("⬅️ Back to main menu", states=('/start_selecting_shops',))
+def handle_start_back(context):
+    # Check if any shops are included before allowing return to the main menu
+    if not context.included_shops:
+        telegram.call("sendMessage", json={
+            "chat_id": context.chat_id,
+            "text": "Please select at least one shop before returning to the menu:",
+            "reply_markup": {"keyboard": [[shop] for shop in context.excluded_shops] + [["⬅️ Back to main menu"]],
+                             "resize_keyboard": True}
+        })
+        return KEEP_STATE
+
+    main_menu(context.chat_id)
+    return IDLE
+
+
+@on_input('/start_selecting_shops')
+def handle_start_shop_input(context):
+    chat_id = context.chat_id
+    text = context.text
+    # Get the list of excluded shops
+    shops = list(context.excluded_shops)
+    # Check if the input text is a valid shop
+    if text in shops:
+        include_shop(chat_id, text)
+        # Ask if the user wants to add more shops or return to the main menu
+        telegram.call("sendMessage", json={
             "chat_id": chat_id,
-            "text": "Please enter the name of the item you want to search for.",
-            "reply_markup": {"keyboard": [["⬅️ Back to main menu"]], "resize_keyboard": True}
+            "text": "Do you want to add more shops or continue with the selected shop list?",
+            "reply_markup": {
+                "keyboard": [["➕ Add another shop"], ["➡️ Save tracking shop list. Return to the main menu"]],
+                "resize_keyboard": True
+            }
         })
-        save_user_state(chat_id, 'searching_item')
+    else:
+        # The user input is not a valid shop, ask them to select again
+        telegram.call("sendMessage", json={
+            "chat_id": chat_id,
+            "text": "Please select a valid shop from the list:",
+            "reply_markup": {"keyboard": [[shop] for shop in shops] + [["⬅️ Back to main menu"]],
+                             "resize_keyboard": True}
+        })
+
+
+# --------------- Message Handlers: Search and Tracking ---------------
+
+@on_input('adding_item', 'searching_item', next_state=IDLE)
+def handle_item_input(context):
+    chat_id = context.chat_id
+    item_name = context.text.strip()
+
+    if context.state == 'adding_item':
+        # Save the item for tracking and notify the user
+        added = add_tracked_item(chat_id, item_name)
+
+        if added:
+            response = f"'{item_name}' saved for tracking. I will notify you when '{item_name}' has a valid sale."
+            telegram.call("sendMessage", json={"chat_id": chat_id, "text": response})
+        else:
+            tracked_items = get_tracked_items(chat_id)
+            response = f"'{item_name}' is already in your tracking list. Here is your current list:\n" + "\n".join(
+                tracked_items)
+            telegram.call("sendMessage", json={"chat_id": chat_id, "text": response})
+            main_menu(chat_id)
+            return
+
+    if not search_and_send_page(chat_id, item_name):
+        telegram.call("sendMessage",
+                      json={"chat_id": chat_id, "text": f"No items found for '{item_name}'."})
+    main_menu(chat_id)
 
 
-    # Handle main menu options
-    elif text == "🛒 Add shop item to track price":
-        requests.post(f"{API_URL}/sendMessage", json={
+# --------------- Message Handlers: Settings ---------------
+
+@on_command("📄 Turn on items photo groups", "📄 Turn off items photo groups", states=('in_settings',))
+def handle_toggle_photo_groups(context):
+    chat_id = context.chat_id
+    # Toggle the photo group setting
+    current_photo_group_state = is_photo_group_enabled(chat_id)
+    current_text_info_state = is_text_info_enabled(chat_id)
+
+    # Check if both features would be disabled
+    if not current_text_info_state and current_photo_group_state:
+        # Cannot disable photo groups if text info is already disabled
+        telegram.call("sendMessage", json={
             "chat_id": chat_id,
-            "text": "Please provide the name of the shop item you want to track.",
-            "reply_markup": {"keyboard": [["⬅️ Back to main menu"]], "resize_keyboard": True}
+            "text": "At least one of the options (photo groups or text info) must be enabled. Text info is already disabled, so photo groups cannot be turned off."
         })
-        save_user_state(chat_id, 'adding_item')
+    else:
+        # Safe to toggle photo groups
+        set_photo_group_enabled(chat_id, not current_photo_group_state)
+        new_state = "enabled" if not current_photo_group_state else "disabled"
+        telegram.call("sendMessage", json={
+            "chat_id": chat_id,
+            "text": f"Item photo groups are now {new_state}."
+        })
+        settings_menu(chat_id)
+
+
+@on_command("📄 Turn on items text info", "📄 Turn off items text info", states=('in_settings',))
+def handle_toggle_text_info(context):
+    chat_id = context.chat_id
+    # Toggle the text info setting
+    current_photo_group_state = is_photo_group_enabled(chat_id)
+    current_text_info_state = is_text_info_enabled(chat_id)
 
-    elif text == "⚙️ Settings":
+    # Check if both features would be disabled
+    if not current_photo_group_state and current_text_info_state:
+        # Cannot disable text info if photo groups are already disabled
+        telegram.call("sendMessage", json={
+            "chat_id": chat_id,
+            "text": "At least one of the options (photo groups or text info) must be enabled. Photo groups are already disabled, so text info cannot be turned off."
+        })
+    else:
+        # Safe to toggle text info
+        set_text_info_enabled(chat_id, not current_text_info_state)
+        new_state = "enabled" if not current_text_info_state else "disabled"
+        telegram.call("sendMessage", json={
+            "chat_id": chat_id,
+            "text": f"Item text info is now {new_state}."
+        })
         settings_menu(chat_id)
-        save_user_state(chat_id, 'in_settings')
 
-    elif text == "🛍 Compare shopping list over shops":
-        # Clean preferences after unexpected last user manipulations
-        preferences = get_user_preferences(chat_id)
-        preferences['selected_shops'] = []
-        preferences['item_list'] = []
-        save_user_preferences(chat_id, preferences)
 
-        requests.post(f"{API_URL}/sendMessage", json={
+@on_command("🚫 Exclude some shops from tracking", states=('in_settings',))
+def handle_exclude_shops_command(context):
+    # Retrieve the included shops that can be excluded
+    included_shops = context.included_shops
+
+    # If there are no included shops, inform the user
+    if not included_shops:
+        telegram.call("sendMessage", json={
+            "chat_id": context.chat_id,
+            "text": "No shops are currently included for tracking."
+        })
+        return KEEP_STATE
+
+    # Present the user with a list of shops that can be excluded
+    telegram.call("sendMessage", json={
+        "chat_id": context.chat_id,
+        "text": "Please select a shop to exclude from tracking:",
+        "reply_markup": {
+            "keyboard": [[shop] for shop in included_shops] + [["⬅️ Back to settings"]],
+            "resize_keyboard": True}
+    })
+    return 'excluding_shop'
+
+
+@on_command("✅ Include some shops in tracking", states=('in_settings',))
+def handle_include_shops_command(context):
+    # Retrieve the excluded shops that can be included
+    excluded_shops = context.excluded_shops
+
+    # If all shops are already included, inform the user
+    if not excluded_shops:
+        telegram.call("sendMessage", json={
+            "chat_id": context.chat_id,
+            "text": "All shops are currently included for tracking."
+        })
+        return KEEP_STATE
+
+    # Present the user with a list of excluded shops that can be included
+    telegram.call("sendMessage", json={
+        "chat_id": context.chat_id,
+        "text": "Please select a shop to include in tracking:",
+        "reply_markup": {
+            "keyboard": [[shop] for shop in sorted(excluded_shops)] + [["⬅️ Back to settings"]],
+            "resize_keyboard": True}
+    })
+    return 'including_shop'
+
+
+@on_command("🛑 Remove shop item from tracking price", states=('in_settings',))
+def handle_remove_item_command(context):
+    items_to_remove = get_tracked_items(context.chat_id)
+    if items_to_remove:
+        telegram.call("sendMessage", json={
+            "chat_id": context.chat_id,
+            "text": "Select an item to remove from tracking:",
+            "reply_markup": {"keyboard": [[item] for item in items_to_remove] + [["⬅️ Back to settings"]],
+                             "resize_keyboard": True}
+        })
+        return 'removing_item'
+
+    telegram.call("sendMessage", json={
+        "chat_id": context.chat_id,
+        "text": "You don't have any items being tracked.",
+    })
+    settings_menu(context.chat_id)
+    return 'in_settings'
+
+
+@on_input('in_settings')
+def handle_settings_input(context):
+    pass  # Unknown input keeps the settings menu open
+
+
+@on_command("⬅️ Back to settings", states=('excluding_shop', 'including_shop', 'removing_item'),
+            next_state='in_settings')
+def handle_back_to_settings(context):
+    settings_menu(context.chat_id)
+
+
+@on_input('excluding_shop', next_state='in_settings')
+def handle_exclude_shop_input(context):
+    exclude_shop(context.chat_id, context.text)
+    telegram.call("sendMessage",
+                  json={"chat_id": context.chat_id, "text": f"Shop '{context.text}' excluded from tracking."})
+    settings_menu(context.chat_id)
+
+
+@on_input('including_shop', next_state='in_settings')
+def handle_include_shop_input(context):
+    include_shop(context.chat_id, context.text)
+    telegram.call("sendMessage",
+                  json={"chat_id": context.chat_id, "text": f"Shop '{context.text}' included for tracking."})
+    settings_menu(context.chat_id)
+
+
+@on_input('removing_item', next_state='in_settings')
+def handle_remove_item_input(context):
+    remove_tracked_item(context.chat_id, context.text)
+    telegram.call("sendMessage",
+                  json={"chat_id": context.chat_id, "text": f"Item '{context.text}' removed from tracking."})
+    settings_menu(context.chat_id)
+
+
+# --------------- Message Handlers: Shopping List Comparison ---------------
+
+@on_input('shop_list_history')
+def handle_shop_history_input(context):
+    chat_id = context.chat_id
+    shop_history = get_user_selected_shops_history(chat_id)
+    try:
+        index = int(context.text) - 1
+        if 0 <= index < len(shop_history):
+            selected_history_list = shop_history[index]
+            preferences = context.preferences
+            preferences['selected_shops'] = selected_history_list
+            # Proceed to item entry
+            telegram.call("sendMessage", json={
+                "chat_id": chat_id,
+                "text": "Please provide your shopping list, one per line and send.",
+                "reply_markup": {"keyboard": [["⬅️ Back to main menu"]], "resize_keyboard": True}
+            })
+            preferences['item_list'] = []
+            save_user_preferences(chat_id, preferences)
+            return 'entering_items'
+        else:
+            raise IndexError
+    except (ValueError, IndexError):
+        # Handle invalid input
+        keyboard_buttons = [[str(i + 1)] for i in range(len(shop_history))] + [["⬅️ Back to main menu"]]
+        text_message = "Invalid selection. Please choose a number from the list:\n"
+        for i, shop_list in enumerate(shop_history):
+            text_message += f"{i + 1}. {', '.join(shop_list)}\n"
+        telegram.call("sendMessage", json={
             "chat_id": chat_id,
-            "text": "Please select a shop or list of shops from your history.",
-            "reply_markup": {
-                "keyboard": [["List of all shops"], ["Lists of shops from history"], ["⬅️ Back to main menu"]],
-                "resize_keyboard": True}
+            "text": text_message,
+            "reply_markup": {"keyboard": keyboard_buttons, "resize_keyboard": True}
         })
-        save_user_state(chat_id, 'selecting_shops')
 
-    elif text == "ℹ️ About project":
-        about_text = "This bot helps you optimize your shopping by tracking prices, managing sale sheets, and finding the best shopping routes."
-        requests.post(f"{API_URL}/sendMessage", json={"chat_id": chat_id, "text": about_text})
-        main_menu(chat_id)
-        save_user_state(chat_id, None)
 
-    # Handle states
-    else:
-        if state == 'adding_item' or state == "searching_item":
-            if text == "⬅️ Back to main menu":
-                main_menu(chat_id)
-                save_user_state(chat_id, None)
-            else:
-                item_name = text.strip()
-
-                found_items = find_item(item_name, included_shops=get_included_shops(chat_id))
-
-                if state == 'adding_item':
-                    # Save the item for tracking and notify the user
-                    added = add_tracked_item(chat_id, item_name)
-
-                    if added:
-                        response = f"'{item_name}' saved for tracking. I will notify you when '{item_name}' has a valid sale."
-                        requests.post(f"{API_URL}/sendMessage", json={"chat_id": chat_id, "text": response})
-                    else:
-                        tracked_items = get_tracked_items(chat_id)
-                        response = f"'{item_name}' is already in your tracking list. Here is your current list:\n" + "\n".join(
-                            tracked_items)
-                        requests.post(f"{API_URL}/sendMessage", json={"chat_id": chat_id, "text": response})
-                        main_menu(chat_id)
-                        save_user_state(chat_id, None)
-                        return
-
-                if found_items:
-                    items_by_shop = {}
-                    for found_item in found_items:
-                        shop_name = found_item['shop_name']
-
-                        if shop_name not in items_by_shop:
-                            items_by_shop[shop_name] = []
-                        items_by_shop[shop_name].append(found_item)
-
-                    photo_group_enabled = is_photo_group_enabled(chat_id)
-                    text_info_enabled = is_text_info_enabled(chat_id)
-
-                    for shop_name, shop_items in items_by_shop.items():
-                        response = f"Here is what I found for '{item_name}' in {shop_name}:\n"
-                        media_group = []
-
-                        for found_item in shop_items:
-                            if text_info_enabled:
-                                response += f"- {found_item['item_name']} at {shop_name}: {found_item['price']}\n"
-
-                            s3_image_dir = found_item.get('image_name')
-                            # Collecting images for the media group (album) if photo group is enabled
-                            if photo_group_enabled and s3_image_dir:
-                                # Extract the filename from the full S3 path
-                                image_filename = os.path.basename(s3_image_dir)
-                                local_image_path = f"/tmp/{image_filename}"
-
-                                # Instead of reading the file content, pass the file path directly
-                                media_group.append((s3_image_dir, local_image_path))
-                                logger.debug(f"Image added to media_group: {local_image_path}")
-
-                        if media_group and photo_group_enabled:
-                            logger.debug(f"Sending media group for {shop_name} with {len(media_group)} images")
-                            send_images_as_album(chat_id, media_group, shop_name)
-
-                        if text_info_enabled:
-                            requests.post(f"{API_URL}/sendMessage", json={"chat_id": chat_id, "text": response})
-                else:
-                    requests.post(f"{API_URL}/sendMessage",
-                                  json={"chat_id": chat_id, "text": f"No items found for '{item_name}'."})
-                main_menu(chat_id)
-                save_user_state(chat_id, None)
-
-        elif state == 'in_settings':
-            if text == "⬅️ Back to main menu":
-                main_menu(chat_id)
-                save_user_state(chat_id, None)
-            elif text == "📄 Turn on items photo groups" or text == "📄 Turn off items photo groups":
-                # Toggle the photo group setting
-                current_photo_group_state = is_photo_group_enabled(chat_id)
-                current_text_info_state = is_text_info_enabled(chat_id)
-
-                # Check if both features would be disabled
-                if not current_text_info_state and current_photo_group_state:
-                    # Cannot disable photo groups if text info is already disabled
-                    requests.post(f"{API_URL}/sendMessage", json={
-                        "chat_id": chat_id,
-                        "text": "At least one of the options (photo groups or text info) must be enabled. Text info is already disabled, so photo groups cannot be turned off."
-                    })
-                else:
-                    # Safe to toggle photo groups
-                    set_photo_group_enabled(chat_id, not current_photo_group_state)
-                    new_state = "enabled" if not current_photo_group_state else "disabled"
-                    requests.post(f"{API_URL}/sendMessage", json={
-                        "chat_id": chat_id,
-                        "text": f"Item photo groups are now {new_state}."
-                    })
-                    settings_menu(chat_id)
-
-            elif text == "📄 Turn on items text info" or text == "📄 Turn off items text info":
-                # Toggle the text info setting
-                current_photo_group_state = is_photo_group_enabled(chat_id)
-                current_text_info_state = is_text_info_enabled(chat_id)
-
-                # Check if both features would be disabled
-                if not current_photo_group_state and current_text_info_state:
-                    # Cannot disable text info if photo groups are already disabled
-                    requests.post(f"{API_URL}/sendMessage", json={
-                        "chat_id": chat_id,
-                        "text": "At least one of the options (photo groups or text info) must be enabled. Photo groups are already disabled, so text info cannot be turned off."
-                    })
-                else:
-                    # Safe to toggle text info
-                    set_text_info_enabled(chat_id, not current_text_info_state)
-                    new_state = "enabled" if not current_text_info_state else "disabled"
-                    requests.post(f"{API_URL}/sendMessage", json={
-                        "chat_id": chat_id,
-                        "text": f"Item text info is now {new_state}."
-                    })
-                    settings_menu(chat_id)
-            elif text == "🚫 Exclude some shops from tracking":
-                # Retrieve the included shops that can be excluded
-                included_shops = get_included_shops(chat_id)
-
-                # If there are no included shops, inform the user
-                if not included_shops:
-                    requests.post(f"{API_URL}/sendMessage", json={
-                        "chat_id": chat_id,
-                        "text": "No shops are currently included for tracking."
-                    })
-                else:
-                    # Present the user with a list of shops that can be excluded
-                    requests.post(f"{API_URL}/sendMessage", json={
-                        "chat_id": chat_id,
-                        "text": "Please select a shop to exclude from tracking:",
-                        "reply_markup": {
-                            "keyboard": [[shop] for shop in included_shops] + [["⬅️ Back to settings"]],
-                            "resize_keyboard": True}
-                    })
-                    save_user_state(chat_id, 'excluding_shop')
-            elif text == "✅ Include some shops in tracking":
-                # Retrieve the excluded shops that can be included
-                excluded_shops = get_excluded_shops(chat_id)
-
-                # If all shops are already included, inform the user
-                if not excluded_shops:
-                    requests.post(f"{API_URL}/sendMessage", json={
-                        "chat_id": chat_id,
-                        "text": "All shops are currently included for tracking."
-                    })
-                else:
-                    # Present the user with a list of excluded shops that can be included
-                    requests.post(f"{API_URL}/sendMessage", json={
-                        "chat_id": chat_id,
-                        "text": "Please select a shop to include in tracking:",
-                        "reply_markup": {
-                            "keyboard": [[shop] for shop in sorted(excluded_shops)] + [["⬅️ Back to settings"]],
-                            "resize_keyboard": True}
-                    })
-                    save_user_state(chat_id, 'including_shop')
-            elif text == "🛑 Remove shop item from tracking price":
-                items_to_remove = get_tracked_items(chat_id)
-                if items_to_remove:
-                    requests.post(f"{API_URL}/sendMessage", json={
-                        "chat_id": chat_id,
-                        "text": "Select an item to remove from tracking:",
-                        "reply_markup": {"keyboard": [[item] for item in items_to_remove] + [["⬅️ Back to settings"]],
-                                         "resize_keyboard": True}
-                    })
-                    save_user_state(chat_id, 'removing_item')
-                else:
-                    requests.post(f"{API_URL}/sendMessage", json={
-                        "chat_id": chat_id,
-                        "text": "You don't have any items being tracked.",
-                    })
-                    settings_menu(chat_id)
-                    save_user_state(chat_id, 'in_settings')
-
-        elif state == 'excluding_shop':
-            if text == "⬅️ Back to settings":
-                settings_menu(chat_id)
-                save_user_state(chat_id, 'in_settings')
-            else:
-                exclude_shop(chat_id, text)
-                requests.post(f"{API_URL}/sendMessage",
-                              json={"chat_id": chat_id, "text": f"Shop '{text}' excluded from tracking."})
-                settings_menu(chat_id)
-                save_user_state(chat_id, 'in_settings')
-
-        elif state == 'including_shop':
-            if text == "⬅️ Back to settings":
-                settings_menu(chat_id)
-                save_user_state(chat_id, 'in_settings')
-            else:
-                include_shop(chat_id, text)
-                requests.post(f"{API_URL}/sendMessage",
-                              json={"chat_id": chat_id, "text": f"Shop '{text}' included for tracking."})
-                settings_menu(chat_id)
-                save_user_state(chat_id, 'in_settings')
-
-        elif state == 'removing_item':
-            if text == "⬅️ Back to settings":
-                settings_menu(chat_id)
-                save_user_state(chat_id, 'in_settings')
-            else:
-                remove_tracked_item(chat_id, text)
-                requests.post(f"{API_URL}/sendMessage",
-                              json={"chat_id": chat_id, "text": f"Item '{text}' removed from tracking."})
-                settings_menu(chat_id)
-                save_user_state(chat_id, 'in_settings')
-
-        elif state == "shop_list_history":
-            if text == "⬅️ Back to main menu":
-                main_menu(chat_id)
-                save_user_state(chat_id, None)
-            else:
-                try:
-                    index = int(text) - 1
-                    shop_history = get_user_selected_shops_history(chat_id)
-                    if 0 <= index < len(shop_history):
-                        selected_history_list = shop_history[index]
-                        preferences = get_user_preferences(chat_id)
-                        preferences['selected_shops'] = selected_history_list
-                        save_user_preferences(chat_id, preferences)
-                        # Proceed to item entry
-                        requests.post(f"{API_URL}/sendMessage", json={
-                            "chat_id": chat_id,
-                            "text": "Please provide your shopping list, one per line and send.",
-                            "reply_markup": {"keyboard": [["⬅️ Back to main menu"]], "resize_keyboard": True}
-                        })
-                        preferences['item_list'] = []
-                        save_user_preferences(chat_id, preferences)
-                        save_user_state(chat_id, 'entering_items')
-                    else:
-                        raise IndexError
-                except (ValueError, IndexError):
-                    # Handle invalid input
-                    shop_history = get_user_selected_shops_history(chat_id)
-                    keyboard_buttons = [[str(i + 1)] for i in range(len(shop_history))] + [["⬅️ Back to main menu"]]
-                    text_message = "Invalid selection. Please choose a number from the list:\n"
-                    for i, shop_list in enumerate(shop_history):
-                        text_message += f"{i + 1}. {', '.join(shop_list)}\n"
-                    requests.post(f"{API_URL}/sendMessage", json={
-                        "chat_id": chat_id,
-                        "text": text_message,
-                        "reply_markup": {"keyboard": keyboard_buttons, "resize_keyboard": True}
-                    })
-
-        elif state == 'selecting_shops':
-            if text == "⬅️ Back to main menu":
-                main_menu(chat_id)
-                save_user_state(chat_id, None)
-            elif text == "➡️ Continue with shop list":
-                preferences = get_user_preferences(chat_id)
-                selected_shops = preferences.get('selected_shops', [])
-                if not selected_shops:
-                    # No shops selected yet
-                    shops = get_all_shops()
-                    requests.post(f"{API_URL}/sendMessage", json={
-                        "chat_id": chat_id,
-                        "text": "You have not selected any shops. Please select at least one shop.",
-                        "reply_markup": {"keyboard": [[shop] for shop in shops] + [["⬅️ Back to main menu"]],
-                                         "resize_keyboard": True}
-                    })
-                    save_user_state(chat_id, 'selecting_shops')
-                else:
-                    logger.debug(selected_shops)
-                    save_user_selected_shops_history(chat_id, selected_shops)
-                    # Proceed to item entry
-                    requests.post(f"{API_URL}/sendMessage", json={
-                        "chat_id": chat_id,
-                        "text": "Please provide your shopping list, one by line and send.",
-                        "reply_markup": {"keyboard": [["⬅️ Back to main menu"]], "resize_keyboard": True}
-                    })
-
-                    # Not to overwrite history
-                    preferences = get_user_preferences(chat_id)
-                    preferences['item_list'] = []
-                    save_user_preferences(chat_id, preferences)
-                    save_user_state(chat_id, 'entering_items')
-            elif text == "Lists of shops from history":
-                # Get the user's shop history
-                shop_history = get_user_selected_shops_history(chat_id)
-                if shop_history:
-                    # Build the keyboard buttons with numbers
-                    keyboard_buttons = [[str(i + 1)] for i in range(len(shop_history))] + [["⬅️ Back to main menu"]]
-
-                    # Corrected prompt and display
-                    text_message = "Please select a shop list from your history:\n"
-                    for i, shop_list in enumerate(shop_history):
-                        text_message += f"{i + 1}. {', '.join(shop_list)}\n"
-
-                    # Send the message with the keyboard
-                    requests.post(f"{API_URL}/sendMessage", json={
-                        "chat_id": chat_id,
-                        "text": text_message,
-                        "reply_markup": {"keyboard": keyboard_buttons, "resize_keyboard": True}
-                    })
-
-                    # Save the user state
-                    save_user_state(chat_id, 'shop_list_history')
-                else:
-                    shops = get_all_shops()
-                    # The user input is not a valid shop
-                    requests.post(f"{API_URL}/sendMessage", json={
-                        "chat_id": chat_id,
-                        "text": "You don't have any history saved list. Please select a shop from the list:",
-                        "reply_markup": {"keyboard": [[shop] for shop in shops] + [["⬅️ Back to main menu"]],
-                                         "resize_keyboard": True}
-                    })
-            else:
-                # Get the list of available shops
-                shops = get_all_shops()
-                # Check if the input text is a valid shop
-                if text in shops:
-                    # Save the selected shop
-                    preferences = get_user_preferences(chat_id)
-                    selected_shops = preferences.get('selected_shops', [])
-                    if text not in selected_shops:
-                        selected_shops.append(text)
-                        preferences['selected_shops'] = selected_shops
-                        save_user_preferences(chat_id, preferences)
-                    # Ask if the user wants to add more shops or continue
-                    requests.post(f"{API_URL}/sendMessage", json={
-                        "chat_id": chat_id,
-                        "text": "Do you want to add more shops or continue with the selected shop list?",
-                        "reply_markup": {
-                            "keyboard": [["➕ Add another shop"], ["➡️ Continue with shop list"],
-                                         ["⬅️ Back to main menu"]],
-                            "resize_keyboard": True
-                        }
-                    })
-                    save_user_state(chat_id, 'confirming_shops')
+@on_command("➡️ Continue with shop list", states=('selecting_shops', 'confirming_shops'))
+def handle_continue_with_shops(context):
+    chat_id = context.chat_id
+    preferences = context.preferences
+    selected_shops = preferences.get('selected_shops', [])
+    if not selected_shops:
+        # No shops selected yet
+        shops = get_all_shops()
+        telegram.call("sendMessage", json={
+            "chat_id": chat_id,
+            "text": "You have not selected any shops. Please select at least one shop.",
+            "reply_markup": {"keyboard": [[shop] for shop in shops] + [["⬅️ Back to main menu"]],
+                             "resize_keyboard": True}
+        })
+        return 'selecting_shops'
 
-                else:
-                    # The user input is not a valid shop
-                    requests.post(f"{API_URL}/sendMessage", json={
-                        "chat_id": chat_id,
-                        "text": "Please select a shop from the list:",
-                        "reply_markup": {"keyboard": [[shop] for shop in shops] + [["⬅️ Back to main menu"]],
-                                         "resize_keyboard": True}
-                    })
-
-
-        elif state == 'confirming_shops':
-            if text == "⬅️ Back to main menu":
-                main_menu(chat_id)
-                save_user_state(chat_id, None)
-            elif text == "➕ Add another shop":
-                # Exclude already selected shops
-                preferences = get_user_preferences(chat_id)
-                selected_shops = preferences.get('selected_shops', [])
-                shops = [shop for shop in get_all_shops() if shop not in selected_shops]
-                if shops:
-                    requests.post(f"{API_URL}/sendMessage", json={
-                        "chat_id": chat_id,
-                        "text": "Please select shop from the list:",
-                        "reply_markup": {"keyboard": [[shop] for shop in shops] + [
-                            ["⬅️ Back to main menu"] + ["➡️ Continue with shop list"]],
-                                         "resize_keyboard": True}
-                    })
-                    save_user_state(chat_id, 'selecting_shops')
-                else:
-                    # All shops have been selected
-                    requests.post(f"{API_URL}/sendMessage", json={
-                        "chat_id": chat_id,
-                        "text": "You have selected all available shops.",
-                        "reply_markup": {
-                            "keyboard": [["➡️ Continue with shop list"], ["⬅️ Back to main menu"]],
-                            "resize_keyboard": True
-                        }
-                    })
-                    save_user_state(chat_id, 'confirming_shops')
-
-            elif text == "➡️ Continue with shop list":
-                preferences = get_user_preferences(chat_id)
-                selected_shops = preferences.get('selected_shops', [])
-                if not selected_shops:
-                    # No shops selected yet
-                    shops = get_all_shops()
-                    requests.post(f"{API_URL}/sendMessage", json={
-                        "chat_id": chat_id,
-                        "text": "You have not selected any shops. Please select at least one shop.",
-                        "reply_markup": {"keyboard": [[shop] for shop in shops] + [["⬅️ Back to main menu"]],
-                                         "resize_keyboard": True}
-                    })
-                    save_user_state(chat_id, 'selecting_shops')
-                else:
-                    logger.debug(selected_shops)
-                    save_user_selected_shops_history(chat_id, selected_shops)
-                    # Proceed to item entry
-                    requests.post(f"{API_URL}/sendMessage", json={
-                        "chat_id": chat_id,
-                        "text": "Please provide your shopping list, one by line and send.",
-                        "reply_markup": {"keyboard": [["⬅️ Back to main menu"]], "resize_keyboard": True}
-                    })
-
-                    # Not to overwrite history
-                    preferences = get_user_preferences(chat_id)
-                    preferences['item_list'] = []
-                    save_user_preferences(chat_id, preferences)
-                    save_user_state(chat_id, 'entering_items')
+    logger.debug(selected_shops)
+    save_user_selected_shops_history(chat_id, selected_shops)
+    # Proceed to item entry
+    telegram.call("sendMessage", json={
+        "chat_id": chat_id,
+        "text": "Please provide your shopping list, one by line and send.",
+        "reply_markup": {"keyboard": [["⬅️ Back to main menu"]], "resize_keyboard": True}
+    })
 
-            else:
-                # Handle unexpected input
-                requests.post(f"{API_URL}/sendMessage", json={
-                    "chat_id": chat_id,
-                    "text": "Please select an option from the menu."
-                })
-
-        elif state == 'entering_items':
-            if text == "⬅️ Back to main menu":
-                main_menu(chat_id)
-                save_user_state(chat_id, None)
-            else:
-                # Add item to the list
-                preferences = get_user_preferences(chat_id)
-                item_list = preferences.get('item_list', [])
-                item_list.extend(text.split('\n'))
-                preferences['item_list'] = item_list
-                save_user_preferences(chat_id, preferences)
-                preferences = get_user_preferences(chat_id)
-                selected_shops = preferences.get('selected_shops', [])
-                item_list = preferences.get('item_list', [])
-                response = "Here are the items found in the selected shops:\n"
-                # Retrieve user preferences for photo group and text info settings
-                photo_group_enabled = is_photo_group_enabled(chat_id)
-                text_info_enabled = is_text_info_enabled(chat_id)
-                # List to collect all images for the media group
-                for shop in selected_shops:
+    # Not to overwrite history
+    preferences['item_list'] = []
+    save_user_preferences(chat_id, preferences)
+    return 'entering_items'
+
+
+@on_command("Lists of shops from history", states=('selecting_shops',))
+def handle_shop_history_command(context):
+    chat_id = context.chat_id
+    # Get the user's shop history
+    shop_history = get_user_selected_shops_history(chat_id)
+    if shop_history:
+        # Build the keyboard buttons with numbers
+        keyboard_buttons = [[str(i + 1)] for i in range(len(shop_history))] + [["⬅️ Back to main menu"]]
+
+        # Corrected prompt and display
+        text_message = "Please select a shop list from your history:\n"
+        for i, shop_list in enumerate(shop_history):
+            text_message += f"{i + 1}. {', '.join(shop_list)}\n"
+
+        # Send the message with the keyboard
+        telegram.call("sendMessage", json={
+            "chat_id": chat_id,
+            "text": text_message,
+            "reply_markup": {"keyboard": keyboard_buttons, "resize_keyboard": True}
+        })
+        return 'shop_list_history'
+
+    shops = get_all_shops()
+    # The user input is not a valid shop
+    telegram.call("sendMessage", json={
+        "chat_id": chat_id,
+        "text": "You don't have any history saved list. Please select a shop from the list:",
+        "reply_markup": {"keyboard": [[shop] for shop in shops] + [["⬅️ Back to main menu"]],
+                         "resize_keyboard": True}
+    })
+
+
+@on_input('selecting_shops')
+def handle_shop_selection_input(context):
+    chat_id = context.chat_id
+    text = context.text
+    # Get the list of available shops ("List of all shops" lands here and gets the full list)
+    shops = get_all_shops()
+    # Check if the input text is a valid shop
+    if text not in shops:
+        # The user input is not a valid shop
+        telegram.call("sendMessage", json={
+            "chat_id": chat_id,
+            "text": "Please select a shop from the list:",
+            "reply_markup": {"keyboard": [[shop] for shop in shops] + [["⬅️ Back to main menu"]],
+                             "resize_keyboard": True}
+        })
+        return KEEP_STATE
+
+    # Save the selected shop
+    preferences = context.preferences
+    selected_shops = preferences.get('selected_shops', [])
+    if text not in selected_shops:
+        selected_shops.append(text)
+        preferences['selected_shops'] = selected_shops
+        save_user_preferences(chat_id, preferences)
+    # Ask if the user wants to add more shops or continue
+    telegram.call("sendMessage", json={
+        "chat_id": chat_id,
+        "text": "Do you want to add more shops or continue with the selected shop list?",
+        "reply_markup": {
+            "keyboard": [["➕ Add another shop"], ["➡️ Continue with shop list"],
+                         ["⬅️ Back to main menu"]],
+            "resize_keyboard": True
+        }
+    })
+    return 'confirming_shops'
+
+
+@on_command("➕ Add another shop", states=('confirming_shops',))
+def handle_add_another_shop(context):
+    # Exclude already selected shops
+    selected_shops = context.preferences.get('selected_shops', [])
+    shops = [shop for shop in get_all_shops() if shop not in selected_shops]
+    if shops:
+        telegram.call("sendMessage", json={
+            "chat_id": context.chat_id,
+            "text": "Please select shop from the list:",
+            "reply_markup": {"keyboard": [[shop] for shop in shops] + [
+                ["⬅️ Back to main menu"] + ["➡️ Continue with shop list"]],
+                             "resize_keyboard": True}
+        })
+        return 'selecting_shops'
+
+    # All shops have been selected
+    telegram.call("sendMessage", json={
+        "chat_id": context.chat_id,
+        "text": "You have selected all available shops.",
+        "reply_markup": {
+            "keyboard": [["➡️ Continue with shop list"], ["⬅️ Back to main menu"]],
+            "resize_keyboard": True
+        }
+    })
+
+
+@on_input('confirming_shops')
+def handle_confirming_shops_input(context):
+    # Handle unexpected input
+    telegram.call("sendMessage", json={
+        "chat_id": context.chat_id,
+        "text": "Please select an option from the menu."
+    })
+
+
+@on_input('entering_items', next_state=IDLE)
+def handle_shopping_list_input(context):
+    chat_id = context.chat_id
+    # Add item to the list
+    preferences = context.preferences
+    item_list = preferences.get('item_list', [])
+    item_list.extend(context.text.split('\n'))
+    preferences['item_list'] = item_list
+    selected_shops = preferences.get('selected_shops', [])
+    response = "Here are the items found in the selected shops:\n"
+    # Retrieve user preferences for photo group and text info settings
+    photo_group_enabled = is_photo_group_enabled(chat_id)
+    text_info_enabled = is_text_info_enabled(chat_id)
+    # Search the whole list in all selected shops at once
+    found_by_shop = find_items_batch(item_list, selected_shops, top_k=SEARCH_PAGE_SIZE)
+    # Every listed item gets its own image budget, filled with its best matches over all shops
+    album_images = set()
+    for item_name in set(name.strip() for name in item_list):
+        album_images |= select_album_images(
+            [found for shop_results in found_by_shop.values() for found in shop_results.get(item_name, [])])
+    album_tasks = []  # Albums of different shops are sent concurrently
+    # List to collect all images for the media group
+    for shop in selected_shops:
+        if text_info_enabled:
+            response += f"\nItems in {shop}:\n"
+        media_group = []  # List to collect all images for the media group
+        # Loop through each item in the item list and search for it in the specified shop
+        for item_name in item_list:
+            found_items = found_by_shop[shop].get(item_name.strip())
+
+            if found_items:
+                for found_item in found_items:
+                    # Extract price and image path details from the found item
+                    price = found_item.get('price')
+                    s3_image_dir = found_item.get('image_name')
+
+                    logger.debug(f"Found item: {found_item}")
+                    logger.debug(f"Price: {price}, Image Path: {s3_image_dir}")
+
+                    # Include price details in the response if text info is enabled
                     if text_info_enabled:
-                        response += f"\nItems in {shop}:\n"
-                    media_group = []  # List to collect all images for the media group
-                    # Loop through each item in the item list and search for it in the specified shop
-                    for item_name in item_list:
-                        found_items = find_item(item_name, shop)
-
-                        if found_items:
-                            for found_item in found_items:
-                                # Extract price and image path details from the found item
-                                price = found_item.get('price')
-                                s3_image_dir = found_item.get('image_name')
-
-                                logger.debug(f"Found item: {found_item}")
-                                logger.debug(f"Price: {price}, Image Path: {s3_image_dir}")
-
-                                # Include price details in the response if text info is enabled
-                                if text_info_enabled:
-                                    # Add the item price or "Price not found" based on availability
-                                    if price:
-                                        response += f"- {found_item['item_name']} at {shop}: {price}\n"
-                                    else:
-                                        response += f"- {found_item['item_name']} at {shop}: Price not found\n"
-
-                                # Process the image only if the photo group is enabled
-                                if photo_group_enabled and s3_image_dir:
-                                    # Extract the filename from the full S3 path
-                                    image_filename = os.path.basename(s3_image_dir)
-                                    local_image_path = f"/tmp/{image_filename}"
-
-                                    # Add the image filename and its corresponding local path to the media group
-                                    media_group.append((s3_image_dir, local_image_path))
-                                    logger.debug(f"Image added to media_group: {local_image_path}")
+                        # Add the item price or "Price not found" based on availability
+                        if price:
+                            response += f"- {found_item['item_name']} at {shop}: {price}\n"
                         else:
-                            # If the item is not found in the shop, add a not found message to the response
-                            response += f"- {item_name}: Not found in {shop}\n"
-
-                    # After looping through items, send the images as an album if there are any and photo group is enabled
-                    logger.debug(f"Media group length: {len(media_group)}. Photo group enabled: {photo_group_enabled}")
-                    if media_group and photo_group_enabled:
-                        logger.debug(f"Sending media group for shop: {shop}")
-                        send_images_as_album(chat_id, media_group, shop)
-                        media_group.clear()  # Clear the media group after sending to avoid duplicate entries
-                    else:
-                        logger.debug(f"No images to send or photo group is disabled")
-
-                # Send the final response with text results if text info is enabled
-                if text_info_enabled:
-                    requests.post(f"{API_URL}/sendMessage", json={"chat_id": chat_id, "text": response})
-
-                main_menu(chat_id)
-                save_user_state(chat_id, None)
-
-                # Clear selected shops and item list
-                preferences['selected_shops'] = []
-                preferences['item_list'] = []
-                save_user_preferences(chat_id, preferences)
+                            response += f"- {found_item['item_name']} at {shop}: Price not found\n"
 
-        else:
-            if text == "⬅️ Back to main menu":
-                main_menu(chat_id)
-                save_user_state(chat_id, None)
+                    # Process the image only if the photo group is enabled
+                    if photo_group_enabled and s3_image_dir in album_images:
+                        # Add the S3 image path and its score to the media group
+                        media_group.append((found_item['relevance'], s3_image_dir))
+                        logger.debug(f"Image added to media_group: {s3_image_dir}")
             else:
-                requests.post(f"{API_URL}/sendMessage", json={"chat_id": chat_id,
-                                                              "text": "I'm sorry, I didn't understand that. Please choose an option from the menu."})
+                # If the item is not found in the shop, add a not found message to the response
+                response += f"- {item_name}: Not found in {shop}\n"
+
+        # After looping through items, send the images as an album if there are any and photo group is enabled
+        logger.debug(f"Media group length: {len(media_group)}. Photo group enabled: {photo_group_enabled}")
+        if media_group and photo_group_enabled:
+            logger.debug(f"Sending media group for shop: {shop}")
+            # Best matches of the whole list first
+            media_group.sort(key=lambda image: image[0], reverse=True)
+            album_tasks.append(partial(send_images_as_album, chat_id,
+                                       [s3_image_dir for _, s3_image_dir in media_group], shop))
+        else:
+            logger.debug(f"No images to send or photo group is disabled")
+
+    telegram.run_concurrently(album_tasks)
+
+    # Send the final response with text results if text info is enabled
+    if text_info_enabled:
+        # Long lists are split into several messages
+        for text in split_message(response):
+            telegram.call("sendMessage", json={"chat_id": chat_id, "text": text})
+
+    main_menu(chat_id)
+
+    # Clear selected shops and item list
+    preferences['selected_shops'] = []
+    preferences['item_list'] = []
+    save_user_preferences(chat_id, preferences)
 
 
 # Handle callback queries from inline buttons (e.g., language selection)
@@ -1312,7 +2074,7 @@ def process_callback_query(update):
             "text": "Language updated!",  # Confirmation message to the user
             "show_alert": False  # Do not show a popup, just stop the loading animation
         }
-        requests.post(f"{API_URL}/answerCallbackQuery", json=answer_payload)
+        answer_future = telegram.call_async("answerCallbackQuery", json=answer_payload)
 
         # Edit the original message to remove the inline keyboard and update the text
         new_text = f"Language selected! You have set your language to: {get_available_languages().get(language_code, 'Unknown')}"
@@ -1322,27 +2084,129 @@ def process_callback_query(update):
             "text": new_text,
             "reply_markup": {}  # Remove the inline keyboard by setting an empty reply_markup
         }
-        requests.post(f"{API_URL}/editMessageText", json=edit_payload)
+        telegram.call("editMessageText", json=edit_payload)
+        answer_future.result()  # Both calls are independent and run in parallel
 
         # Proceed to include the shops tracking list for the user
         include_user_tracking_shops(chat_id)
 
+    # Check if the callback requests the next page of search results (data is 'more_<offset>')
+    elif data.startswith('more_'):
+        offset = int(data.split('_')[1])
+        item_name = get_user_preferences(chat_id).get('last_search')
+        answer_future = telegram.call_async("answerCallbackQuery", json={"callback_query_id": callback_query_id})
+
+        # Remove the button so that the same page is not requested twice
+        telegram.call("editMessageReplyMarkup", json={
+            "chat_id": chat_id,
+            "message_id": message_id,
+            "reply_markup": {}
+        })
+
+        if not item_name or not search_and_send_page(chat_id, item_name, offset):
+            telegram.call("sendMessage", json={"chat_id": chat_id, "text": "No more results found."})
+        answer_future.result()
+
+
+def process_update(update):
+    """
+    Processes a single Telegram update (message or callback query) and writes the
+    preference changes it made. Redelivered updates are dropped before any work is done,
+    unless the earlier attempt never completed and its lease expired.
+
+    :param update: The Telegram update.
+    """
+    update_id = update['update_id']
+    if not update_ledger.claim(update_id):
+        logger.info(f"Skipping already processed update {update_id}")
+        return
+
+    preference_sessions.clear()
+
+    try:
+        # Process message or callback query based on the update type
+        if 'message' in update:
+            process_message(update)
+        elif 'callback_query' in update:
+            process_callback_query(update)
+    except Exception:
+        # Let a redelivery of the update process it again
+        update_ledger.release(update_id)
+        raise
+    finally:
+        # Persist all preference changes of this update with a single write per user
+        try:
+            flush_preference_sessions()
+        except Exception as e:
+            logger.error(f"Error saving user preferences: {str(e)}")
+
+    # Only now redeliveries are dropped; a claim of an update that never got here expires with its lease
+    update_ledger.complete(update_id)
+
+
+# Queue decoupling the webhook response from the update processing (None in 'sync' mode)
+update_queue = create_update_queue(UPDATE_QUEUE_MODE, process_update, UPDATE_QUEUE_URL)
+
+
+def process_queued_updates(records):
+    """
+    Worker entry point: processes the updates of an SQS event in order. When an update fails,
+    it and all later updates of the same chat (message group) are reported as failures, so SQS
+    redelivers them without breaking the order of the chat.
+
+    :param records: The SQS event records.
+    :return: The partial batch response ('batchItemFailures').
+    """
+    failures = []
+    failed_groups = set()
+
+    for record in records:
+        group_id = record.get('attributes', {}).get('MessageGroupId')
+        if group_id in failed_groups:
+            failures.append({'itemIdentifier': record['messageId']})
+            continue
+
+        try:
+            process_update(json.loads(record['body']))
+        except Exception as e:
+            logger.error(f"Error processing queued update: {str(e)}")
+            failures.append({'itemIdentifier': record['messageId']})
+            failed_groups.add(group_id)
+
+    return {'batchItemFailures': failures}
+
 
 def lambda_handler(event, context):
     """
     This function will act as the webhook to handle Telegram updates when deployed to AWS Lambda.
     It will process both regular messages and callback queries.
+
+    With an update queue (UPDATE_QUEUE_MODE 'sqs' or 'local') the webhook only validates and
+    enqueues the update and answers Telegram at once; the same function invoked with the SQS
+    event of the queue acts as the worker.
     """
+    # Invocation by the SQS event source mapping of the update queue
+    if 'Records' in event:
+        return process_queued_updates(event['Records'])
+
     try:
         # Parse the body from the incoming event
         if 'body' in event:
             update = json.loads(event['body'])  # Extract the JSON body from the Lambda event
 
-            # Process message or callback query based on the update type
-            if 'message' in update:
-                process_message(update)  # Call your process_message function
-            elif 'callback_query' in update:
-                process_callback_query(update)  # Call your process_callback_query function
+            if not isinstance(update, dict) or 'update_id' not in update:
+                logger.error('Invalid update in the request')
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps({'error': 'Bad Request'})
+                }
+
+            # Other update types are acknowledged without processing
+            if 'message' in update or 'callback_query' in update:
+                if update_queue is not None:
+                    update_queue.enqueue(update)
+                else:
+                    process_update(update)
 
             # Return a success response to Telegram
             return {
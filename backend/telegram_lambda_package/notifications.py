@@ -0,0 +1,195 @@
+import logging
+import os
+from collections import defaultdict
+
+from aws_resources import LazyResource, lazy_table
+from detected_data import find_price_for_item
+from dynamodb_utils import parallel_scan
+from search_index import DETECTED_DATA_KEY, QueryMatcher, item_ngrams, normalize_name
+from send_scheduler import RateLimiter, SendScheduler
+from telegram_client import TelegramClient
+
+logger = logging.getLogger()
+
+# First text of every notification; the matched items follow in the same message
+NOTIFICATION_HEADER = "🔔 Items you track are on sale:"
+
+user_preferences_table = lazy_table('user_preferences')
+
+telegram = LazyResource(lambda: TelegramClient(
+    os.environ.get('TOKEN'), api_url=os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org'),
+    rate_limiter=RateLimiter()))
+
+
+# --------------- Tracked Query Index ---------------
+
+class TrackedQueryIndex:
+    """
+    Reverse index of the items tracked by all users. Every distinct normalized query is kept
+    once together with its subscribers, and every query bigram points to the queries containing
+    it, so a detected row is matched against all tracked queries by looking up its own bigrams
+    instead of comparing it with every query of every user.
+    """
+
+    def __init__(self):
+        self.matchers = []
+        self.queries = []
+        self.subscribers = []  # Per query: list of (chat_id, excluded shops, tracked item name)
+        self.query_ids = {}  # Normalized query -> position in the lists above
+        self.postings = defaultdict(list)  # Bigram -> positions of the queries containing it
+
+    def add(self, chat_id, item_name, excluded_shops=()):
+        """
+        Subscribes a chat to a tracked item.
+
+        :param chat_id: The chat tracking the item.
+        :param item_name: The tracked item name as entered by the user.
+        :param excluded_shops: The shops the user excluded from notifications.
+        """
+        query = normalize_name(item_name)
+        query_id = self.query_ids.get(query)
+
+        if query_id is None:
+            matcher = QueryMatcher(query)
+            if not matcher.ngrams:
+                return  # Names shorter than a bigram cannot be matched
+            query_id = len(self.matchers)
+            self.query_ids[query] = query_id
+            self.matchers.append(matcher)
+            self.queries.append(query)
+            self.subscribers.append([])
+            for ngram in matcher.ngrams:
+                self.postings[ngram].append(query_id)
+
+        self.subscribers[query_id].append((chat_id, frozenset(excluded_shops), item_name))
+
+    def match(self, item):
+        """
+        Finds the tracked queries a detected_data row matches (the row shares at least the
+        query's min_overlap bigrams, the rule used by searches).
+
+        :param item: The detected_data row.
+        :return: The list of matching query positions.
+        """
+        hits = defaultdict(int)
+        for ngram in item_ngrams(item):
+            for query_id in self.postings.get(ngram, ()):
+                hits[query_id] += 1
+
+        return [query_id for query_id, count in hits.items() if count >= self.matchers[query_id].min_overlap]
+
+    def __len__(self):
+        return len(self.matchers)
+
+
+def build_tracked_index():
+    """
+    Builds the reverse index from the user_preferences table with a single parallel scan.
+
+    :return: The TrackedQueryIndex.
+    """
+    index = TrackedQueryIndex()
+    rows = parallel_scan(user_preferences_table,
+                         ProjectionExpression='chat_id, tracked_items, excluded_shops',
+                         FilterExpression='attribute_exists(tracked_items)')
+
+    for row in rows:
+        excluded_shops = row.get('excluded_shops', ())
+        for item_name in row.get('tracked_items', ()):
+            index.add(row['chat_id'], item_name, excluded_shops)
+
+    logger.info(f"Tracked query index built with {len(index)} distinct queries")
+    return index
+
+
+# --------------- Matching ---------------
+
+def collect_notifications(index, items):
+    """
+    Streams detected_data rows once and groups the matches by chat. Only valid rows of shops
+    the user did not exclude are kept, and a row is reported to a chat once even if it matches
+    several of the chat's tracked items.
+
+    :param index: The TrackedQueryIndex.
+    :param items: An iterable of new detected_data rows.
+    :return: A dict mapping a chat id to a list of (tracked item name, row).
+    """
+    notifications = defaultdict(list)
+    notified = set()
+
+    for item in items:
+        if item.get('valid') is not True:
+            continue
+
+        shop_name = item.get('shop_name')
+        for query_id in index.match(item):
+            for chat_id, excluded_shops, item_name in index.subscribers[query_id]:
+                key = (chat_id, item.get(DETECTED_DATA_KEY))
+                if shop_name in excluded_shops or key in notified:
+                    continue
+                notified.add(key)
+                notifications[chat_id].append((item_name, item))
+
+    return notifications
+
+
+def format_match(item_name, item):
+    """
+    Formats one matched row of a notification.
+
+    :param item_name: The tracked item name the row matched.
+    :param item: The detected_data row.
+    :return: The text.
+    """
+    price = find_price_for_item(item).strip().replace('\n', ', ')
+    return f"'{item_name}': {item.get('item_name')} ({item.get('shop_name')})\n{price}"
+
+
+# --------------- Sending ---------------
+
+def send_notifications(notifications):
+    """
+    Sends the notifications as bulk messages through the send scheduler, which merges the
+    texts of a chat into as few messages as possible and paces them under Telegram's limits.
+    Chats that blocked the bot (403) are skipped.
+
+    :param notifications: A dict mapping a chat id to a list of (tracked item name, row).
+    :return: The number of chats notified.
+    """
+    scheduler = SendScheduler(telegram.get())
+    for chat_id, matches in notifications.items():
+        scheduler.submit(chat_id, NOTIFICATION_HEADER)
+        for item_name, item in matches:
+            scheduler.submit(chat_id, format_match(item_name, item))
+
+    delivered = 0
+    for chat_id, response in scheduler.flush().items():
+        if response is None:
+            continue
+        if response.status_code == 200:
+            delivered += 1
+        elif response.status_code == 403:
+            logger.info(f"Chat {chat_id} blocked the bot, notification skipped")
+        else:
+            logger.error(f"Error notifying chat {chat_id}: {response.text}")
+
+    return delivered
+
+
+def notify_tracked_items(items, index=None):
+    """
+    Notifies the users tracking any of the given new detected_data rows. This runs once per
+    ingested flyer: the tracked queries are indexed once and the rows are streamed once.
+
+    :param items: An iterable of new detected_data rows.
+    :param index: (Optional) A prebuilt TrackedQueryIndex.
+    :return: The number of notified chats.
+    """
+    index = index if index is not None else build_tracked_index()
+    if not len(index):
+        return 0
+
+    notifications = collect_notifications(index, items)
+    delivered = send_notifications(notifications)
+    logger.info(f"Notified {delivered} of {len(notifications)} chats about tracked items")
+    return delivered
@@ -0,0 +1,139 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+
+from aws_resources import lazy_table
+
+logger = logging.getLogger()
+
+# Registry table item whose 'version' counter is bumped whenever searchable data changes
+REGISTRY_TABLE = os.environ.get('REGISTRY_TABLE', 'bot_registry')
+DATA_VERSION_KEY = 'data_version'
+
+# Number of search results kept in the in-process LRU tier
+QUERY_CACHE_SIZE = int(os.environ.get('QUERY_CACHE_SIZE', '256'))
+
+# Optional second tier shared by all Lambda containers; disabled when empty.
+# Schema: partition key 'cache_key' (String), TTL attribute 'expires_at' (Number).
+QUERY_CACHE_TABLE = os.environ.get('QUERY_CACHE_TABLE', '')
+QUERY_CACHE_TTL = int(os.environ.get('QUERY_CACHE_TTL', '3600'))
+
+registry_table = lazy_table(REGISTRY_TABLE)
+
+
+# --------------- Data Version ---------------
+
+def get_data_version():
+    """
+    Reads the current data version. Cached results are keyed by it, so bumping the version
+    invalidates every cached result at once. The version is read (strongly consistent) on every
+    lookup and never kept in memory, so no result cached before a bump is served afterwards.
+
+    :return: The data version (0 if it was never bumped).
+    """
+    response = registry_table.get_item(Key={'registry_key': DATA_VERSION_KEY}, ConsistentRead=True)
+    return int(response.get('Item', {}).get('version', 0))
+
+
+def bump_data_version():
+    """
+    Increments the data version. Must be called after detected_data rows or the validity
+    of flyers change, e.g. once per ingested batch. This is the only writer of the version:
+    the admin API (backend/app.py) imports it from this module as well.
+
+    :return: The new data version.
+    """
+    response = registry_table.update_item(
+        Key={'registry_key': DATA_VERSION_KEY},
+        UpdateExpression='ADD version :one',
+        ExpressionAttributeValues={':one': 1},
+        ReturnValues='UPDATED_NEW'
+    )
+    return int(response['Attributes']['version'])
+
+
+# --------------- Result Cache ---------------
+
+class QueryResultCache:
+    """
+    Two-tier cache of search results: an LRU dict in process memory, kept across warm Lambda
+    invocations, and an optional DynamoDB table with TTL expiry shared by all containers.
+    Values must be JSON serializable.
+    """
+
+    def __init__(self, max_entries=QUERY_CACHE_SIZE, table_name=QUERY_CACHE_TABLE, ttl=QUERY_CACHE_TTL):
+        """
+        :param max_entries: The maximal number of entries held in memory.
+        :param table_name: (Optional) The DynamoDB table of the second tier; no second tier if empty.
+        :param ttl: Seconds an entry of the second tier stays valid.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.table = lazy_table(table_name) if table_name else None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Looks a key up in memory first and in the DynamoDB tier second.
+
+        :param key: The cache key.
+        :return: The cached value, or None on a miss.
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        if self.table is None:
+            return None
+
+        try:
+            item = self.table.get_item(Key={'cache_key': key}).get('Item')
+        except ClientError as e:
+            logger.error(f"Error reading query cache: {str(e)}")
+            return None
+
+        # Expired items may still be returned until DynamoDB's TTL process deletes them
+        if item is None or int(item['expires_at']) <= time.time():
+            return None
+
+        value = json.loads(item['value'])
+        self._remember(key, value)
+        return value
+
+    def put(self, key, value):
+        """
+        Stores a value in both tiers.
+
+        :param key: The cache key.
+        :param value: The JSON serializable value.
+        """
+        self._remember(key, value)
+
+        if self.table is None:
+            return
+
+        try:
+            self.table.put_item(Item={
+                'cache_key': key,
+                'value': json.dumps(value),
+                'expires_at': int(time.time()) + self.ttl
+            })
+        except ClientError as e:
+            logger.error(f"Error writing query cache: {str(e)}")
+
+    def _remember(self, key, value):
+        """
+        Stores a value in memory and evicts the least recently used entries.
+        """
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
@@ -0,0 +1,340 @@
+import heapq
+import math
+import os
+import re
+import zlib
+from collections import Counter
+
+from aws_resources import lazy_table
+from dynamodb_utils import iter_items
+
+# Name of the DynamoDB table holding the inverted bigram index.
+# Schema: partition key 'bigram' (String), sort key 'item_id' (String).
+SEARCH_INDEX_TABLE = os.environ.get('SEARCH_INDEX_TABLE', 'search_index')
+
+# Attribute of detected_data rows that uniquely identifies an item (its primary key)
+DETECTED_DATA_KEY = os.environ.get('DETECTED_DATA_KEY', 'image_id')
+
+# Size of the character n-grams used for matching
+NGRAM_SIZE = 2
+
+# Number of bits of the bigram fingerprint stored on detected_data rows
+FINGERPRINT_BITS = 64
+
+# Maximal number of candidates per query fetched from detected_data (best bigram overlap first)
+MAX_SEARCH_CANDIDATES = int(os.environ.get('MAX_SEARCH_CANDIDATES', '500'))
+
+# Weight of every word an item name has beyond the query's words in the relevance length penalty
+LENGTH_PENALTY = float(os.environ.get('LENGTH_PENALTY', '0.1'))
+
+# Splits text by any non-alphanumeric characters
+WORD_SPLIT_RE = re.compile(r'\W+')
+
+search_index_table = lazy_table(SEARCH_INDEX_TABLE)
+
+czech_to_english_map = str.maketrans(
+    "áčďéěíňóřšťúůýžÁČĎÉĚÍŇÓŘŠŤÚŮÝŽ",
+    "acdeeinorstuuyzACDEEINORSTUUYZ"
+)
+
+
+# --------------- Name Normalization ---------------
+
+def normalize_name(name):
+    """
+    Normalizes an item name for matching: lowercase, Czech diacritics replaced
+    by their English equivalents and whitespace control characters flattened.
+
+    :param name: The raw item name.
+    :return: The normalized name.
+    """
+    return (name or '').lower().translate(czech_to_english_map).replace('\n', ' ').replace('\t', ' ').strip()
+
+
+def generate_ngrams(text, n):
+    """
+    Generates n-grams from a given text.
+
+    :param text: The input text from which n-grams are generated.
+    :param n: The number of characters per n-gram.
+    :return: A set of n-grams.
+    """
+    words = WORD_SPLIT_RE.split(text)  # Split text by any non-alphanumeric characters
+    ngrams = set()
+
+    # Generate n-grams for each word in the text
+    for word in words:
+        for i in range(len(word) - n + 1):
+            ngrams.add(word[i:i + n])
+
+    return ngrams
+
+
+def ngram_bit(ngram):
+    """
+    Maps an n-gram to its bit position in the fingerprint. Uses CRC32 because the built-in
+    hash() of strings is randomized per process.
+
+    :param ngram: The n-gram.
+    :return: The bit position.
+    """
+    return zlib.crc32(ngram.encode('utf-8')) % FINGERPRINT_BITS
+
+
+def ngram_fingerprint(ngrams):
+    """
+    Folds a set of n-grams into a FINGERPRINT_BITS-bit bitset.
+
+    :param ngrams: The set of n-grams.
+    :return: The fingerprint as a non-negative integer.
+    """
+    fingerprint = 0
+    for ngram in ngrams:
+        fingerprint |= 1 << ngram_bit(ngram)
+    return fingerprint
+
+
+def search_fields(item_name):
+    """
+    Computes the precomputed search attributes stored on a detected_data row at ingest time.
+
+    :param item_name: The item name of the row.
+    :return: A dict with 'search_name', 'search_bigrams' (sorted list) and 'search_fingerprint'.
+    """
+    search_name = normalize_name(item_name)
+    ngrams = generate_ngrams(search_name, NGRAM_SIZE)
+    return {
+        'search_name': search_name,
+        'search_bigrams': sorted(ngrams),
+        'search_fingerprint': ngram_fingerprint(ngrams)
+    }
+
+
+def item_ngrams(item):
+    """
+    Returns the bigrams of a detected_data row's item name, using the precomputed
+    'search_bigrams' attribute when the row carries it.
+
+    :param item: The detected_data row.
+    :return: A set (or sorted list for precomputed rows) of bigrams.
+    """
+    if 'search_bigrams' in item:
+        return item['search_bigrams']
+    return generate_ngrams(normalize_name(item.get('item_name', '')), NGRAM_SIZE)
+
+
+def item_word_count(item):
+    """
+    Counts the words of a detected_data row's normalized item name.
+
+    :param item: The detected_data row.
+    :return: The number of words.
+    """
+    search_name = item.get('search_name')
+    if search_name is None:
+        search_name = normalize_name(item.get('item_name', ''))
+    return sum(1 for word in WORD_SPLIT_RE.split(search_name) if word)
+
+
+def inverse_document_frequency(document_frequency, total_documents):
+    """
+    Smoothed inverse document frequency of a bigram: bigrams found in few item names weigh more.
+
+    :param document_frequency: The number of items containing the bigram.
+    :param total_documents: The number of items in the corpus.
+    :return: The IDF weight (at least 1).
+    """
+    total_documents = max(total_documents, document_frequency)
+    return math.log((1 + total_documents) / (1 + document_frequency)) + 1
+
+
+class QueryMatcher:
+    """
+    Matches detected_data rows against one query. The query's bigrams and their fingerprint
+    bits are computed once, so rows carrying precomputed search attributes are matched without
+    normalizing names or building bigram sets.
+    """
+
+    def __init__(self, query):
+        search_name = normalize_name(query)
+        self.ngrams = generate_ngrams(search_name, NGRAM_SIZE)
+        self.ngram_bits = [1 << ngram_bit(ngram) for ngram in self.ngrams]
+        self.word_count = sum(1 for word in WORD_SPLIT_RE.split(search_name) if word)
+        # An item has to share all but one of the query bigrams (and at least one)
+        self.min_overlap = max(len(self.ngrams) - 1, 1)
+
+    def shared_ngrams(self, item):
+        """
+        Returns the query bigrams contained in the row's item name. Only the bigrams whose bit is
+        set in the row's fingerprint are looked up, and rows sharing none of them are rejected
+        without converting their bigram list.
+
+        :param item: The detected_data row.
+        :return: The set of shared bigrams.
+        """
+        fingerprint = item.get('search_fingerprint')
+        if fingerprint is None:
+            return self.ngrams.intersection(item_ngrams(item))
+
+        fingerprint = int(fingerprint)
+        candidates = [ngram for ngram, bit in zip(self.ngrams, self.ngram_bits) if fingerprint & bit]
+        if not candidates:
+            return set()
+
+        # The stored bigrams are a list; one set conversion makes every lookup constant time
+        return set(item_ngrams(item)).intersection(candidates)
+
+    def idf_weights(self, document_frequencies, total_documents):
+        """
+        Computes the IDF weight of every query bigram.
+
+        :param document_frequencies: A dict mapping a bigram to the number of items containing it.
+        :param total_documents: The number of items in the corpus.
+        :return: A dict mapping every query bigram to its weight.
+        """
+        return {ngram: inverse_document_frequency(document_frequencies.get(ngram, 0), total_documents)
+                for ngram in self.ngrams}
+
+    def relevance(self, item, shared_ngrams, idf_weights):
+        """
+        Scores a matched row: the IDF-weighted share of the query bigrams found in the item name,
+        times the Dice coefficient of both bigram sets, divided by a penalty for every word the
+        item name has beyond the query's words. Scores are in [0, 1].
+
+        :param item: The detected_data row.
+        :param shared_ngrams: The query bigrams contained in the row's item name.
+        :param idf_weights: The IDF weights of the query bigrams (see idf_weights).
+        :return: The relevance score.
+        """
+        if not self.ngrams:
+            return 0.0
+
+        weighted_recall = sum(idf_weights[ngram] for ngram in shared_ngrams) / sum(idf_weights.values())
+        dice = 2 * len(shared_ngrams) / (len(self.ngrams) + len(item_ngrams(item)))
+        extra_words = max(item_word_count(item) - self.word_count, 0)
+
+        return weighted_recall * dice / (1 + LENGTH_PENALTY * extra_words)
+
+
+# --------------- Index Maintenance ---------------
+
+def index_detected_item(item):
+    """
+    Adds the posting entries of a detected_data row to the inverted index. Only valid rows are
+    indexed, so posting lists grow with the current flyers rather than with all history.
+    Must be called by the ingestion path whenever a row is written to detected_data.
+
+    :param item: The detected_data row (must contain the DETECTED_DATA_KEY attribute).
+    :return: The number of posting entries written.
+    """
+    if item.get('valid') is not True:
+        return 0
+
+    item_id = item[DETECTED_DATA_KEY]
+    ngrams = item_ngrams(item)
+
+    with search_index_table.batch_writer(overwrite_by_pkeys=['bigram', 'item_id']) as batch:
+        for ngram in ngrams:
+            batch.put_item(Item={
+                'bigram': ngram,
+                'item_id': item_id,
+                'shop_name': item.get('shop_name', 'Unknown Shop')
+            })
+
+    return len(ngrams)
+
+
+def unindex_detected_item(item):
+    """
+    Removes the posting entries of a detected_data row from the inverted index.
+    Must be called whenever a row is deleted from detected_data, becomes invalid or its item name changes.
+
+    :param item: The detected_data row as it was indexed.
+    """
+    item_id = item[DETECTED_DATA_KEY]
+
+    with search_index_table.batch_writer(overwrite_by_pkeys=['bigram', 'item_id']) as batch:
+        for ngram in item_ngrams(item):
+            batch.delete_item(Key={'bigram': ngram, 'item_id': item_id})
+
+
+# --------------- Index Lookup ---------------
+
+def query_posting_list(ngram):
+    """
+    Yields the postings stored in the posting list of a single bigram.
+
+    :param ngram: The bigram to look up.
+    :return: A generator of (item_id, shop_name) tuples.
+    """
+    from boto3.dynamodb.conditions import Key  # Deferred import, see aws_resources.LazyResource
+
+    postings = iter_items(search_index_table.query,
+                          KeyConditionExpression=Key('bigram').eq(ngram),
+                          ProjectionExpression='item_id, shop_name')
+
+    for posting in postings:
+        yield posting['item_id'], posting.get('shop_name')
+
+
+def find_candidate_ids(query_ngrams, min_overlap, shop_names=None, document_frequencies=None,
+                       max_candidates=MAX_SEARCH_CANDIDATES):
+    """
+    Finds the items sharing at least min_overlap bigrams with the query by reading
+    only the posting lists of the query's bigrams.
+
+    :param query_ngrams: The set of bigrams of the normalized query.
+    :param min_overlap: The minimal number of shared bigrams for an item to qualify.
+    :param shop_names: (Optional) Collection of shop names to restrict the search to.
+    :param document_frequencies: (Optional) A dict filled with the posting list length of every read bigram.
+    :param max_candidates: The maximal number of candidates returned (those sharing the most bigrams).
+    :return: A dict mapping item id to the number of shared bigrams.
+    """
+    return find_candidate_ids_batch({None: query_ngrams}, {None: min_overlap}, shop_names,
+                                    document_frequencies, max_candidates)[None]
+
+
+def find_candidate_ids_batch(queries_ngrams, min_overlaps, shop_names=None, document_frequencies=None,
+                             max_candidates=MAX_SEARCH_CANDIDATES):
+    """
+    Resolves several queries against the index in one pass: the posting list of every distinct
+    bigram is read once, however many queries share it.
+
+    :param queries_ngrams: A dict mapping a query key to the set of bigrams of that query.
+    :param min_overlaps: A dict mapping a query key to its minimal number of shared bigrams.
+    :param shop_names: (Optional) Collection of shop names to restrict the search to.
+    :param document_frequencies: (Optional) A dict filled with the posting list length (over all shops)
+                                 of every read bigram, i.e. its document frequency for IDF weighting.
+    :param max_candidates: The maximal number of candidates per query (those sharing the most bigrams),
+                           which bounds the rows fetched from detected_data.
+    :return: A dict mapping each query key to a dict of item id -> number of shared bigrams.
+    """
+    shop_names = set(shop_names) if shop_names else None
+
+    # Reverse mapping: bigram -> the queries containing it
+    queries_by_ngram = {}
+    for query, ngrams in queries_ngrams.items():
+        for ngram in ngrams:
+            queries_by_ngram.setdefault(ngram, []).append(query)
+
+    overlaps = {query: Counter() for query in queries_ngrams}
+    for ngram, queries in queries_by_ngram.items():
+        posting_count = 0
+        for item_id, shop_name in query_posting_list(ngram):
+            posting_count += 1
+            if shop_names is not None and shop_name not in shop_names:
+                continue
+            for query in queries:
+                overlaps[query][item_id] += 1
+
+        if document_frequencies is not None:
+            document_frequencies[ngram] = posting_count
+
+    candidates = {}
+    for query, overlap in overlaps.items():
+        qualified = [(item_id, count) for item_id, count in overlap.items() if count >= min_overlaps[query]]
+        if len(qualified) > max_candidates:
+            qualified = heapq.nlargest(max_candidates, qualified, key=lambda candidate: candidate[1])
+        candidates[query] = dict(qualified)
+
+    return candidates
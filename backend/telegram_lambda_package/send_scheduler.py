@@ -0,0 +1,262 @@
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger()
+
+# Priorities of outgoing messages: interactive replies go before bulk notifications
+INTERACTIVE = 0
+BULK = 1
+
+# Messages per second sent by the bot in total (Telegram allows about 30)
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', '25'))
+
+# Messages per second sent to one chat (Telegram allows about 1) and the burst a chat may receive at once
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', '1'))
+TELEGRAM_CHAT_BURST = float(os.environ.get('TELEGRAM_CHAT_BURST', '5'))
+
+# Number of per-chat buckets kept in memory
+MAX_CHAT_BUCKETS = 10000
+
+# Telegram rejects messages longer than this
+MAX_MESSAGE_LENGTH = 4096
+
+# Separator of texts merged into one message
+MERGED_TEXT_SEPARATOR = "\n\n"
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at a constant rate up to its capacity; every message takes one token.
+    Not thread-safe, the owning RateLimiter serializes the access.
+    """
+
+    def __init__(self, rate, capacity):
+        """
+        :param rate: Tokens added per second.
+        :param capacity: The maximal number of tokens (the allowed burst).
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0  # Set by drain: no message before this time, whatever the priority
+
+    def wait_time(self, now):
+        """
+        Returns the seconds until a token is available (0 if one is available now).
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def drain(self, seconds):
+        """
+        Empties the bucket so that the next token is available only after the given seconds.
+        """
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class RateLimiter:
+    """
+    Paces outgoing Bot API calls with a global token bucket and one bucket per chat, so that
+    the bot stays under Telegram's limits instead of provoking 429 responses.
+
+    Only bulk messages (notifications) are paced per chat. An interactive reply to a user's own
+    action (albums, texts and the menu of one search) is sent at once and only counts against the
+    global bucket, unless Telegram asked the chat to back off (see penalize).
+    Within one process interactive callers also have priority: bulk callers wait while any
+    interactive caller is waiting. The bot and the notification job run in separate processes
+    with their own limiters, so this priority does not hold between them.
+    """
+
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE,
+                 chat_burst=TELEGRAM_CHAT_BURST, max_chat_buckets=MAX_CHAT_BUCKETS):
+        """
+        :param global_rate: Messages per second in total.
+        :param chat_rate: Messages per second to one chat.
+        :param chat_burst: Messages one chat may receive at once.
+        :param max_chat_buckets: The number of per-chat buckets kept (least recently used are dropped).
+        """
+        self.global_bucket = TokenBucket(global_rate, max(global_rate, 1))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_chat_buckets = max_chat_buckets
+        self.chat_buckets = OrderedDict()
+        self.condition = threading.Condition()
+        self.interactive_waiting = 0
+
+    def acquire(self, chat_id=None, priority=INTERACTIVE):
+        """
+        Blocks until a message may be sent.
+
+        :param chat_id: (Optional) The chat receiving the message; None only counts against the global bucket.
+        :param priority: INTERACTIVE or BULK.
+        """
+        with self.condition:
+            if priority == INTERACTIVE:
+                self.interactive_waiting += 1
+            try:
+                while True:
+                    if priority != INTERACTIVE and self.interactive_waiting:
+                        self.condition.wait()
+                        continue
+
+                    now = time.monotonic()
+                    wait = self.global_bucket.wait_time(now)
+                    chat_bucket = None
+                    if chat_id is not None and priority == INTERACTIVE:
+                        penalized_bucket = self.chat_buckets.get(str(chat_id))
+                        if penalized_bucket is not None:
+                            wait = max(wait, penalized_bucket.blocked_until - now)
+                    elif chat_id is not None:
+                        chat_bucket = self._chat_bucket(chat_id)
+                        wait = max(wait, chat_bucket.wait_time(now))
+
+                    if wait <= 0:
+                        self.global_bucket.take()
+                        if chat_bucket is not None:
+                            chat_bucket.take()
+                        return
+                    self.condition.wait(wait)
+            finally:
+                if priority == INTERACTIVE:
+                    self.interactive_waiting -= 1
+                    self.condition.notify_all()
+
+    def penalize(self, retry_after, chat_id=None):
+        """
+        Backs off after a 429 response: the chat's bucket (or the global one for calls without a
+        chat) is drained for the delay reported by Telegram, so all callers wait instead of retrying.
+
+        :param retry_after: The seconds Telegram asked to wait.
+        :param chat_id: (Optional) The chat of the rejected call.
+        """
+        with self.condition:
+            bucket = self._chat_bucket(chat_id) if chat_id is not None else self.global_bucket
+            bucket.drain(retry_after)
+
+    def _chat_bucket(self, chat_id):
+        """
+        Returns the bucket of a chat (the caller holds the lock).
+        """
+        chat_id = str(chat_id)
+        bucket = self.chat_buckets.get(chat_id)
+
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.chat_buckets[chat_id] = bucket
+            while len(self.chat_buckets) > self.max_chat_buckets:
+                self.chat_buckets.popitem(last=False)
+        else:
+            self.chat_buckets.move_to_end(chat_id)
+
+        return bucket
+
+
+def split_message(text, limit=MAX_MESSAGE_LENGTH):
+    """
+    Splits a text into messages Telegram accepts, preferably at line breaks.
+
+    :param text: The text.
+    :param limit: The maximal message length.
+    :return: The list of message texts.
+    """
+    messages = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        messages.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text:
+        messages.append(text)
+    return messages
+
+
+def merge_texts(texts, limit=MAX_MESSAGE_LENGTH):
+    """
+    Merges texts sent to the same chat into as few messages as possible, keeping their order.
+
+    :param texts: The texts.
+    :param limit: The maximal message length.
+    :return: The list of message texts.
+    """
+    messages = []
+    for text in texts:
+        for part in split_message(text, limit):
+            if messages and len(messages[-1]) + len(MERGED_TEXT_SEPARATOR) + len(part) <= limit:
+                messages[-1] += MERGED_TEXT_SEPARATOR + part
+            else:
+                messages.append(part)
+    return messages
+
+
+class SendScheduler:
+    """
+    Collects texts for many chats and sends them through a TelegramClient: the pending texts of
+    a chat are merged into as few messages as possible, chats with interactive texts are sent
+    first, and the client's rate limiter paces the calls.
+    """
+
+    def __init__(self, client):
+        """
+        :param client: The TelegramClient (should be created with a RateLimiter).
+        """
+        self.client = client
+        self.pending = {}  # Chat id -> list of texts
+        self.order = []  # Heap of (priority, sequence, chat id)
+        self.priorities = {}  # Chat id -> best priority of its pending texts
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+
+    def submit(self, chat_id, text, priority=BULK):
+        """
+        Queues a text for a chat.
+
+        :param chat_id: The chat.
+        :param text: The text.
+        :param priority: INTERACTIVE or BULK.
+        """
+        with self.lock:
+            self.pending.setdefault(chat_id, []).append(text)
+            if priority < self.priorities.get(chat_id, BULK + 1):
+                self.priorities[chat_id] = priority
+                heapq.heappush(self.order, (priority, next(self.sequence), chat_id))
+
+    def flush(self):
+        """
+        Sends all pending texts and waits until they were sent.
+
+        :return: A dict mapping a chat id to the response of its last message (None if the call failed).
+        """
+        with self.lock:
+            pending, order, priorities = self.pending, self.order, self.priorities
+            self.pending, self.order, self.priorities = {}, [], {}
+
+        tasks, chat_ids = [], []
+        while order:
+            priority, _, chat_id = heapq.heappop(order)
+            if priorities.get(chat_id) != priority:
+                continue  # Superseded by an entry with a better priority
+            del priorities[chat_id]
+            chat_ids.append(chat_id)
+            tasks.append(lambda chat_id=chat_id, priority=priority: self._send(chat_id, pending[chat_id], priority))
+
+        return dict(zip(chat_ids, self.client.run_concurrently(tasks)))
+
+    def _send(self, chat_id, texts, priority):
+        response = None
+        for text in merge_texts(texts):
+            response = self.client.call("sendMessage", json={"chat_id": chat_id, "text": text}, priority=priority)
+            if response.status_code != 200:
+                break  # E.g. the user blocked the bot, the remaining messages would fail as well
+        return response
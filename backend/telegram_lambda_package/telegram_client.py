@@ -0,0 +1,111 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from send_scheduler import INTERACTIVE
+
+logger = logging.getLogger()
+
+
+class TelegramClient:
+    """
+    Thin client for the Telegram Bot API. One pooled keep-alive session is shared by all calls,
+    so a warm Lambda container reuses its TLS connections to api.telegram.org across invocations.
+    Independent calls can be run concurrently on a bounded thread pool, and an optional
+    RateLimiter paces them under Telegram's global and per-chat limits.
+    """
+
+    def __init__(self, token, pool_size=8, max_retries=3, timeout=30, api_url='https://api.telegram.org',
+                 rate_limiter=None):
+        """
+        :param token: The bot token.
+        :param pool_size: The maximal number of pooled connections and concurrent calls.
+        :param max_retries: How many times a call rejected with 429 Too Many Requests is retried.
+        :param timeout: The timeout of a single HTTP request in seconds.
+        :param api_url: The Bot API server (e.g. a local stub for benchmarks).
+        :param rate_limiter: (Optional) The RateLimiter every call waits for.
+        """
+        self.api_url = f"{api_url}/bot{token}"
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='telegram')
+
+    def call(self, method, json=None, data=None, files=None, priority=INTERACTIVE):
+        """
+        Calls a Bot API method. Calls rejected with 429 are retried after the 'retry_after'
+        delay reported by Telegram; with a rate limiter, the delay holds back every call to the chat.
+
+        :param method: The Bot API method name, e.g. 'sendMessage'.
+        :param json: (Optional) The JSON payload.
+        :param data: (Optional) Form fields for multipart requests.
+        :param files: (Optional) Files for multipart requests.
+        :param priority: INTERACTIVE (replies to users) or BULK (notifications), see RateLimiter.
+        :return: The requests Response of the last attempt.
+        """
+        url = f"{self.api_url}/{method}"
+        chat_id = (json or data or {}).get('chat_id')
+
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter:
+                self.rate_limiter.acquire(chat_id, priority)
+
+            response = self.session.post(url, json=json, data=data, files=files, timeout=self.timeout)
+
+            if response.status_code != 429 or attempt == self.max_retries:
+                return response
+
+            retry_after = self._retry_after(response)
+            logger.warning(f"Telegram rate limit hit on {method}, retrying in {retry_after}s")
+            if self.rate_limiter:
+                self.rate_limiter.penalize(retry_after, chat_id)
+            else:
+                time.sleep(retry_after)
+
+        return response
+
+    def call_async(self, method, **kwargs):
+        """
+        Schedules a Bot API call on the client's thread pool.
+
+        :return: A Future resolving to the requests Response.
+        """
+        return self.executor.submit(self.call, method, **kwargs)
+
+    def run_concurrently(self, tasks):
+        """
+        Runs independent callables (e.g. one per shop sending its album and text) on the client's
+        thread pool and waits for all of them. Errors are logged and do not cancel the other tasks.
+
+        :param tasks: An iterable of zero-argument callables.
+        :return: The list of results in the order of the tasks (None for failed tasks).
+        """
+        futures = [self.executor.submit(task) for task in tasks]
+        results = []
+
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.error(f"Error in concurrent Telegram task: {str(e)}")
+                results.append(None)
+
+        return results
+
+    @staticmethod
+    def _retry_after(response):
+        """
+        Extracts the number of seconds to wait from a 429 response.
+        """
+        try:
+            return int(response.json().get('parameters', {}).get('retry_after', 1))
+        except ValueError:
+            return 1
@@ -0,0 +1,117 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+
+from aws_resources import lazy_table
+
+logger = logging.getLogger()
+
+# Ledger of claimed Telegram updates.
+# Schema: partition key 'update_id' (Number), TTL attribute 'expires_at' (Number);
+# 'lease_expires_at' (Number) is set while the update is in progress and removed once it is done.
+PROCESSED_UPDATES_TABLE = os.environ.get('PROCESSED_UPDATES_TABLE', 'processed_updates')
+
+# Seconds a processed update id stays recorded (Telegram gives up redelivering an update well before)
+UPDATE_LEDGER_TTL = int(os.environ.get('UPDATE_LEDGER_TTL', '3600'))
+
+# Seconds an update in progress stays claimed; a redelivery after that is processed again, so a claim
+# of a function killed mid-update (timeout, out of memory) expires. Must exceed the function timeout.
+UPDATE_LEASE_SECONDS = int(os.environ.get('UPDATE_LEASE_SECONDS', '180'))
+
+# Number of recently claimed update ids remembered in memory
+UPDATE_LEDGER_CACHE_SIZE = int(os.environ.get('UPDATE_LEDGER_CACHE_SIZE', '1024'))
+
+
+class UpdateLedger:
+    """
+    Makes update processing idempotent: an update is processed only by whoever claims its
+    update_id first. Claims are conditional puts into DynamoDB, so they hold across containers.
+    A claim is a lease until the update is marked done (complete): if the claimer dies without
+    completing or releasing it, a redelivery after the lease is processed again. An LRU of
+    completed ids in front of the table drops retries reaching the same warm container without
+    any request.
+    """
+
+    def __init__(self, table_name=PROCESSED_UPDATES_TABLE, ttl=UPDATE_LEDGER_TTL,
+                 cache_size=UPDATE_LEDGER_CACHE_SIZE, lease_seconds=UPDATE_LEASE_SECONDS):
+        """
+        :param table_name: The DynamoDB table of the ledger.
+        :param ttl: Seconds a processed update id is kept.
+        :param cache_size: The number of update ids remembered in memory.
+        :param lease_seconds: Seconds an update in progress stays claimed.
+        """
+        self.table = lazy_table(table_name)
+        self.ttl = ttl
+        self.lease_seconds = lease_seconds
+        self.cache_size = cache_size
+        self.recent_ids = OrderedDict()
+        self.lock = threading.Lock()
+
+    def claim(self, update_id):
+        """
+        Claims an update for processing.
+
+        :param update_id: The Telegram update_id.
+        :return: True if the caller should process the update (and complete or release it afterwards),
+                 False if it was processed before or is in progress elsewhere.
+        """
+        with self.lock:
+            if update_id in self.recent_ids:
+                self.recent_ids.move_to_end(update_id)
+                return False
+
+        now = int(time.time())
+        try:
+            self.table.put_item(
+                Item={'update_id': update_id, 'expires_at': now + self.ttl,
+                      'lease_expires_at': now + self.lease_seconds},
+                ConditionExpression='attribute_not_exists(update_id) OR expires_at < :now OR lease_expires_at < :now',
+                ExpressionAttributeValues={':now': now}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            # Rather process an update twice than drop it because the ledger is unavailable
+            logger.error(f"Error claiming update {update_id}: {str(e)}")
+
+        return True
+
+    def complete(self, update_id):
+        """
+        Marks a claimed update as done, so that redeliveries are dropped until the record expires.
+
+        :param update_id: The Telegram update_id.
+        """
+        with self.lock:
+            self._remember(update_id)
+
+        try:
+            self.table.update_item(Key={'update_id': update_id}, UpdateExpression='REMOVE lease_expires_at')
+        except ClientError as e:
+            logger.error(f"Error completing update {update_id}: {str(e)}")
+
+    def release(self, update_id):
+        """
+        Releases the claim of an update whose processing failed, so that a redelivery is processed.
+
+        :param update_id: The Telegram update_id.
+        """
+        with self.lock:
+            self.recent_ids.pop(update_id, None)
+
+        try:
+            self.table.delete_item(Key={'update_id': update_id})
+        except ClientError as e:
+            logger.error(f"Error releasing update {update_id}: {str(e)}")
+
+    def _remember(self, update_id):
+        """
+        Adds an update id to the in-memory LRU (the caller holds the lock).
+        """
+        self.recent_ids[update_id] = True
+        while len(self.recent_ids) > self.cache_size:
+            self.recent_ids.popitem(last=False)
@@ -0,0 +1,101 @@
+import json
+import logging
+import queue
+import threading
+
+from aws_resources import lazy_client
+
+logger = logging.getLogger()
+
+
+def update_chat_id(update):
+    """
+    Returns the chat a Telegram update belongs to, used as the ordering key of the queue.
+
+    :param update: The Telegram update.
+    :return: The chat id as a string ('global' for updates without a chat).
+    """
+    if 'message' in update:
+        return str(update['message']['chat']['id'])
+    if 'callback_query' in update:
+        return str(update['callback_query']['message']['chat']['id'])
+    return 'global'
+
+
+class SqsUpdateQueue:
+    """
+    Hands updates over to an SQS FIFO queue consumed by the worker (lambda_handler invoked with an
+    SQS event). The chat id is the message group, so updates of one chat are processed in order
+    while different chats are processed in parallel; the update_id deduplicates webhook retries.
+    """
+
+    def __init__(self, queue_url):
+        """
+        :param queue_url: The URL of the FIFO queue.
+        """
+        self.queue_url = queue_url
+        self.sqs = lazy_client('sqs')
+
+    def enqueue(self, update):
+        self.sqs.send_message(
+            QueueUrl=self.queue_url,
+            MessageBody=json.dumps(update),
+            MessageGroupId=update_chat_id(update),
+            MessageDeduplicationId=str(update['update_id'])
+        )
+
+
+class LocalUpdateQueue:
+    """
+    In-process stand-in for the SQS queue (local development and tests). A single worker thread
+    processes the updates in arrival order, which preserves the order of every chat. Lambda freezes
+    the process after a response, so this queue must not be used in deployed functions.
+    """
+
+    def __init__(self, process_update):
+        """
+        :param process_update: Callable processing one update.
+        """
+        self.process_update = process_update
+        self.updates = queue.Queue()
+        self.worker = threading.Thread(target=self._work, daemon=True, name='update-worker')
+        self.worker.start()
+
+    def enqueue(self, update):
+        self.updates.put(update)
+
+    def join(self):
+        """
+        Waits until every enqueued update was processed.
+        """
+        self.updates.join()
+
+    def _work(self):
+        while True:
+            update = self.updates.get()
+            try:
+                self.process_update(update)
+            except Exception as e:
+                logger.error(f"Error processing queued update {update.get('update_id')}: {str(e)}")
+            finally:
+                self.updates.task_done()
+
+
+def create_update_queue(mode, process_update, queue_url=None):
+    """
+    Creates the queue used by the webhook in the given mode.
+
+    :param mode: 'sqs', 'local', or 'sync' (no queue, updates are processed by the webhook itself).
+    :param process_update: Callable processing one update (used by the local queue).
+    :param queue_url: The URL of the SQS FIFO queue (required by the 'sqs' mode).
+    :return: The queue, or None in 'sync' mode.
+    """
+    if mode == 'sqs':
+        if not queue_url:
+            raise ValueError("UPDATE_QUEUE_URL is required in the 'sqs' update queue mode")
+        return SqsUpdateQueue(queue_url)
+    if mode == 'local':
+        return LocalUpdateQueue(process_update)
+    if mode != 'sync':
+        raise ValueError(f"Unknown update queue mode: {mode}")
+    return None
@@ -75,15 +75,7 @@ const PdfTable = ({ pdfs, refreshPdfs }) => {
   };
 
 
-  const sortedPdfs = pdfs.sort((a, b) => new Date(a.valid_to) - new Date(b.valid_to));
-
-  const isNearExpiry = (validToDate) => {
-    const today = new Date();
-    const validTo = new Date(validToDate);
-    const timeDiff = validTo - today;
-    const daysDiff = timeDiff / (1000 * 3600 * 24);
-    return daysDiff <= 2;
-  };
+  const sortedPdfs = [...pdfs].sort((a, b) => new Date(a.valid_to) - new Date(b.valid_to));
 
   return (
     <div>
@@ -103,7 +95,7 @@ const PdfTable = ({ pdfs, refreshPdfs }) => {
         </thead>
         <tbody>
           {sortedPdfs.map((pdf, index) => (
-            <tr key={index} className={isNearExpiry(pdf.valid_to) ? 'near-expiry' : ''}>
+            <tr key={index} className={pdf.near_expiry ? 'near-expiry' : ''}>
               <td>{pdf.shop_name}</td>
               <td><a href={`http://127.0.0.1:5000/uploads/${pdf.filename}`} target="_blank" rel="noopener noreferrer">{pdf.filename}</a></td>
               <td>{pdf.valid_from}</td>
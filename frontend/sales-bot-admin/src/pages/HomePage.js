@@ -1,23 +1,45 @@
-import React, { useEffect, useState } from 'react';
+import React, { useCallback, useEffect, useState } from 'react';
 import PdfTable from '../components/PdfTable';
+import ShopSelector from '../components/ShopSelector';
 import axios from 'axios';
 import { Link } from 'react-router-dom';
 
 const HomePage = () => {
   const [pdfs, setPdfs] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [shops, setShops] = useState([]);
+  const [selectedShop, setSelectedShop] = useState('');
+  const [hideUsed, setHideUsed] = useState(false);
 
-  const fetchPdfs = () => {
-    axios.get('http://127.0.0.1:5000/pdfs')
+  // Loads the first page (or the page after `cursor`) with the current filters
+  const fetchPdfs = useCallback((cursor = null) => {
+    const params = {};
+    if (selectedShop) params.shop = selectedShop;
+    if (hideUsed) params.used = 'false';
+    if (cursor) params.cursor = cursor;
+
+    axios.get('http://127.0.0.1:5000/pdfs', { params })
       .then(response => {
-        setPdfs(response.data);
+        setPdfs(previous => (cursor ? [...previous, ...response.data.items] : response.data.items));
+        setNextCursor(response.data.next_cursor);
       })
       .catch(error => {
         console.error('Error fetching PDFs:', error);
       });
-  };
+  }, [selectedShop, hideUsed]);
 
   useEffect(() => {
     fetchPdfs();
+  }, [fetchPdfs]);
+
+  useEffect(() => {
+    axios.get('http://127.0.0.1:5000/shops')
+      .then(response => {
+        setShops(response.data.sort((a, b) => a.name.localeCompare(b.name)));
+      })
+      .catch(error => {
+        console.error('Error fetching shops:', error);
+      });
   }, []);
 
   return (
@@ -26,7 +48,17 @@ const HomePage = () => {
       <div>
         <Link to="/upload" style={{ display: 'block', marginBottom: '10px' }}>Upload New PDF</Link>
       </div>
-      <PdfTable pdfs={pdfs} refreshPdfs={fetchPdfs} />
+      <div style={{ marginBottom: '10px' }}>
+        <ShopSelector shops={shops} onSelectShop={setSelectedShop} />
+        <label>
+          <input type="checkbox" checked={hideUsed} onChange={(e) => setHideUsed(e.target.checked)} />
+          Hide processed PDFs
+        </label>
+      </div>
+      <PdfTable pdfs={pdfs} refreshPdfs={() => fetchPdfs()} />
+      {nextCursor && (
+        <button onClick={() => fetchPdfs(nextCursor)} style={{ marginTop: '10px' }}>Load more</button>
+      )}
     </div>
   );
 };